@@ -14,9 +14,11 @@ from ten import (
     StatusCode,
     CmdResult,
 )
+from .conversation_memory import ConversationMemory
 from .litellm import LiteLLM, LiteLLMConfig
 from .log import logger
-from .utils import get_micro_ts, parse_sentence
+from .sentence_segmenter import SentenceSegmenter, get_punctuations
+from .utils import get_micro_ts
 
 
 CMD_IN_FLUSH = "flush"
@@ -31,20 +33,26 @@ PROPERTY_BASE_URL = "base_url"  # Optional
 PROPERTY_FREQUENCY_PENALTY = "frequency_penalty"  # Optional
 PROPERTY_GREETING = "greeting"  # Optional
 PROPERTY_MAX_MEMORY_LENGTH = "max_memory_length"  # Optional
+PROPERTY_MAX_MEMORY_TOKENS = "max_memory_tokens"  # Optional
+PROPERTY_MIN_SENTENCE_LENGTH = "min_sentence_length"  # Optional
 PROPERTY_MAX_TOKENS = "max_tokens"  # Optional
 PROPERTY_MODEL = "model"  # Optional
 PROPERTY_PRESENCE_PENALTY = "presence_penalty"  # Optional
 PROPERTY_PROMPT = "prompt"  # Optional
+PROPERTY_SENTENCE_LANGUAGE = "sentence_language"  # Optional
 PROPERTY_PROVIDER = "provider"  # Optional
 PROPERTY_TEMPERATURE = "temperature"  # Optional
 PROPERTY_TOP_P = "top_p"  # Optional
 
 
 class LiteLLMExtension(Extension):
-    memory = []
+    memory = None
     max_memory_length = 10
+    max_memory_tokens = 2048
     outdate_ts = 0
     litellm = None
+    sentence_punctuations = get_punctuations("default")
+    min_sentence_length = 0
 
     def on_start(self, ten: TenEnv) -> None:
         logger.info("LiteLLMExtension on_start")
@@ -65,12 +73,34 @@ class LiteLLMExtension(Extension):
             except Exception as e:
                 logger.warning(f"get_property_float optional {key} failed, err: {e}")
 
+        for key in [PROPERTY_MAX_MEMORY_LENGTH, PROPERTY_MAX_MEMORY_TOKENS]:
+            try:
+                value = int(ten.get_property_int(key))
+                if value > 0:
+                    setattr(self, key, value)
+            except Exception as e:
+                logger.warning(f"get_property_int optional {key} failed, err: {e}")
+
+        self.memory = ConversationMemory(self.max_memory_tokens, self.max_memory_length)
+
         for key in [PROPERTY_MAX_MEMORY_LENGTH, PROPERTY_MAX_TOKENS]:
             try:
                 litellm_config.key = int(ten.get_property_int(key))
             except Exception as e:
                 logger.warning(f"get_property_int optional {key} failed, err: {e}")
 
+        try:
+            self.sentence_punctuations = get_punctuations(ten.get_property_string(PROPERTY_SENTENCE_LANGUAGE))
+        except Exception as e:
+            logger.warning(f"get_property_string optional {PROPERTY_SENTENCE_LANGUAGE} failed, err: {e}")
+
+        try:
+            min_sentence_length = ten.get_property_int(PROPERTY_MIN_SENTENCE_LENGTH)
+            if min_sentence_length > 0:
+                self.min_sentence_length = int(min_sentence_length)
+        except Exception as e:
+            logger.warning(f"get_property_int optional {PROPERTY_MIN_SENTENCE_LENGTH} failed, err: {e}")
+
         # Create LiteLLM instance
         self.litellm = LiteLLM(litellm_config)
         logger.info(f"newLiteLLM succeed with max_tokens: {litellm_config.max_tokens}, model: {litellm_config.model}")
@@ -148,8 +178,6 @@ class LiteLLMExtension(Extension):
             return
 
         # Prepare memory
-        if len(self.memory) > self.max_memory_length:
-            self.memory.pop(0)
         self.memory.append({"role": "user", "content": input_text})
 
         def chat_completions_stream_worker(start_time, input_text, memory):
@@ -162,7 +190,7 @@ class LiteLLMExtension(Extension):
                     logger.info(f"chat_completions_stream_worker for input text: [{input_text}] failed")
                     return
 
-                sentence = ""
+                segmenter = SentenceSegmenter(self.sentence_punctuations, self.min_sentence_length)
                 full_content = ""
                 first_sentence_sent = False
 
@@ -178,13 +206,7 @@ class LiteLLMExtension(Extension):
 
                     full_content += content
 
-                    while True:
-                        sentence, content, sentence_is_final = parse_sentence(sentence, content)
-
-                        if len(sentence) == 0 or not sentence_is_final:
-                            logger.info(f"sentence {sentence} is empty or not final")
-                            break
-
+                    for sentence in segmenter.feed(content):
                         logger.info(f"chat_completions_stream_worker recv for input text: [{input_text}] got sentence: [{sentence}]")
 
                         # send sentence
@@ -198,15 +220,15 @@ class LiteLLMExtension(Extension):
                             logger.error(f"chat_completions_stream_worker recv for input text: [{input_text}] send sentence [{sentence}] failed, err: {e}")
                             break
 
-                        sentence = ""
                         if not first_sentence_sent:
                             first_sentence_sent = True
                             logger.info(f"chat_completions_stream_worker recv for input text: [{input_text}] first sentence sent, first_sentence_latency {get_micro_ts() - start_time}ms")
 
                 # remember response as assistant content in memory
-                memory.append({"role": "assistant", "content": full_content})
+                self.memory.append({"role": "assistant", "content": full_content})
 
                 # send end of segment
+                sentence = segmenter.flush()
                 try:
                     output_data = Data.create("text_data")
                     output_data.set_property_string(DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence)
@@ -223,7 +245,7 @@ class LiteLLMExtension(Extension):
         start_time = get_micro_ts()
         thread = Thread(
             target=chat_completions_stream_worker,
-            args=(start_time, input_text, self.memory),
+            args=(start_time, input_text, self.memory.messages()),
         )
         thread.start()
         logger.info(f"LiteLLMExtension on_data end")
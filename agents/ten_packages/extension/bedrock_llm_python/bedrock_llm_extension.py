@@ -1,4 +1,18 @@
 from .bedrock_llm import BedrockLLM, BedrockLLMConfig
+from .conversation_memory import ConversationMemory
+from .inflight_streams import InflightStreams
+from .sentence_segmenter import SentenceSegmenter, get_punctuations
+from .speculative import Speculator, TurnOutput
+from .turn_timeline import (
+    STAGE_ASR_FINAL,
+    STAGE_FIRST_SENTENCE,
+    STAGE_FIRST_TOKEN,
+    STAGE_FLUSH,
+    DATA_PROPERTY_TURN_ID,
+    STAGE_LLM_REQUEST,
+    TimelineRecorder,
+    get_asr_final_ms,
+)
 from datetime import datetime
 from threading import Thread
 from ten import (
@@ -31,6 +45,12 @@ PROPERTY_TOP_P = "top_p"  # Optional
 PROPERTY_MAX_TOKENS = "max_tokens"  # Optional
 PROPERTY_GREETING = "greeting"  # Optional
 PROPERTY_MAX_MEMORY_LENGTH = "max_memory_length"  # Optional
+PROPERTY_MAX_MEMORY_TOKENS = "max_memory_tokens"  # Optional
+PROPERTY_SENTENCE_LANGUAGE = "sentence_language"  # Optional
+PROPERTY_MIN_SENTENCE_LENGTH = "min_sentence_length"  # Optional
+PROPERTY_SPECULATIVE_COMPLETION = "speculative_completion"  # Optional
+PROPERTY_SPECULATIVE_STABLE_MS = "speculative_stable_ms"  # Optional
+PROPERTY_TIMELINE_PATH = "timeline_path"  # Optional
 
 
 def get_current_time():
@@ -41,36 +61,21 @@ def get_current_time():
     return unix_microseconds
 
 
-def is_punctuation(char):
-    if char in [",", "，", ".", "。", "?", "？", "!", "！"]:
-        return True
-    return False
-
-
-def parse_sentence(sentence, content):
-    remain = ""
-    found_punc = False
-
-    for char in content:
-        if not found_punc:
-            sentence += char
-        else:
-            remain += char
-
-        if not found_punc and is_punctuation(char):
-            found_punc = True
-
-    return sentence, remain, found_punc
-
-
 class BedrockLLMExtension(Extension):
-    memory = []
+    memory = None
     max_memory_length = 10
+    max_memory_tokens = 2048
     outdate_ts = 0
     bedrock_llm = None
+    sentence_punctuations = get_punctuations("default")
+    min_sentence_length = 0
+    inflight_streams = None
+    speculator = None
+    timelines = None
 
     def on_start(self, ten: TenEnv) -> None:
         logger.info("BedrockLLMExtension on_start")
+        self.inflight_streams = InflightStreams()
         # Prepare configuration
         bedrock_llm_config = BedrockLLMConfig.default_config()
 
@@ -125,12 +130,82 @@ class BedrockLLMExtension(Extension):
                 f"GetProperty optional {PROPERTY_MAX_MEMORY_LENGTH} failed, err: {err}."
             )
 
+        try:
+            prop_max_memory_tokens = ten.get_property_int(PROPERTY_MAX_MEMORY_TOKENS)
+            if prop_max_memory_tokens > 0:
+                self.max_memory_tokens = int(prop_max_memory_tokens)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_MAX_MEMORY_TOKENS} failed, err: {err}."
+            )
+
+        self.memory = ConversationMemory(
+            self.max_memory_tokens, self.max_memory_length
+        )
+
+        try:
+            sentence_language = ten.get_property_string(PROPERTY_SENTENCE_LANGUAGE)
+            self.sentence_punctuations = get_punctuations(sentence_language)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_SENTENCE_LANGUAGE} failed, err: {err}."
+            )
+
+        try:
+            min_sentence_length = ten.get_property_int(PROPERTY_MIN_SENTENCE_LENGTH)
+            if min_sentence_length > 0:
+                self.min_sentence_length = int(min_sentence_length)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_MIN_SENTENCE_LENGTH} failed, err: {err}."
+            )
+
+        speculative_completion = False
+        try:
+            speculative_completion = ten.get_property_bool(
+                PROPERTY_SPECULATIVE_COMPLETION
+            )
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_SPECULATIVE_COMPLETION} failed, err: {err}."
+            )
+
+        speculative_stable_ms = 400
+        try:
+            prop_speculative_stable_ms = ten.get_property_int(
+                PROPERTY_SPECULATIVE_STABLE_MS
+            )
+            if prop_speculative_stable_ms > 0:
+                speculative_stable_ms = int(prop_speculative_stable_ms)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_SPECULATIVE_STABLE_MS} failed, err: {err}."
+            )
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_TIMELINE_PATH} failed, err: {err}."
+            )
+        self.timelines = TimelineRecorder("bedrock_llm_python", timeline_path)
+
+        if speculative_completion:
+            self.speculator = Speculator(
+                speculative_stable_ms,
+                lambda turn: self.start_speculation(ten, turn),
+            )
+
         # Create bedrockLLM instance
         try:
             self.bedrock_llm = BedrockLLM(bedrock_llm_config)
             logger.info(
                 f"newBedrockLLM succeed with max_tokens: {bedrock_llm_config.max_tokens}, model: {bedrock_llm_config.model}"
             )
+            self.inflight_streams.default_completion_tokens = (
+                bedrock_llm_config.max_tokens
+            )
         except Exception as err:
             logger.exception(f"newBedrockLLM failed, err: {err}")
 
@@ -152,6 +227,12 @@ class BedrockLLMExtension(Extension):
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("BedrockLLMExtension on_stop")
+        if self.speculator is not None:
+            self.speculator.cancel()
+        self.outdate_ts = get_current_time()
+        self.inflight_streams.cancel_all()
+        if self.timelines is not None:
+            self.timelines.report()
         ten.on_stop_done()
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
@@ -163,6 +244,9 @@ class BedrockLLMExtension(Extension):
 
         if cmd_name == CMD_IN_FLUSH:
             self.outdate_ts = get_current_time()
+            # close in-flight event streams, bedrock stops generating right away
+            self.inflight_streams.cancel_all(self.outdate_ts)
+            logger.info(f"in-flight streams stats: {self.inflight_streams.stats()}")
             cmd_out = Cmd.create(CMD_OUT_FLUSH)
             ten.send_cmd(cmd_out, None)
             logger.info(f"BedrockLLMExtension on_cmd sent flush")
@@ -190,7 +274,7 @@ class BedrockLLMExtension(Extension):
         # Assume 'data' is an object from which we can get properties
         try:
             is_final = data.get_property_bool(DATA_IN_TEXT_DATA_PROPERTY_IS_FINAL)
-            if not is_final:
+            if not is_final and self.speculator is None:
                 logger.info("ignore non-final input")
                 return
         except Exception as err:
@@ -212,55 +296,119 @@ class BedrockLLMExtension(Extension):
             )
             return
 
-        # Prepare memory. A conversation must alternate between user and assistant roles
-        while len(self.memory):
-            if len(self.memory) > self.max_memory_length:
-                logger.debug(
-                    f"pop out first message, reason: memory length limit: `{self.memory[0]}`"
-                )
-                self.memory.pop(0)
-            elif self.memory[0]["role"] == "assistant":
-                logger.debug(
-                    f"pop out first message, reason: messages can not start with assistant: `{self.memory[0]}`"
-                )
-                self.memory.pop(0)
-            else:
-                break
+        if not is_final:
+            self.speculator.on_partial(input_text)
+            return
+
+        start_time = get_current_time()
+        final_ms = get_asr_final_ms(data)
+        if self.speculator is not None:
+            turn = self.speculator.on_final(input_text)
+            if turn is not None:
+                # the speculative answer is already on its way, let it out
+                self.prepare_memory(self.memory, input_text)
+                turn.commit(start_time + 100_000, final_ms)
+                return
+
+        self.prepare_memory(self.memory, input_text)
 
-        if len(self.memory) and self.memory[-1]["role"] == "user":
+        # Start thread to request and read responses from Bedrock
+        # allow 100ms buffer time, in case interruptor's flush cmd comes just after on_data event
+        turn = TurnOutput(input_text, start_time + 100_000, final_ms=final_ms)
+        thread = Thread(
+            target=self.converse_stream_worker,
+            args=(ten, start_time, input_text, self.memory.messages(), turn),
+        )
+        thread.start()
+        logger.info(f"BedrockLLMExtension on_data end")
+
+    def start_speculation(self, ten: TenEnv, turn: TurnOutput) -> None:
+        # speculate on a copy, memory is only updated once the turn is committed
+        memory = self.memory.copy()
+        self.prepare_memory(memory, turn.text)
+        thread = Thread(
+            target=self.converse_stream_worker,
+            args=(ten, get_current_time(), turn.text, memory.messages(), turn),
+        )
+        thread.start()
+
+    def prepare_memory(self, memory, input_text):
+        """
+        Append user input to memory. A conversation must alternate between user and assistant roles,
+        memory length, token budget and the leading role are taken care of by ConversationMemory.
+        """
+        if len(memory) and memory[-1]["role"] == "user":
             # if last user input got empty response, append current user input.
             logger.debug(
                 f"found last message with role `user`, will append this input into last user input"
             )
-            self.memory[-1]["content"].append({"text": input_text})
+            memory.merge_last({"text": input_text})
         else:
-            self.memory.append({"role": "user", "content": [{"text": input_text}]})
+            memory.append({"role": "user", "content": [{"text": input_text}]})
 
-        def converse_stream_worker(start_time, input_text, memory):
-            try:
+    def remember_response(self, full_content):
+        # remember response as assistant content in memory
+        if len(self.memory) and self.memory[-1]["role"] == "assistant":
+            self.memory.merge_last({"text": full_content})
+        else:
+            self.memory.append(
+                {"role": "assistant", "content": [{"text": full_content}]}
+            )
+
+    def send_data(self, ten, sentence, end_of_segment, input_text, turn_id=""):
+        try:
+            output_data = Data.create("text_data")
+            output_data.set_property_string(DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence)
+            output_data.set_property_bool(
+                DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, end_of_segment
+            )
+            if turn_id:
+                output_data.set_property_string(DATA_PROPERTY_TURN_ID, turn_id)
+            ten.send_data(output_data)
+            logger.info(
+                f"GetConverseStream for input text: [{input_text}] {'end of segment ' if end_of_segment else ''}sent sentence [{sentence}]"
+            )
+        except Exception as err:
+            logger.info(
+                f"GetConverseStream for input text: [{input_text}] {'end of segment ' if end_of_segment else ''}send sentence [{sentence}] failed, err: {err}"
+            )
+
+    def converse_stream_worker(self, ten: TenEnv, start_time, input_text, memory, turn):
+        timeline = self.timelines.begin(input_text)
+        timeline.stamp(
+            STAGE_ASR_FINAL,
+            turn.final_ms if turn.final_ms is not None else start_time / 1000,
+        )
+        try:
+            logger.info(
+                f"GetConverseStream for input text: [{input_text}] memory: {memory}"
+            )
+
+            # Get result from Bedrock
+            timeline.stamp(STAGE_LLM_REQUEST)
+            resp = self.bedrock_llm.get_converse_stream(memory)
+            if resp is None or resp.get("stream") is None:
                 logger.info(
-                    f"GetConverseStream for input text: [{input_text}] memory: {memory}"
+                    f"GetConverseStream for input text: [{input_text}] failed"
                 )
+                return
 
-                # Get result from Bedrock
-                resp = self.bedrock_llm.get_converse_stream(memory)
-                if resp is None or resp.get("stream") is None:
-                    logger.info(
-                        f"GetConverseStream for input text: [{input_text}] failed"
-                    )
-                    return
-
-                stream = resp.get("stream")
-                sentence = ""
-                full_content = ""
-                first_sentence_sent = False
+            stream = resp.get("stream")
+            segmenter = SentenceSegmenter(
+                self.sentence_punctuations, self.min_sentence_length
+            )
+            full_content = ""
+            first_sentence_sent = False
 
+            inflight = self.inflight_streams.register(stream, turn=turn)
+            try:
                 for event in stream:
-                    # allow 100ms buffer time, in case interruptor's flush cmd comes just after on_data event
-                    if (start_time + 100_000) < self.outdate_ts:
+                    # turn start carries the 100ms buffer, see on_data
+                    if turn.outdated(self.outdate_ts):
                         logger.info(
                             f"GetConverseStream recv interrupt and flushing for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}, delta > 100ms"
                         )
+                        timeline.stamp(STAGE_FLUSH)
                         break
 
                     if "contentBlockDelta" in event:
@@ -268,6 +416,9 @@ class BedrockLLMExtension(Extension):
                         # ignore other types of content: e.g toolUse
                         if "text" in delta_types:
                             content = event["contentBlockDelta"]["delta"]["text"]
+                            self.inflight_streams.on_chunk(inflight)
+                            turn.on_chunk()
+                            timeline.stamp(STAGE_FIRST_TOKEN)
                     elif (
                         "internalServerException" in event
                         or "modelStreamErrorException" in event
@@ -282,88 +433,53 @@ class BedrockLLMExtension(Extension):
 
                     full_content += content
 
-                    while True:
-                        sentence, content, sentence_is_final = parse_sentence(
-                            sentence, content
-                        )
-                        if not sentence or not sentence_is_final:
-                            logger.info(f"sentence [{sentence}] is empty or not final")
-                            break
+                    for sentence in segmenter.feed(content):
                         logger.info(
                             f"GetConverseStream recv for input text: [{input_text}] got sentence: [{sentence}]"
                         )
 
                         # send sentence
-                        try:
-                            output_data = Data.create("text_data")
-                            output_data.set_property_string(
-                                DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence
-                            )
-                            output_data.set_property_bool(
-                                DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, False
-                            )
-                            ten.send_data(output_data)
-                            logger.info(
-                                f"GetConverseStream recv for input text: [{input_text}] sent sentence [{sentence}]"
-                            )
-                        except Exception as err:
-                            logger.info(
-                                f"GetConverseStream recv for input text: [{input_text}] send sentence [{sentence}] failed, err: {err}"
-                            )
-                            break
+                        turn.emit(self.send_data, ten, sentence, False, input_text, timeline.turn_id)
 
-                        sentence = ""
                         if not first_sentence_sent:
                             first_sentence_sent = True
+                            timeline.stamp(STAGE_FIRST_SENTENCE)
                             logger.info(
-                                f"GetConverseStream recv for input text: [{input_text}] first sentence sent, first_sentence_latency {get_current_time() - start_time}ms"
+                                "GetConverseStream recv for input text: [{}] first sentence sent, first_sentence_latency {:.0f}ms".format(
+                                    input_text, timeline.since(STAGE_ASR_FINAL)
+                                )
                             )
-
-                if len(full_content.strip()):
-                    # remember response as assistant content in memory
-                    if memory and memory[-1]["role"] == "assistant":
-                        memory[-1]["content"].append({"text": full_content})
-                    else:
-                        memory.append(
-                            {"role": "assistant", "content": [{"text": full_content}]}
-                        )
-                else:
-                    # can not put empty model response into memory
-                    logger.error(
-                        f"GetConverseStream recv for input text: [{input_text}] failed: empty response [{full_content}]"
-                    )
-                    return
-
-                # send end of segment
-                try:
-                    output_data = Data.create("text_data")
-                    output_data.set_property_string(
-                        DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence
-                    )
-                    output_data.set_property_bool(
-                        DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, True
-                    )
-                    ten.send_data(output_data)
-                    logger.info(
-                        f"GetConverseStream for input text: [{input_text}] end of segment with sentence [{sentence}] sent"
-                    )
-                except Exception as err:
-                    logger.info(
-                        f"GetConverseStream for input text: [{input_text}] end of segment with sentence [{sentence}] send failed, err: {err}"
-                    )
-
             except Exception as e:
+                if not inflight.cancelled:
+                    raise
+                timeline.stamp(STAGE_FLUSH)
                 logger.info(
-                    f"GetConverseStream for input text: [{input_text}] failed, err: {e}"
+                    f"GetConverseStream stream closed by flush for input text: [{input_text}], err: {e}"
                 )
+            finally:
+                self.inflight_streams.unregister(inflight)
 
-        # Start thread to request and read responses from OpenAI
-        start_time = get_current_time()
-        thread = Thread(
-            target=converse_stream_worker, args=(start_time, input_text, self.memory)
-        )
-        thread.start()
-        logger.info(f"BedrockLLMExtension on_data end")
+            if len(full_content.strip()):
+                turn.emit(self.remember_response, full_content)
+            else:
+                # can not put empty model response into memory
+                logger.error(
+                    f"GetConverseStream recv for input text: [{input_text}] failed: empty response [{full_content}]"
+                )
+                return
+
+            # send end of segment
+            turn.emit(self.send_data, ten, segmenter.flush(), True, input_text, timeline.turn_id)
+
+        except Exception as e:
+            logger.info(
+                f"GetConverseStream for input text: [{input_text}] failed, err: {e}"
+            )
+        finally:
+            # a speculative turn that was never committed is not a turn of the user
+            if turn.final_ms is not None:
+                timeline.stamps[STAGE_ASR_FINAL] = turn.final_ms
+                timeline.finish()
 
 
 @register_addon_as_extension("bedrock_llm_python")
@@ -18,25 +18,57 @@ from ten import (
 import time
 from .pb import chat_text_pb2 as pb
 from .log import logger
+from .transcript_coalescer import TranscriptCoalescer
 
 CMD_NAME_FLUSH = "flush"
+CMD_NAME_ON_USER_LEFT = "on_user_left"
+
+CMD_ON_USER_LEFT_USER_ID_FIELD = "user_id"
 
 TEXT_DATA_TEXT_FIELD = "text"
 TEXT_DATA_FINAL_FIELD = "is_final"
 TEXT_DATA_STREAM_ID_FIELD = "stream_id"
 TEXT_DATA_END_OF_SEGMENT_FIELD = "end_of_segment"
 
-# record the cached text data for each stream id
-cached_text_map = {}
+PROPERTY_EMIT_INTERVAL_MS = "emit_interval_ms"  # Optional
+PROPERTY_MAX_STREAMS = "max_streams"  # Optional
 
 
 class ChatTranscriberExtension(Extension):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.ten = None
+        self.coalescer = None
+
     def on_start(self, ten: TenEnv) -> None:
         logger.info("on_start")
+        self.ten = ten
+
+        # a partial update per stream every emit_interval_ms at most, finals
+        # are sent right away, 0 sends every update
+        emit_interval_ms = 100
+        try:
+            emit_interval_ms = ten.get_property_int(PROPERTY_EMIT_INTERVAL_MS)
+        except Exception as e:
+            logger.info(f"on_start get_property_int {PROPERTY_EMIT_INTERVAL_MS} error: {e}")
+
+        max_streams = 64
+        try:
+            value = ten.get_property_int(PROPERTY_MAX_STREAMS)
+            if value > 0:
+                max_streams = value
+        except Exception as e:
+            logger.info(f"on_start get_property_int {PROPERTY_MAX_STREAMS} error: {e}")
+
+        self.coalescer = TranscriptCoalescer(self.send_text, emit_interval_ms, max_streams)
+        self.coalescer.start()
         ten.on_start_done()
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("on_stop")
+        if self.coalescer is not None:
+            self.coalescer.stop()
+            logger.info(f"transcript stats: {self.coalescer.stats()}")
         ten.on_stop_done()
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
@@ -44,6 +76,16 @@ class ChatTranscriberExtension(Extension):
         cmd_json = cmd.to_json()
         logger.info("on_cmd json: {}".format(cmd_json))
 
+        if cmd.get_name() == CMD_NAME_ON_USER_LEFT and self.coalescer is not None:
+            # the stream_id of a transcript is the uid of its user
+            try:
+                user_id = int(cmd.get_property_string(CMD_ON_USER_LEFT_USER_ID_FIELD))
+                self.coalescer.drop(user_id)
+            except Exception as e:
+                logger.warning(
+                    f"on_cmd get_property_string {CMD_ON_USER_LEFT_USER_ID_FIELD} error: {e}"
+                )
+
         cmd_result = CmdResult.create(StatusCode.OK)
         cmd_result.set_property_string("detail", "success")
         ten.return_result(cmd_result, cmd)
@@ -94,19 +136,9 @@ class ChatTranscriberExtension(Extension):
             f"on_data {TEXT_DATA_TEXT_FIELD}: {text} {TEXT_DATA_FINAL_FIELD}: {final} {TEXT_DATA_STREAM_ID_FIELD}: {stream_id} {TEXT_DATA_END_OF_SEGMENT_FIELD}: {end_of_segment}"
         )
 
-        # We cache all final text data and append the non-final text data to the cached data
-        # until the end of the segment.
-        if end_of_segment:
-            if stream_id in cached_text_map:
-                text = cached_text_map[stream_id] + text
-                del cached_text_map[stream_id]
-        else:
-            if final:
-                if stream_id in cached_text_map:
-                    text = cached_text_map[stream_id] + text
-
-                cached_text_map[stream_id] = text
+        self.coalescer.put(stream_id, text, final, end_of_segment)
 
+    def send_text(self, stream_id: int, text: str, end_of_segment: bool) -> None:
         pb_text = pb.Text(
             uid=stream_id,
             data_type="transcribe",
@@ -129,7 +161,7 @@ class ChatTranscriberExtension(Extension):
             # convert the origin text data to the protobuf data and send it to the graph.
             ten_data = Data.create("data")
             ten_data.set_property_buf("data", pb_serialized_text)
-            ten.send_data(ten_data)
+            self.ten.send_data(ten_data)
             logger.info("data sent")
         except Exception as e:
             logger.warning(f"on_data new_data error: {e}")
@@ -0,0 +1,161 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from .log import logger
+
+
+class StreamState:
+    def __init__(self):
+        # final texts of the current segment
+        self.cached = ""
+        # the latest partial not sent yet
+        self.pending = None
+        self.last_sent_ms = 0.0
+
+
+class TranscriptCoalescer:
+    """
+    Rate limits the transcript updates of every stream.
+
+    A stream sends at most one update per interval_ms. A partial that comes
+    sooner is held, and replaced by the next one, until the interval is up;
+    finals and ends of segment are sent right away and drop the held
+    partial. A final text, and the end of a segment, is sent joined to the
+    final texts before it in the segment.
+
+    At most max_streams streams are kept, the one updated longest ago is
+    dropped for a new one. emit(stream_id, text, end_of_segment) is called
+    in order per stream, from put or from the thread of the coalescer.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[int, str, bool], None],
+        interval_ms: int = 100,
+        max_streams: int = 64,
+    ):
+        self.emit = emit
+        self.interval_ms = interval_ms
+        self.max_streams = max_streams
+
+        self.cond = threading.Condition()
+        self.streams: "OrderedDict[int, StreamState]" = OrderedDict()
+        self.stopped = False
+        self.thread = None
+
+        self.received = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.evicted = 0
+
+    def start(self) -> None:
+        if self.interval_ms > 0 and self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="transcript_coalescer", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, stream_id: int, text: str, final: bool, end_of_segment: bool) -> None:
+        with self.cond:
+            self.received += 1
+            state = self._state(stream_id)
+
+            if end_of_segment:
+                text = state.cached + text
+                state.cached = ""
+            elif final:
+                text = state.cached + text
+                state.cached = text
+
+            now = _now_ms()
+            if final or end_of_segment or self.thread is None or now - state.last_sent_ms >= self.interval_ms:
+                if state.pending is not None:
+                    self.coalesced += 1
+                    state.pending = None
+                self._emit(stream_id, state, text, end_of_segment, now)
+                return
+
+            if state.pending is not None:
+                self.coalesced += 1
+            else:
+                self.cond.notify_all()
+            state.pending = text
+
+    def drop(self, stream_id: int) -> None:
+        """
+        Drop the state of a stream, e.g. once its user left.
+        """
+        with self.cond:
+            if self.streams.pop(stream_id, None) is None:
+                return
+            self.cond.notify_all()
+        logger.info(f"dropped the transcript state of stream {stream_id}")
+
+    def stats(self) -> Dict[str, int]:
+        with self.cond:
+            return {
+                "received": self.received,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "evicted": self.evicted,
+                "streams": len(self.streams),
+            }
+
+    def _state(self, stream_id: int) -> StreamState:
+        state = self.streams.get(stream_id)
+        if state is not None:
+            self.streams.move_to_end(stream_id)
+            return state
+        state = StreamState()
+        self.streams[stream_id] = state
+        while len(self.streams) > self.max_streams:
+            evicted_id, _ = self.streams.popitem(last=False)
+            self.evicted += 1
+            logger.info(f"dropped the transcript state of stream {evicted_id}, more than {self.max_streams} streams")
+        return state
+
+    def _emit(self, stream_id: int, state: StreamState, text: str, end_of_segment: bool, now: float) -> None:
+        state.last_sent_ms = now
+        self.sent += 1
+        try:
+            self.emit(stream_id, text, end_of_segment)
+        except Exception as e:
+            logger.warning(f"emit transcript of stream {stream_id} failed, err: {e}")
+
+    def _run(self) -> None:
+        with self.cond:
+            while not self.stopped:
+                now = _now_ms()
+                wait_ms = None
+                for stream_id, state in list(self.streams.items()):
+                    if state.pending is None:
+                        continue
+                    due_ms = state.last_sent_ms + self.interval_ms - now
+                    if due_ms > 0:
+                        wait_ms = due_ms if wait_ms is None else min(wait_ms, due_ms)
+                        continue
+                    text, state.pending = state.pending, None
+                    self._emit(stream_id, state, text, False, now)
+                # woken early by put, clear or stop, the pending partials are looked at again
+                self.cond.wait(None if wait_ms is None else wait_ms / 1000)
+
+
+def _now_ms() -> float:
+    return time.monotonic() * 1000
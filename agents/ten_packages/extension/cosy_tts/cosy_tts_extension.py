@@ -28,13 +28,70 @@ import threading
 # 导入python内置的datetime模块，用于处理时间
 from datetime import datetime
 
+# 导入time模块，用于计算备用连接的空闲时长
+import time
+
 # 导入自定义的日志记录器模块log，用于记录日志信息
 from.log import logger
 
+# 导入把PCM数据切成固定时长音频帧的分帧器
+from .pcm_framer import PcmFramer
+
+# 导入合成音频缓存，重复的短句不必再次合成
+from .audio_cache import AudioCache, load_phrases
+
+# 导入按播放速度发送音频帧的节拍器
+from .frame_pacer import FramePacer
+
+# 导入把服务端音频转换成图配置采样率的转换器
+from .pcm_converter import PcmConverter, native_rate
+
+# 导入合并LLM文本片段的合并器，减少合成请求次数
+from .text_coalescer import TextCoalescer
+
+# 导入每轮对话的延迟时间线记录器
+from .turn_timeline import (
+    STAGE_FIRST_AUDIO,
+    STAGE_FLUSH,
+    STAGE_LAST_FRAME,
+    STAGE_TTS_REQUEST,
+    LatencyHistogram,
+    TimelineRecorder,
+    TurnTimeline,
+    get_turn_id,
+    now_ms,
+)
+
+# 打断时放入队列的标记，让处理线程立即取消正在进行的合成会话
+FLUSH_MARKER = "flush"
+
+# 服务端支持的采样率和对应的音频格式
+COSY_FORMATS = {
+    8000: AudioFormat.PCM_8000HZ_MONO_16BIT,
+    16000: AudioFormat.PCM_16000HZ_MONO_16BIT,
+    22050: AudioFormat.PCM_22050HZ_MONO_16BIT,
+    24000: AudioFormat.PCM_24000HZ_MONO_16BIT,
+    44100: AudioFormat.PCM_44100HZ_MONO_16BIT,
+    48000: AudioFormat.PCM_48000HZ_MONO_16BIT,
+}
+
+# 备用连接空闲超过这个时长就重新建立，与SDK连接池的重连间隔一致，避免拿到被服务端断开的连接
+SPARE_MAX_IDLE_S = 30
+
 
 # 定义了一个CosyTTSCallback类，继承自ResultCallback类。这个类负责处理语音合成的回调事件，包括打开、完成、错误、关闭等。
 class CosyTTSCallback(ResultCallback):
-    def __init__(self, ten: TenEnv, sample_rate: int, need_interrupt_callback):
+    def __init__(
+        self,
+        ten: TenEnv,
+        sample_rate: int,
+        need_interrupt_callback,
+        frame_ms: int = 10,
+        sentence_ttfb: LatencyHistogram = None,
+        session_ttfb: LatencyHistogram = None,
+        pacer: FramePacer = None,
+        provider_sample_rate: int = 0,
+    ):
         """
         初始化CosyTTSCallback对象，设置相关属性。
 
@@ -42,9 +99,14 @@ class CosyTTSCallback(ResultCallback):
         ten (TenEnv)：与扩展关联的TenEnv对象。
         sample_rate (int)：音频采样率。
         need_interrupt_callback：回调函数，用于确定是否需要中断。
-
-        设置frame_size为根据采样率计算的一帧音频数据的大小，以字节为单位。
-        设置ts为当前任务的时间戳，init_ts为初始化时的时间戳。
+        frame_ms (int)：每个输出音频帧的时长，单位毫秒。
+        sentence_ttfb (LatencyHistogram)：统计每句话首包延迟的直方图，可为None。
+        session_ttfb (LatencyHistogram)：统计每个会话首包延迟的直方图，可为None。
+        pacer (FramePacer)：按播放速度发送音频帧的节拍器，为None时直接发送。
+        provider_sample_rate (int)：服务端返回音频的采样率，与sample_rate不同时转换成sample_rate，为0时与sample_rate相同。
+
+        设置frame_size为根据采样率和帧时长计算的一帧音频数据的大小，以字节为单位。
+        设置ts为当前任务的时间戳，init_ts为会话开始时的时间戳。
         设置ttfb为None。
         设置need_interrupt_callback属性。
         设置closed属性为False。
@@ -52,12 +114,44 @@ class CosyTTSCallback(ResultCallback):
         super().__init__()
         self.ten = ten
         self.sample_rate = sample_rate
-        self.frame_size = int(self.sample_rate * 1 * 2 / 100)
+        self.frame_size = int(self.sample_rate * 1 * 2 * frame_ms / 1000)
         self.ts = datetime.now()  # current task ts
         self.init_ts = datetime.now()
         self.ttfb = None  # time to first byte
         self.need_interrupt_callback = need_interrupt_callback
         self.closed = False
+        self.timeline = None
+        self.last_frame_ms = None
+        self.framer = PcmFramer(self.sample_rate, frame_ms)
+        self.converter = PcmConverter(provider_sample_rate or sample_rate, sample_rate)
+        self.sentence_ttfb = sentence_ttfb
+        self.session_ttfb = session_ttfb
+        self.pacer = pacer
+        self.sentences = 0
+        self.created_at = time.monotonic()
+        self.cache_key = None
+        self.audio = None
+
+    def begin_session(self):
+        """
+        合成器开始为一个LLM片段服务时调用。会话首包延迟从这里开始计时，
+        音频帧时间戳从当前时间开始。备用合成器提前创建，所以不能在初始化时计时。
+        """
+        self.init_ts = datetime.now()
+        self.ttfb = None
+        self.sentences = 0
+        self.last_frame_ms = None
+        self.cache_key = None
+        self.audio = None
+        self.converter.reset()
+        self.framer.reset(int(now_ms()))
+
+    def record(self, cache_key: str):
+        """
+        收集会话的音频数据，会话完成后以cache_key存入音频缓存。cache_key为None时停止收集。
+        """
+        self.cache_key = cache_key
+        self.audio = bytearray() if cache_key is not None else None
 
     def need_interrupt(self) -> bool:
         """
@@ -81,6 +175,31 @@ class CosyTTSCallback(ResultCallback):
         """
         self.ts = ts
 
+    def set_timeline(self, timeline: TurnTimeline):
+        """
+        设置下一句话的延迟时间线，首个音频帧、最后一帧和打断都记录在它上面。
+        同一会话里的句子共用一条音频流，上一句的时间线在这里结束，
+        它的最后一帧是下一句送出前收到的最后一帧音频。
+
+        参数：
+        timeline (TurnTimeline)：下一句话的时间线。
+        """
+        self.finish_timeline()
+        self.timeline = timeline
+        self.sentences += 1
+
+    def finish_timeline(self):
+        """
+        结束当前句子的时间线。
+        """
+        timeline = self.timeline
+        if timeline is None:
+            return
+        if self.last_frame_ms is not None and STAGE_FIRST_AUDIO in timeline.stamps:
+            timeline.stamp(STAGE_LAST_FRAME, self.last_frame_ms)
+        timeline.finish()
+        self.timeline = None
+
     def on_open(self):
         """
         在语音合成任务开始时被调用，记录一条日志信息。
@@ -101,12 +220,13 @@ class CosyTTSCallback(ResultCallback):
         pass
         # logger.info(f"recv speech synthsis message {message}")
 
-    def get_frame(self, data: bytes) -> AudioFrame:
+    def get_frame(self, data: memoryview, timestamp: int = 0) -> AudioFrame:
         """
         将字节数据转换为音频帧对象。
 
         参数：
-        data (bytes)：音频数据的字节表示。
+        data (memoryview)：一帧音频数据，由分帧器给出。
+        timestamp (int)：音频帧的时间戳，单位毫秒。
 
         返回：
         AudioFrame：包含音频数据的音频帧对象。
@@ -122,7 +242,7 @@ class CosyTTSCallback(ResultCallback):
         f.set_sample_rate(self.sample_rate)
         f.set_bytes_per_sample(2)
         f.set_number_of_channels(1)
-        # f.set_timestamp = 0
+        f.set_timestamp(timestamp)
         f.set_data_fmt(AudioFrameDataFmt.INTERLEAVE)
         f.set_samples_per_channel(len(data) // 2)
         f.alloc_buf(len(data))
@@ -141,25 +261,74 @@ class CosyTTSCallback(ResultCallback):
         这个方法首先会检查是否需要中断当前的语音合成任务。如果需要中断，它将立即返回，不会处理数据。
         如果不需要中断，它会检查`ttfb`（time to first byte）是否为`None`。`ttfb`用于标记从任务开始到接收到第一个音频字节的时间间隔。如果`ttfb`为`None`，意味着这是任务开始后接收到的第一个音频字节，它会记录当前时间与初始化时间之间的时间差，并将其记录为`ttfb`，然后通过日志输出。
         接着，`on_data`方法会将音频数据转换为音频帧对象，通过`get_frame`方法实现。这涉及到对音频数据的解析和填充到音频帧对象的缓冲区中，确保其正确的声道、采样率和格式。
-        最后，`on_data`方法会调用`ten`对象的`send_audio_frame`方法，将音频帧对象发送到目标接收端。这可能是一个音频播放器或者其他音频处理组件，具体行为取决于`ten`对象的实现。
+        最后，`on_data`方法会通过`send_frame`方法把音频帧交给节拍器，由它按播放速度调用`ten`对象的`send_audio_frame`方法，将音频帧对象发送到目标接收端。这可能是一个音频播放器或者其他音频处理组件，具体行为取决于`ten`对象的实现。
         在`CosyTTSCallback`类初始化后，它被用作语音合成任务的回调处理程序。一旦任务开始，它将根据从语音合成服务接收到的音频数据做出响应。例如，它可能在一个循环中不断检查服务端发送来的音频数据，一旦有新的数据到达，它将更新并传递音频帧给接收端。
 
         总结来说，`CosyTTSCallback`类充当了数据处理器和分发器的角色，确保音频数据被正确地格式化、记录（在`ttfb`的情况下）并发送给最终的音频消费组件。
         """
         if self.need_interrupt():
+            if self.timeline is not None:
+                self.timeline.stamp(STAGE_FLUSH)
             return
 
         if self.ttfb is None:
             self.ttfb = datetime.now() - self.init_ts
-            logger.info("TTS TTFB {}ms".format(int(self.ttfb.total_seconds() * 1000)))
+            ttfb_ms = self.ttfb.total_seconds() * 1000
+            logger.info("TTS session TTFB {}ms".format(int(ttfb_ms)))
+            if self.session_ttfb is not None:
+                self.session_ttfb.observe(ttfb_ms)
+
+        # 句子首包延迟：从句子送出到之后收到的第一个音频数据块，
+        # 上一句的音频还没收完时，这个数据块可能仍属于上一句
+        timeline = self.timeline
+        if timeline is not None:
+            if STAGE_FIRST_AUDIO not in timeline.stamps:
+                ttfb_ms = timeline.since(STAGE_TTS_REQUEST)
+                logger.info(
+                    "TTS sentence TTFB {:.0f}ms for text [{}]".format(ttfb_ms, timeline.text)
+                )
+                if self.sentence_ttfb is not None:
+                    self.sentence_ttfb.observe(ttfb_ms)
+            timeline.stamp(STAGE_FIRST_AUDIO)
+        self.last_frame_ms = now_ms()
+
+        if self.audio is not None:
+            self.audio += data
 
         # logger.info("audio result length: %d, %d", len(data), self.frame_size)
         try:
-            f = self.get_frame(data)
-            self.ten.send_audio_frame(f)
+            # 服务端推送的数据块长短不一，转换成输出采样率后切成固定时长的音频帧再发送
+            for frame, timestamp in self.framer.push(self.converter.push(data)):
+                self.send_frame(self.get_frame(frame, timestamp))
         except Exception as e:
             logger.exception(e)
 
+    def send_tail(self) -> None:
+        """
+        合成任务完成后，发送转换器和分帧器中剩余的音频数据，末尾补静音到整帧。
+        """
+        if self.need_interrupt():
+            return
+        try:
+            for frame, timestamp in self.framer.push(self.converter.flush()):
+                self.send_frame(self.get_frame(frame, timestamp))
+            for frame, timestamp in self.framer.flush():
+                self.send_frame(self.get_frame(frame, timestamp))
+                self.last_frame_ms = now_ms()
+            if self.pacer is not None:
+                self.pacer.end()
+        except Exception as e:
+            logger.exception(e)
+
+    def send_frame(self, frame: AudioFrame) -> None:
+        """
+        发送一个音频帧，有节拍器时交给节拍器按播放速度发送。
+        """
+        if self.pacer is not None:
+            self.pacer.put(frame)
+        else:
+            self.ten.send_audio_frame(frame)
+
 
 # 定义了一个名为CosyTTSExtension的类，继承自Extension类。这个类实现了一个语音合成扩展，用于处理文本到语音的转换任务。
 
@@ -182,6 +351,7 @@ class CosyTTSExtension(Extension):
         self.voice = ""
         self.model = ""
         self.sample_rate = 16000
+        self.provider_sample_rate = 16000
         self.tts = None
         self.callback = None
         self.format = None
@@ -191,6 +361,31 @@ class CosyTTSExtension(Extension):
         self.stopped = False
         self.thread = None
         self.queue = queue.Queue()
+        self.timelines = None
+        self.turn_id = None
+        self.frame_ms = 10
+
+        # 预先建立连接的备用合成器，打断取消当前会话后由它接替
+        self.spare = None
+        self.spare_lock = threading.Lock()
+        self.spare_thread = None
+        self.sentence_ttfb = LatencyHistogram()
+        self.session_ttfb = LatencyHistogram()
+        self.sessions = 0
+        self.spare_hits = 0
+
+        # 合成音频缓存，以及重放缓存音频用的回调对象
+        self.audio_cache = None
+        self.cache_callback = None
+
+        # 按播放速度发送音频帧，最多领先实际播放pacing_lead_ms
+        self.pacing_lead_ms = 150
+        self.pacer = None
+
+        # 合并相邻的文本片段再合成，每轮的第一个片段立即合成
+        self.coalesce_min_chars = 20
+        self.coalesce_max_delay_ms = 200
+        self.coalescer = None
 
     def on_start(self, ten: TenEnv) -> None:
         """
@@ -201,7 +396,7 @@ class CosyTTSExtension(Extension):
 
         记录一条日志信息。
         从ten对象中获取api_key、voice、model和sample_rate属性，并打印日志。
-        根据sample_rate属性设置format格式。
+        根据provider_sample_rate属性设置向服务端请求的format格式，sample_rate是输出音频的采样率。
         创建一个线程，启动异步处理任务。
         调用ten的on_start_done方法，表示启动完成。
         """
@@ -211,25 +406,105 @@ class CosyTTSExtension(Extension):
         self.model = ten.get_property_string("model")
         self.sample_rate = ten.get_property_int("sample_rate")
 
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string("timeline_path")
+        except Exception as e:
+            logger.info(f"GetProperty optional timeline_path failed, err: {e}")
+        self.timelines = TimelineRecorder("cosy_tts", timeline_path)
+
+        try:
+            frame_ms = ten.get_property_int("frame_ms")
+            if frame_ms > 0:
+                self.frame_ms = frame_ms
+        except Exception as e:
+            logger.info(f"GetProperty optional frame_ms failed, err: {e}")
+
         dashscope.api_key = self.api_key
-        f = AudioFormat.PCM_16000HZ_MONO_16BIT
-        if self.sample_rate == 8000:
-            f = AudioFormat.PCM_8000HZ_MONO_16BIT
-        elif self.sample_rate == 16000:
-            f = AudioFormat.PCM_16000HZ_MONO_16BIT
-        elif self.sample_rate == 22050:
-            f = AudioFormat.PCM_22050HZ_MONO_16BIT
-        elif self.sample_rate == 24000:
-            f = AudioFormat.PCM_24000HZ_MONO_16BIT
-        elif self.sample_rate == 44100:
-            f = AudioFormat.PCM_44100HZ_MONO_16BIT
-        elif self.sample_rate == 48000:
-            f = AudioFormat.PCM_48000HZ_MONO_16BIT
-        else:
-            logger.error("unknown sample rate %d", self.sample_rate)
-            exit()
 
-        self.format = f
+        # 向服务端请求的采样率，没有配置时取服务端支持的、最接近输出采样率的一个，
+        # 与输出采样率不同时在本地转换
+        provider_sample_rate = 0
+        try:
+            provider_sample_rate = ten.get_property_int("provider_sample_rate")
+        except Exception as e:
+            logger.info(f"GetProperty optional provider_sample_rate failed, err: {e}")
+        if provider_sample_rate not in COSY_FORMATS:
+            if provider_sample_rate > 0:
+                logger.error("unsupported provider sample rate %d", provider_sample_rate)
+            provider_sample_rate = native_rate(COSY_FORMATS.keys(), self.sample_rate)
+        self.provider_sample_rate = provider_sample_rate
+        if self.provider_sample_rate != self.sample_rate:
+            logger.info(
+                "resampling tts audio from %d to %d", self.provider_sample_rate, self.sample_rate
+            )
+
+        self.format = COSY_FORMATS[self.provider_sample_rate]
+
+        try:
+            self.pacing_lead_ms = ten.get_property_int("pacing_lead_ms")
+        except Exception as e:
+            logger.info(f"GetProperty optional pacing_lead_ms failed, err: {e}")
+        self.pacer = FramePacer(
+            ten.send_audio_frame, self.frame_ms, self.pacing_lead_ms, "cosy_pacer"
+        )
+        self.pacer.start()
+
+        try:
+            self.coalesce_min_chars = ten.get_property_int("coalesce_min_chars")
+        except Exception as e:
+            logger.info(f"GetProperty optional coalesce_min_chars failed, err: {e}")
+        try:
+            self.coalesce_max_delay_ms = ten.get_property_int("coalesce_max_delay_ms")
+        except Exception as e:
+            logger.info(f"GetProperty optional coalesce_max_delay_ms failed, err: {e}")
+        self.coalescer = TextCoalescer(
+            self.put_text,
+            self.coalesce_min_chars,
+            self.coalesce_max_delay_ms,
+            "cosy_coalescer",
+        )
+        self.coalescer.start()
+
+        audio_cache_memory_mb = 16
+        try:
+            audio_cache_memory_mb = ten.get_property_int("audio_cache_memory_mb")
+        except Exception as e:
+            logger.info(f"GetProperty optional audio_cache_memory_mb failed, err: {e}")
+
+        audio_cache_path = ""
+        try:
+            audio_cache_path = ten.get_property_string("audio_cache_path")
+        except Exception as e:
+            logger.info(f"GetProperty optional audio_cache_path failed, err: {e}")
+
+        audio_cache_phrases = []
+        try:
+            audio_cache_phrases = load_phrases(ten.get_property_string("audio_cache_phrases"))
+        except Exception as e:
+            logger.info(f"GetProperty optional audio_cache_phrases failed, err: {e}")
+
+        if audio_cache_memory_mb > 0 or len(audio_cache_path) > 0:
+            self.audio_cache = AudioCache(
+                max(audio_cache_memory_mb, 0) * 1024 * 1024, audio_cache_path
+            )
+            self.cache_callback = CosyTTSCallback(
+                ten,
+                self.sample_rate,
+                self.need_interrupt,
+                self.frame_ms,
+                pacer=self.pacer,
+                provider_sample_rate=self.provider_sample_rate,
+            )
+            if len(audio_cache_phrases) > 0:
+                # 在后台预先合成配置的短句，不阻塞启动
+                threading.Thread(
+                    target=self.audio_cache.prerender,
+                    args=[audio_cache_phrases, self.cache_key, self.render],
+                    daemon=True,
+                ).start()
+
+        self.prepare_spare(ten)
 
         self.thread = threading.Thread(target=self.async_handle, args=[ten])
         self.thread.start()
@@ -251,11 +526,30 @@ class CosyTTSExtension(Extension):
         """
         logger.info("on_stop")
         self.stopped = True
+        if self.coalescer is not None:
+            logger.info("coalescer stats: {}".format(self.coalescer.stats()))
+            self.coalescer.stop()
         self.flush()
         self.queue.put(None)
         if self.thread is not None:
             self.thread.join()
             self.thread = None
+        if self.spare_thread is not None:
+            self.spare_thread.join()
+            self.spare_thread = None
+        with self.spare_lock:
+            spare, self.spare = self.spare, None
+        if spare is not None:
+            self.close_synthesizer(spare[0])
+        if self.timelines is not None:
+            self.timelines.report()
+        self.report_ttfb()
+        if self.audio_cache is not None:
+            logger.info("audio cache stats: {}".format(self.audio_cache.stats()))
+            self.audio_cache.close()
+        if self.pacer is not None:
+            logger.info("pacer stats: {}".format(self.pacer.stats()))
+            self.pacer.stop()
         ten.on_stop_done()
 
     def need_interrupt(self, ts: datetime.time) -> bool:
@@ -274,6 +568,162 @@ class CosyTTSExtension(Extension):
         """
         return self.outdate_ts > ts
 
+    def new_synthesizer(self, ten: TenEnv):
+        """
+        创建一个合成器和它的回调对象。
+        """
+        callback = CosyTTSCallback(
+            ten,
+            self.sample_rate,
+            self.need_interrupt,
+            self.frame_ms,
+            self.sentence_ttfb,
+            self.session_ttfb,
+            self.pacer,
+            self.provider_sample_rate,
+        )
+        tts = SpeechSynthesizer(
+            model=self.model,
+            voice=self.voice,
+            format=self.format,
+            callback=callback,
+        )
+        return tts, callback
+
+    def prepare_spare(self, ten: TenEnv):
+        """
+        在后台线程中创建备用合成器并预先建立websocket连接，下一个会话就不用等握手。
+
+        SDK的连接方法是私有的（SDK自带的连接池也是这样调用的），旧版本没有它时，
+        备用合成器只省去对象创建，连接仍在第一次streaming_call时建立。
+        """
+        if self.stopped:
+            return
+        if self.spare_thread is not None and self.spare_thread.is_alive():
+            return
+        with self.spare_lock:
+            if (
+                self.spare is not None
+                and not self.spare[1].closed
+                and time.monotonic() - self.spare[1].created_at < SPARE_MAX_IDLE_S
+            ):
+                return
+
+        def warm_up():
+            try:
+                tts, callback = self.new_synthesizer(ten)
+                connect = getattr(tts, "_SpeechSynthesizer__connect", None)
+                if connect is not None:
+                    start = time.monotonic()
+                    connect()
+                    logger.info(
+                        "spare tts connected in {:.0f}ms".format(
+                            (time.monotonic() - start) * 1000
+                        )
+                    )
+                with self.spare_lock:
+                    old, self.spare = self.spare, (tts, callback)
+                if old is not None:
+                    self.close_synthesizer(old[0])
+            except Exception as e:
+                logger.warning(f"prepare spare tts failed, err: {e}")
+
+        self.spare_thread = threading.Thread(target=warm_up, daemon=True)
+        self.spare_thread.start()
+
+    def take_synthesizer(self, ten: TenEnv):
+        """
+        取出备用合成器开始新会话，没有可用的备用合成器时现场创建，并在后台准备下一个。
+        """
+        with self.spare_lock:
+            spare, self.spare = self.spare, None
+        if spare is not None:
+            tts, callback = spare
+            if (
+                callback.closed
+                or time.monotonic() - callback.created_at > SPARE_MAX_IDLE_S
+            ):
+                logger.info("spare tts is stale, dropped")
+                self.close_synthesizer(tts)
+                spare = None
+
+        self.sessions += 1
+        if spare is not None:
+            self.spare_hits += 1
+            logger.info("using spare tts")
+            tts, callback = spare
+        else:
+            logger.info("creating tts")
+            tts, callback = self.new_synthesizer(ten)
+        self.prepare_spare(ten)
+        callback.begin_session()
+        return tts, callback
+
+    def cache_key(self, text: str) -> str:
+        """
+        文本在音频缓存中的键，由引擎、音色、模型、采样率和规范化后的文本决定。
+        缓存的是服务端返回的音频，采样率是provider_sample_rate。
+        """
+        return AudioCache.make_key(
+            "cosy", self.voice, self.model, self.provider_sample_rate, text
+        )
+
+    def render(self, text: str) -> bytes:
+        """
+        非流式合成一段文本，返回完整的音频数据，用于预先合成短句。
+        """
+        tts = SpeechSynthesizer(model=self.model, voice=self.voice, format=self.format)
+        return tts.call(text)
+
+    def send_cached(self, text: str, ts: datetime, turn_id: str = None) -> bool:
+        """
+        音频缓存命中时立即发送缓存的音频，没有合成延迟。
+
+        返回：
+        bool：缓存命中并已发送则返回True，否则返回False。
+        """
+        if self.audio_cache is None or not self.audio_cache.cacheable(text):
+            return False
+        data = self.audio_cache.get(self.cache_key(text))
+        if data is None:
+            return False
+
+        logger.info("audio cache hit for text [{}]".format(text))
+        callback = self.cache_callback
+        callback.set_input_ts(ts)
+        callback.begin_session()
+        timeline = self.timelines.begin(text, turn_id)
+        callback.set_timeline(timeline)
+        timeline.stamp(STAGE_TTS_REQUEST)
+        callback.on_data(data)
+        callback.send_tail()
+        callback.finish_timeline()
+        return True
+
+    def close_synthesizer(self, tts):
+        """
+        关闭没有使用过的合成器的连接。
+        """
+        try:
+            close = getattr(tts, "close", None)
+            if close is not None and getattr(tts, "ws", None) is not None:
+                close()
+        except Exception as e:
+            logger.warning(f"close tts failed, err: {e}")
+
+    def report_ttfb(self):
+        """
+        输出句子首包延迟和会话首包延迟的统计。
+        """
+        for name, h in [("sentence", self.sentence_ttfb), ("session", self.session_ttfb)]:
+            stats = h.to_dict()
+            logger.info(
+                "TTS {} TTFB: count {} avg {:.0f}ms p50 {:.0f}ms p90 {:.0f}ms max {:.0f}ms".format(
+                    name, stats["count"], stats["avg"], stats["p50"], stats["p90"], stats["max"]
+                )
+            )
+        logger.info("TTS sessions {} spare hits {}".format(self.sessions, self.spare_hits))
+
     def async_handle(self, ten: TenEnv):
         """
         异步处理音频数据的入口点。
@@ -284,7 +734,10 @@ class CosyTTSExtension(Extension):
         返回：
             None
 
-        使用一个无限循环，直到`stopped`标志设置为True才会结束。它检查队列中是否有新数据。如果有，它将创建一个新的`SpeechSynthesizer`对象，并调用`streaming_call`方法。最后，如果当前音频片段结束，调用`streaming_complete`方法来处理音频数据。
+        使用一个无限循环，直到`stopped`标志设置为True才会结束。它检查队列中是否有新数据。
+        一个LLM片段的所有句子共用一个`SpeechSynthesizer`会话，每句话调用一次`streaming_call`方法，
+        只有片段结束时才调用`streaming_complete`方法处理剩余音频数据，句子之间不用重新握手。
+        打断时取消当前会话，下一个会话使用预先建立好连接的备用合成器。
         """
         try:
             # 初始化语音合成器和回调对象
@@ -297,10 +750,10 @@ class CosyTTSExtension(Extension):
                     if value is None:
                         # 如果队列为空，则退出循环
                         break
-                    input_text, ts, end_of_segment = value
 
-                    # 如果旧的语音合成器已关闭，则清理它并创建一个新的
+                    # 如果旧的语音合成器已关闭，则清理它，下一句使用新的会话
                     if callback is not None and callback.closed is True:
+                        callback.finish_timeline()
                         tts = None
                         callback = None
 
@@ -310,26 +763,37 @@ class CosyTTSExtension(Extension):
                         and tts is not None
                         and callback.need_interrupt()
                     ):
-                        tts.streaming_cancel()
+                        logger.info("cancel tts session")
+                        if callback.sentences > 0:
+                            tts.streaming_cancel()
+                        else:
+                            self.close_synthesizer(tts)
+                        callback.finish_timeline()
                         tts = None
                         callback = None
+                        # 丢掉取消前已经放进节拍器的音频帧
+                        self.pacer.clear()
+                        self.prepare_spare(ten)
+
+                    if value == FLUSH_MARKER:
+                        continue
+
+                    input_text, ts, end_of_segment, turn_id = value
 
                     if self.need_interrupt(ts):
                         logger.info("drop outdated input")
                         continue
 
-                    # 如果需要，创建新的语音合成器
+                    # 没有正在合成的句子时，缓存命中的文本直接发送缓存的音频
+                    # 会话中已有句子时不能插队，否则音频顺序会乱
+                    if (callback is None or callback.sentences == 0) and self.send_cached(
+                        input_text, ts, turn_id
+                    ):
+                        continue
+
+                    # 如果需要，开始新的合成会话
                     if tts is None or callback is None:
-                        logger.info("creating tts")
-                        callback = CosyTTSCallback(
-                            ten, self.sample_rate, self.need_interrupt
-                        )
-                        tts = SpeechSynthesizer(
-                            model=self.model,
-                            voice=self.voice,
-                            format=self.format,
-                            callback=callback,
-                        )
+                        tts, callback = self.take_synthesizer(ten)
 
                     logger.info(
                         "on message [{}] ts [{}] end_of_segment [{}]".format(
@@ -341,32 +805,65 @@ class CosyTTSExtension(Extension):
                     callback.set_input_ts(ts)
 
                     if len(input_text) > 0:
-                        # 如果有文本数据，则调用streaming_call方法进行语音合成
+                        # 如果有文本数据，则在当前会话中调用streaming_call方法进行语音合成
+                        timeline = self.timelines.begin(input_text, turn_id)
+                        callback.set_timeline(timeline)
+                        timeline.stamp(STAGE_TTS_REQUEST)
+                        # 同一条音频流里分不出各句的音频，只缓存只有一句话的会话
+                        if (
+                            callback.sentences == 1
+                            and self.audio_cache is not None
+                            and self.audio_cache.cacheable(input_text)
+                        ):
+                            callback.record(self.cache_key(input_text))
+                        else:
+                            callback.record(None)
                         tts.streaming_call(input_text)
 
-                    # 完成语音合成任务，处理剩余音频数据
-                    if True:  # end_of_segment:
+                    # 片段结束时完成语音合成会话，处理剩余音频数据
+                    # 会话里还没有送出过文本时保留合成器，留给下一个片段
+                    if end_of_segment and callback.sentences > 0:
                         try:
                             tts.streaming_complete()
                         except Exception as e:
                             logger.warning(e)
+                        callback.send_tail()
+                        callback.finish_timeline()
+                        if callback.audio is not None and not callback.need_interrupt():
+                            self.audio_cache.put(callback.cache_key, callback.audio)
+                        logger.info(
+                            "tts session done, sentences {}".format(callback.sentences)
+                        )
                         tts = None
                         callback = None
                 except Exception as e:
                     logger.exception(e)
                     logger.exception(traceback.format_exc())
+                    # 出错的会话不再复用，下一句使用新的会话
+                    if callback is not None:
+                        callback.finish_timeline()
+                    if tts is not None:
+                        self.close_synthesizer(tts)
+                    tts = None
+                    callback = None
         finally:
             if tts is not None:
-                tts.streaming_cancel()
+                if callback.sentences > 0:
+                    tts.streaming_cancel()
+                else:
+                    self.close_synthesizer(tts)
+                callback.finish_timeline()
                 tts = None
                 callback = None
 
     def flush(self):
         """
-        清空队列。
+        清空合并器和队列。
 
-        在while循环中使用self.queue.get()方法，针对队列中的每个值调用queue.get()，进行清空操作。
+        丢掉合并器中还没送出的文本片段，再在while循环中使用self.queue.get()方法，针对队列中的每个值调用queue.get()，进行清空操作。
         """
+        if self.coalescer is not None:
+            self.coalescer.clear()
         while not self.queue.empty():
             self.queue.get()
 
@@ -382,13 +879,21 @@ class CosyTTSExtension(Extension):
         通过ten对象获取text属性的字符串值，并赋值给inputText。
         通过ten对象获取end_of_segment属性，并将其赋值给end_of_segment。
         记录一条日志信息，表明接收到新的数据，包含inputText和end_of_segment的值。
-        将(inputText, datetime.now(), end_of_segment)作为三元组放入队列。
+        交给合并器，合并后的文本由put_text放入队列。
         """
         inputText = data.get_property_string("text")
         end_of_segment = data.get_property_bool("end_of_segment")
 
         logger.info("on data {} {}".format(inputText, end_of_segment))
-        self.queue.put((inputText, datetime.now(), end_of_segment))
+        # 合并器只合并同一轮的文本，记下这一轮在LLM时间线中的编号
+        self.turn_id = get_turn_id(data)
+        self.coalescer.put(inputText, end_of_segment)
+
+    def put_text(self, text: str, end_of_segment: bool) -> None:
+        """
+        合并器送出合并后的文本时调用，将(text, datetime.now(), end_of_segment, turn_id)作为四元组放入队列。
+        """
+        self.queue.put((text, datetime.now(), end_of_segment, self.turn_id))
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
         """
@@ -414,6 +919,10 @@ class CosyTTSExtension(Extension):
         if cmd_name == "flush":
             self.outdate_ts = datetime.now()
             self.flush()
+            # 丢掉还没发送出去的音频帧，打断立即生效
+            self.pacer.clear()
+            # 让处理线程立即取消当前会话并准备备用合成器，不必等下一句文本
+            self.queue.put(FLUSH_MARKER)
             cmd_out = Cmd.create("flush")
             ten.send_cmd(cmd_out, lambda ten, result: print("send_cmd flush done"))
         else:
@@ -0,0 +1,175 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Fixed size PCM framing shared by the TTS extensions. Every TTS extension
+# ships an identical copy of this file, keep them in sync. It has no package
+# imports, run it directly for a throughput benchmark.
+import time
+from typing import Iterator, Tuple, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class PcmFramer:
+    """
+    Cuts a PCM byte stream of any chunking into frames of exactly frame_ms.
+
+    Whole frames are handed out as memoryview slices of the incoming buffer,
+    without a copy. Only a frame split across two chunks is assembled, in a
+    preallocated frame sized buffer. A frame view is valid until the
+    generator that yielded it is resumed, the consumer copies it into the
+    outgoing audio frame before that.
+
+    Every frame carries a timestamp in ms, counted from the base given to
+    reset at frame_ms per frame.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        frame_ms: int = 10,
+        bytes_per_sample: int = 2,
+        channels: int = 1,
+    ):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.samples_per_frame = sample_rate * frame_ms // 1000
+        self.frame_size = self.samples_per_frame * channels * bytes_per_sample
+        self.carry = bytearray(self.frame_size)
+        self.view = memoryview(self.carry)
+        self.pending = 0
+        self.timestamp_ms = 0
+
+        self.frames = 0
+        self.carried = 0
+        self.padded_bytes = 0
+
+    def reset(self, timestamp_ms: int = 0) -> None:
+        """
+        Drop a partial frame and start the timestamps of the next stream.
+        """
+        self.pending = 0
+        self.timestamp_ms = timestamp_ms
+
+    def push(self, data: Buffer) -> Iterator[Tuple[memoryview, int]]:
+        """
+        Yield (frame, timestamp_ms) for every frame completed by data.
+        """
+        src = memoryview(data)
+        if src.format != "B":
+            src = src.cast("B")
+        frame_size = self.frame_size
+        total = len(src)
+        offset = 0
+
+        if self.pending:
+            n = min(frame_size - self.pending, total)
+            self.view[self.pending : self.pending + n] = src[:n]
+            self.pending += n
+            offset = n
+            if self.pending < frame_size:
+                return
+            self.pending = 0
+            self.carried += 1
+            yield self.view, self._next_timestamp()
+
+        frame_ms = self.frame_ms
+        while total - offset >= frame_size:
+            timestamp_ms = self.timestamp_ms
+            self.timestamp_ms = timestamp_ms + frame_ms
+            self.frames += 1
+            yield src[offset : offset + frame_size], timestamp_ms
+            offset += frame_size
+
+        rest = total - offset
+        if rest:
+            self.view[:rest] = src[offset:]
+            self.pending = rest
+
+    def flush(self, pad: bool = True) -> Iterator[Tuple[memoryview, int]]:
+        """
+        Yield the partial frame, padded with silence to a full frame unless pad
+        is False.
+        """
+        tail = self.pending
+        if tail == 0:
+            return
+        self.pending = 0
+        if pad:
+            self.view[tail:] = bytes(self.frame_size - tail)
+            self.padded_bytes += self.frame_size - tail
+            yield self.view, self._next_timestamp()
+        else:
+            yield self.view[:tail], self._next_timestamp()
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "carried": self.carried,
+            "padded_bytes": self.padded_bytes,
+            "frame_size": self.frame_size,
+        }
+
+    def _next_timestamp(self) -> int:
+        timestamp_ms = self.timestamp_ms
+        self.timestamp_ms += self.frame_ms
+        self.frames += 1
+        return timestamp_ms
+
+
+def _concat_frames(stream, frame_size: int):
+    # the former framing, bytes concatenation and re-slicing, for comparison
+    chunk = b""
+    for data in stream:
+        chunk += data
+        while len(chunk) >= frame_size:
+            yield chunk[:frame_size]
+            chunk = chunk[frame_size:]
+
+
+def benchmark(seconds: float = 1.0, chunk_size: int = 4096, sample_rate: int = 16000, frame_ms: int = 10) -> dict:
+    """
+    Frames per second a single core frames and copies out, for PcmFramer and
+    the former bytes concatenation.
+    """
+    framer = PcmFramer(sample_rate, frame_ms)
+    sink = bytearray(framer.frame_size)
+    chunk = bytes(chunk_size)
+
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(100):
+            for frame, _ in framer.push(chunk):
+                sink[:] = frame
+                frames += 1
+    framer_fps = frames / (time.perf_counter() - start)
+
+    # one long stream, the concatenation cost grows with the buffered tail
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for frame in _concat_frames((chunk for _ in range(100)), framer.frame_size):
+            sink[:] = frame
+            frames += 1
+    concat_fps = frames / (time.perf_counter() - start)
+
+    return {
+        "chunk_size": chunk_size,
+        "frame_size": framer.frame_size,
+        "framer_fps": framer_fps,
+        "concat_fps": concat_fps,
+    }
+
+
+if __name__ == "__main__":
+    for size in [320, 4096, 65536]:
+        result = benchmark(chunk_size=size)
+        print(
+            "chunk {chunk_size:>6}B frame {frame_size}B: framer {framer_fps:>12,.0f} fps/core, concat {concat_fps:>12,.0f} fps/core".format(
+                **result
+            )
+        )
@@ -0,0 +1,179 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Merging of LLM text fragments before synthesis. Every TTS extension ships an
+# identical copy of this file, keep them in sync.
+import threading
+import time
+from typing import Callable, Dict
+
+from .log import logger
+
+SENTENCE_TERMINATORS = ".!?。！？…\n"
+
+# closing quotes and brackets after a terminator still end the sentence
+_CLOSERS = "\"')]}”’）」』】》"
+
+
+class TextCoalescer:
+    """
+    Merges adjacent text fragments of a turn into fewer, longer texts, so the
+    TTS is not called once per comma.
+
+    The first fragment of a turn is emitted right away, it is what the first
+    audio waits for. Later fragments are held and merged until the merged
+    text has min_chars characters, ends a sentence, or the segment ends, or
+    until max_delay_ms after the first held fragment; the audio of the
+    fragments before it is still playing by then. A turn starts with the
+    first fragment after an end of segment or a clear.
+
+    emit(text, end_of_segment) is called with the merged texts in order,
+    from put or from the thread of the coalescer for the deadline. An end
+    of segment with nothing held is emitted as an empty text. With
+    min_chars of 0 or less every fragment is emitted as it comes.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[str, bool], None],
+        min_chars: int = 20,
+        max_delay_ms: int = 200,
+        name: str = "coalescer",
+    ):
+        self.emit = emit
+        self.min_chars = min_chars
+        self.max_delay_ms = max_delay_ms
+        self.name = name
+
+        self.cond = threading.Condition()
+        self.held = ""
+        self.held_fragments = 0
+        self.deadline = None  # monotonic s at which the held text is emitted
+        self.eager = True
+        self.stopped = False
+        self.thread = None
+
+        self.fragments = 0
+        self.texts = 0
+        self.reasons = {"eager": 0, "length": 0, "sentence": 0, "deadline": 0, "end": 0}
+
+    def start(self) -> None:
+        if self.min_chars > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, text: str, end_of_segment: bool = False) -> None:
+        with self.cond:
+            if self.thread is None:
+                self._emit(text, 1 if text else 0, end_of_segment, "eager")
+                return
+
+            if self.eager and len(text) > 0 and len(self.held) == 0:
+                self.eager = end_of_segment
+                self._emit(text, 1, end_of_segment, "end" if end_of_segment else "eager")
+                return
+
+            if len(text) > 0:
+                self.held = _join(self.held, text)
+                self.held_fragments += 1
+
+            if end_of_segment:
+                self._emit_held(True, "end")
+                self.eager = True
+            elif len(self.held) >= self.min_chars:
+                self._emit_held(False, "length")
+            elif _ends_sentence(self.held):
+                self._emit_held(False, "sentence")
+            elif len(self.held) > 0 and self.deadline is None:
+                self.deadline = time.monotonic() + self.max_delay_ms / 1000
+                self.cond.notify_all()
+
+    def clear(self) -> int:
+        """
+        Drop the held text and start a new turn, returns how many fragments
+        were dropped.
+        """
+        with self.cond:
+            dropped = self.held_fragments
+            self.held = ""
+            self.held_fragments = 0
+            self.deadline = None
+            self.eager = True
+            self.cond.notify_all()
+        if dropped:
+            logger.info(f"{self.name} dropped {dropped} held fragments")
+        return dropped
+
+    def stats(self) -> Dict[str, float]:
+        with self.cond:
+            return {
+                "fragments": self.fragments,
+                "texts": self.texts,
+                "merge_ratio": self.fragments / self.texts if self.texts else 0.0,
+                **self.reasons,
+            }
+
+    def _emit_held(self, end_of_segment: bool, reason: str) -> None:
+        text, fragments = self.held, self.held_fragments
+        self.held = ""
+        self.held_fragments = 0
+        self.deadline = None
+        self._emit(text, fragments, end_of_segment, reason)
+
+    def _emit(self, text: str, fragments: int, end_of_segment: bool, reason: str) -> None:
+        if len(text) > 0:
+            self.fragments += fragments
+            self.texts += 1
+            self.reasons[reason] += 1
+            if fragments > 1:
+                logger.debug(f"{self.name} merged {fragments} fragments ({reason}): [{text}]")
+        elif not end_of_segment:
+            return
+        try:
+            self.emit(text, end_of_segment)
+        except Exception as e:
+            logger.warning(f"{self.name} emit failed, err: {e}")
+
+    def _run(self) -> None:
+        with self.cond:
+            while not self.stopped:
+                if self.deadline is None:
+                    self.cond.wait()
+                    continue
+                wait_s = self.deadline - time.monotonic()
+                if wait_s > 0:
+                    # woken early by put, clear or stop, the deadline is looked at again
+                    self.cond.wait(wait_s)
+                    continue
+                self._emit_held(False, "deadline")
+
+
+def _ends_sentence(text: str) -> bool:
+    text = text.rstrip(" \t" + _CLOSERS)
+    return len(text) > 0 and text[-1] in SENTENCE_TERMINATORS
+
+
+def _join(held: str, text: str) -> str:
+    # fragments cut at punctuation may have lost the space between them,
+    # scripts written without spaces are joined as they are
+    if (
+        held
+        and not held[-1].isspace()
+        and not text[0].isspace()
+        and held[-1].isascii()
+        and text[0].isascii()
+        and text[0].isalnum()
+    ):
+        return held + " " + text
+    return held + text
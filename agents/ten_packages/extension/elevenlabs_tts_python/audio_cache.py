@@ -0,0 +1,247 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Cache of synthesized PCM shared by the TTS extensions. Every TTS extension
+# ships an identical copy of this file, keep them in sync.
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from .log import logger
+
+Buffer = Union[bytes, memoryview]
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    The text as far as the synthesized audio is concerned: NFKC folded and
+    with whitespace collapsed. Case and punctuation change the prosody, they
+    are kept.
+    """
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def load_phrases(config: str) -> List[str]:
+    """
+    Phrases to prerender, from a JSON list of strings.
+    """
+    if not config:
+        return []
+    return [text for text in json.loads(config) if isinstance(text, str) and text.strip()]
+
+
+class AudioCache:
+    """
+    PCM of synthesized texts, keyed by engine, voice, model, sample rate and
+    normalized text.
+
+    Entries live in an in-memory LRU bounded by capacity_bytes. With a path,
+    every entry is also written to a file of its own in that directory, which
+    serves memory misses memory-mapped, so processes sharing the directory
+    share both the files and the page cache. Files are written under a
+    temporary name and renamed into place, a reader never sees a partial one.
+    The directory is trimmed to disk_capacity_bytes, oldest files first, when
+    the cache opens.
+
+    Only texts of at most max_text_len characters are cached, the fillers,
+    notices and short replies that repeat across sessions.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int = 16 * 1024 * 1024,
+        path: str = "",
+        disk_capacity_bytes: int = 256 * 1024 * 1024,
+        max_text_len: int = 200,
+    ):
+        self.capacity_bytes = capacity_bytes
+        self.path = path
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self.max_text_len = max_text_len
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Buffer]" = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        if path:
+            try:
+                os.makedirs(path, exist_ok=True)
+                self._trim_disk()
+            except Exception as e:
+                logger.warning(f"open audio cache {path} failed, err: {e}")
+                self.path = ""
+
+    @staticmethod
+    def make_key(
+        engine: str,
+        voice: str,
+        model: str,
+        sample_rate: int,
+        text: str,
+        options: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        options are the synthesis settings besides voice and model that
+        change the audio, e.g. speed or stability.
+        """
+        digest = hashlib.sha256()
+        digest.update(
+            json.dumps(
+                [engine, voice, model, int(sample_rate), normalize_text(text), options],
+                ensure_ascii=False,
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        return digest.hexdigest()
+
+    def cacheable(self, text: str) -> bool:
+        text = normalize_text(text)
+        return 0 < len(text) <= self.max_text_len
+
+    def get(self, key: str) -> Optional[Buffer]:
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._load(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._insert(key, data)
+        return data
+
+    def put(self, key: str, data: Buffer) -> None:
+        if len(data) == 0:
+            return
+        data = bytes(data)
+        with self.lock:
+            self.stores += 1
+            self._insert(key, data)
+        self._store(key, data)
+
+    def prerender(
+        self, phrases: List[str], make_key: Callable[[str], str], render: Callable[[str], bytes]
+    ) -> int:
+        """
+        Synthesize the phrases that are not cached yet. make_key maps a phrase
+        to its key and render returns the whole PCM of a phrase. Returns how
+        many phrases were rendered.
+        """
+        rendered = 0
+        for text in phrases:
+            key = make_key(text)
+            if self.get(key) is not None:
+                continue
+            try:
+                self.put(key, render(text))
+                rendered += 1
+            except Exception as e:
+                logger.warning(f"prerender [{text}] failed, err: {e}")
+        logger.info(f"audio cache prerendered {rendered} of {len(phrases)} phrases")
+        return rendered
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _insert(self, key: str, data: Buffer) -> None:
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        if len(data) > self.capacity_bytes:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.capacity_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + ".pcm")
+
+    def _load(self, key: str) -> Optional[memoryview]:
+        if not self.path:
+            return None
+        try:
+            with open(self._file(key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                # the mapping outlives the file object, it is released with
+                # the last view of it
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"read audio cache {key} failed, err: {e}")
+            return None
+
+    def _store(self, key: str, data: bytes) -> None:
+        if not self.path:
+            return
+        path = self._file(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"write audio cache {key} failed, err: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _trim_disk(self) -> None:
+        files = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".pcm"):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_capacity_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
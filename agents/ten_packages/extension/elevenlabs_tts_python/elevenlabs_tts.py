@@ -6,9 +6,22 @@
 #
 #
 
-from typing import Iterator
+import base64
+import json
+import threading
+from typing import Callable, Iterator
+from urllib.parse import urlencode
+
 from elevenlabs import Voice, VoiceSettings
 from elevenlabs.client import ElevenLabs
+from websockets.sync.client import connect
+
+from .log import logger
+
+STREAM_INPUT_URL = "wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input"
+
+# sample rates of the pcm output formats
+PCM_SAMPLE_RATES = [16000, 22050, 24000, 44100]
 
 
 class ElevenlabsTTSConfig:
@@ -23,6 +36,9 @@ class ElevenlabsTTSConfig:
         stability=0.5,
         style=0.0,
         voice_id="pNInz6obpgDQGcFmaJgB",
+        stream_input=False,
+        stream_input_url=STREAM_INPUT_URL,
+        sample_rate=16000,
     ) -> None:
         self.api_key = api_key
         self.model_id = model_id
@@ -33,6 +49,13 @@ class ElevenlabsTTSConfig:
         self.stability = stability
         self.style = style
         self.voice_id = voice_id
+        self.stream_input = stream_input
+        self.stream_input_url = stream_input_url
+        self.sample_rate = sample_rate
+
+    @property
+    def output_format(self) -> str:
+        return f"pcm_{self.sample_rate}"
 
 
 def default_elevenlabs_tts_config() -> ElevenlabsTTSConfig:
@@ -49,7 +72,7 @@ class ElevenlabsTTS:
             text=text,
             model=self.config.model_id,
             optimize_streaming_latency=self.config.optimize_streaming_latency,
-            output_format="pcm_16000",
+            output_format=self.config.output_format,
             stream=True,
             voice=Voice(
                 voice_id=self.config.voice_id,
@@ -63,3 +86,108 @@ class ElevenlabsTTS:
         )
 
         return audio_stream
+
+    def input_stream(self, on_audio: Callable[[bytes], None]) -> "ElevenlabsInputStream":
+        """
+        Open a streaming input session, on_audio is called with the PCM as it
+        is synthesized.
+        """
+        query = {
+            "model_id": self.config.model_id,
+            "output_format": self.config.output_format,
+        }
+        if self.config.optimize_streaming_latency > 0:
+            query["optimize_streaming_latency"] = self.config.optimize_streaming_latency
+        url = self.config.stream_input_url.format(voice_id=self.config.voice_id)
+        return ElevenlabsInputStream(
+            f"{url}?{urlencode(query)}",
+            self.config.api_key,
+            {
+                "stability": self.config.stability,
+                "similarity_boost": self.config.similarity_boost,
+                "style": self.config.style,
+                "use_speaker_boost": self.config.speaker_boost,
+            },
+            on_audio,
+            self.config.request_timeout_seconds,
+        )
+
+
+class ElevenlabsInputStream:
+    """
+    One session of the websocket input streaming API. The text of a whole LLM
+    segment is sent fragment by fragment over a single connection, and the
+    audio is read continuously by a reader thread, so only the first fragment
+    pays connection setup and model warm-up.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        api_key: str,
+        voice_settings: dict,
+        on_audio: Callable[[bytes], None],
+        timeout: int = 30,
+    ) -> None:
+        self.on_audio = on_audio
+        self.ws = connect(
+            url, additional_headers={"xi-api-key": api_key}, open_timeout=timeout
+        )
+        # the first message opens the stream and carries the voice settings
+        self.ws.send(json.dumps({"text": " ", "voice_settings": voice_settings}))
+        self.fragments = 0
+        self.received_bytes = 0
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, text: str) -> None:
+        # the API expects each fragment to end with a space
+        if not text.endswith(" "):
+            text += " "
+        self.ws.send(json.dumps({"text": text, "try_trigger_generation": True}))
+        self.fragments += 1
+
+    def finish(self, timeout: float = None) -> None:
+        """
+        Signal the end of the text and wait until the remaining audio is read.
+        """
+        try:
+            self.ws.send(json.dumps({"text": ""}))
+        except Exception as e:
+            logger.warning(f"finish input stream failed, err: {e}")
+        self.reader.join(timeout)
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self.ws.close()
+        except Exception as e:
+            logger.warning(f"close input stream failed, err: {e}")
+
+    def done(self) -> bool:
+        return not self.reader.is_alive()
+
+    def _read(self) -> None:
+        try:
+            for message in self.ws:
+                data = json.loads(message)
+                audio = data.get("audio")
+                if audio:
+                    pcm = base64.b64decode(audio)
+                    self.received_bytes += len(pcm)
+                    self.on_audio(pcm)
+                if data.get("isFinal"):
+                    break
+                if data.get("error"):
+                    logger.warning(f"input stream error: {data}")
+                    break
+        except Exception as e:
+            if not self.closed:
+                logger.warning(f"read input stream failed, err: {e}")
+        finally:
+            self.closed = True
+            try:
+                self.ws.close()
+            except Exception:
+                pass
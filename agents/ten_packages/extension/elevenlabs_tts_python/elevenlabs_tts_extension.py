@@ -18,14 +18,29 @@ from ten import (
     StatusCode,
     Data,
 )
-from .elevenlabs_tts import default_elevenlabs_tts_config, ElevenlabsTTS
+from .audio_cache import AudioCache, load_phrases
+from .frame_pacer import FramePacer
+from .elevenlabs_tts import default_elevenlabs_tts_config, ElevenlabsTTS, PCM_SAMPLE_RATES
 from .pcm import PcmConfig, Pcm
 from .log import logger
+from .pcm_converter import native_rate
+from .text_coalescer import TextCoalescer
+from .turn_timeline import (
+    STAGE_FIRST_AUDIO,
+    STAGE_FLUSH,
+    STAGE_LAST_FRAME,
+    STAGE_TTS_REQUEST,
+    LatencyHistogram,
+    TimelineRecorder,
+    get_turn_id,
+    now_ms,
+)
 
 CMD_IN_FLUSH = "flush"
 CMD_OUT_FLUSH = "flush"
 
 DATA_IN_TEXT_DATA_PROPERTY_TEXT = "text"
+DATA_IN_TEXT_DATA_PROPERTY_END_OF_SEGMENT = "end_of_segment"
 
 PROPERTY_API_KEY = "api_key"  # Required
 PROPERTY_MODEL_ID = "model_id"  # Optional
@@ -35,12 +50,42 @@ PROPERTY_SIMILARITY_BOOST = "similarity_boost"  # Optional
 PROPERTY_SPEAKER_BOOST = "speaker_boost"  # Optional
 PROPERTY_STABILITY = "stability"  # Optional
 PROPERTY_STYLE = "style"  # Optional
+PROPERTY_TIMELINE_PATH = "timeline_path"  # Optional
+PROPERTY_FRAME_MS = "frame_ms"  # Optional
+PROPERTY_AUDIO_CACHE_MEMORY_MB = "audio_cache_memory_mb"  # Optional
+PROPERTY_AUDIO_CACHE_PATH = "audio_cache_path"  # Optional
+PROPERTY_AUDIO_CACHE_PHRASES = "audio_cache_phrases"  # Optional
+PROPERTY_PACING_LEAD_MS = "pacing_lead_ms"  # Optional
+PROPERTY_STREAM_INPUT = "stream_input"  # Optional
+PROPERTY_STREAM_INPUT_URL = "stream_input_url"  # Optional
+PROPERTY_SAMPLE_RATE = "sample_rate"  # Optional
+PROPERTY_PROVIDER_SAMPLE_RATE = "provider_sample_rate"  # Optional
+PROPERTY_COALESCE_MIN_CHARS = "coalesce_min_chars"  # Optional
+PROPERTY_COALESCE_MAX_DELAY_MS = "coalesce_max_delay_ms"  # Optional
 
 
 class Message:
-    def __init__(self, text: str, received_ts: int) -> None:
+    def __init__(self, text: str, received_ts: int, end_of_segment: bool = False, turn_id: str = None) -> None:
         self.text = text
         self.received_ts = received_ts
+        self.end_of_segment = end_of_segment
+        # the timeline id of the LLM turn the text belongs to
+        self.turn_id = turn_id
+
+
+class InputStreamAudio:
+    """
+    The framing state of one streaming input session. The websocket reader
+    thread pushes its audio while the text thread finishes the session, the
+    lock keeps them apart, and no audio is framed once it finished.
+    """
+
+    def __init__(self, framer, converter) -> None:
+        self.framer = framer
+        self.converter = converter
+        self.lock = threading.Lock()
+        self.finished = False
+        self.last_frame_ms = None
 
 
 class ElevenlabsTTSExtension(Extension):
@@ -49,9 +94,22 @@ class ElevenlabsTTSExtension(Extension):
 
         self.elevenlabs_tts = None
         self.outdate_ts = 0
+        self.turn_id = None
         self.pcm = None
-        self.pcm_frame_size = 0
+        self.pcm_framer = None
         self.text_queue = queue.Queue(maxsize=1024)
+        self.timelines = None
+        self.audio_cache = None
+        self.pacer = None
+        self.coalescer = None
+
+        # streaming input session of the current LLM segment
+        self.input_stream = None
+        self.input_stream_ts = 0
+        self.input_stream_timeline = None
+        self.input_stream_audio = None
+        self.fragment_sent_ms = None
+        self.fragment_ttfb = LatencyHistogram()
 
         # prepare configuration
         elevenlabs_tts_config = default_elevenlabs_tts_config()
@@ -103,14 +161,117 @@ class ElevenlabsTTSExtension(Extension):
         except Exception as e:
             logger.warning(f"on_start get_property_float {PROPERTY_STYLE} error: {e}")
 
+        try:
+            elevenlabs_tts_config.stream_input = ten.get_property_bool(PROPERTY_STREAM_INPUT)
+        except Exception as e:
+            logger.warning(f"on_start get_property_bool {PROPERTY_STREAM_INPUT} error: {e}")
+
+        try:
+            stream_input_url = ten.get_property_string(PROPERTY_STREAM_INPUT_URL)
+            if len(stream_input_url) > 0:
+                elevenlabs_tts_config.stream_input_url = stream_input_url
+        except Exception as e:
+            logger.warning(f"on_start get_property_string {PROPERTY_STREAM_INPUT_URL} error: {e}")
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH)
+        except Exception as e:
+            logger.warning(f"on_start get_property_string {PROPERTY_TIMELINE_PATH} error: {e}")
+        self.timelines = TimelineRecorder("elevenlabs_tts_python", timeline_path)
+
+        # sample_rate is the rate of the outgoing frames, ElevenLabs is asked for the nearest pcm format it has
+        # unless provider_sample_rate names one, and the audio is converted if the two differ
+        pcm_config = PcmConfig()
+        try:
+            sample_rate = ten.get_property_int(PROPERTY_SAMPLE_RATE)
+            if sample_rate > 0:
+                pcm_config.sample_rate = sample_rate
+                pcm_config.samples_per_channel = sample_rate * pcm_config.frame_ms // 1000
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_SAMPLE_RATE} error: {e}")
+
+        provider_sample_rate = 0
+        try:
+            provider_sample_rate = ten.get_property_int(PROPERTY_PROVIDER_SAMPLE_RATE)
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_PROVIDER_SAMPLE_RATE} error: {e}")
+        if provider_sample_rate not in PCM_SAMPLE_RATES:
+            if provider_sample_rate > 0:
+                logger.error(f"unsupported {PROPERTY_PROVIDER_SAMPLE_RATE} {provider_sample_rate}")
+            provider_sample_rate = native_rate(PCM_SAMPLE_RATES, pcm_config.sample_rate)
+        elevenlabs_tts_config.sample_rate = provider_sample_rate
+        if provider_sample_rate != pcm_config.sample_rate:
+            logger.info(f"resampling elevenlabs audio from {provider_sample_rate} to {pcm_config.sample_rate}")
+
         # create elevenlabsTTS instance
         self.elevenlabs_tts = ElevenlabsTTS(elevenlabs_tts_config)
 
         logger.info(f"ElevenlabsTTS succeed with model_id: {self.elevenlabs_tts.config.model_id}, VoiceId: {self.elevenlabs_tts.config.voice_id}")
 
         # create pcm instance
-        self.pcm = Pcm(PcmConfig())
-        self.pcm_frame_size = self.pcm.get_pcm_frame_size()
+        try:
+            frame_ms = ten.get_property_int(PROPERTY_FRAME_MS)
+            if frame_ms > 0:
+                pcm_config.frame_ms = frame_ms
+                pcm_config.samples_per_channel = pcm_config.sample_rate * frame_ms // 1000
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_FRAME_MS} error: {e}")
+        self.pcm = Pcm(pcm_config)
+        self.pcm_framer = self.pcm.new_framer()
+        self.pcm_converter = self.pcm.new_converter(provider_sample_rate)
+        self.provider_sample_rate = provider_sample_rate
+
+        # create pacer instance, frames go out at playout rate
+        pacing_lead_ms = 150
+        try:
+            pacing_lead_ms = ten.get_property_int(PROPERTY_PACING_LEAD_MS)
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_PACING_LEAD_MS} error: {e}")
+        self.pacer = FramePacer(ten.send_audio_frame, pcm_config.frame_ms, pacing_lead_ms, "elevenlabs_pacer")
+        self.pacer.start()
+
+        # create coalescer instance, fragments after the first of a turn are merged before synthesis
+        coalesce_min_chars = 20
+        try:
+            coalesce_min_chars = ten.get_property_int(PROPERTY_COALESCE_MIN_CHARS)
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_COALESCE_MIN_CHARS} error: {e}")
+        coalesce_max_delay_ms = 200
+        try:
+            coalesce_max_delay_ms = ten.get_property_int(PROPERTY_COALESCE_MAX_DELAY_MS)
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_COALESCE_MAX_DELAY_MS} error: {e}")
+        self.coalescer = TextCoalescer(self.put_text, coalesce_min_chars, coalesce_max_delay_ms, "elevenlabs_coalescer")
+        self.coalescer.start()
+
+        # create audio cache instance
+        audio_cache_memory_mb = 16
+        try:
+            audio_cache_memory_mb = ten.get_property_int(PROPERTY_AUDIO_CACHE_MEMORY_MB)
+        except Exception as e:
+            logger.warning(f"on_start get_property_int {PROPERTY_AUDIO_CACHE_MEMORY_MB} error: {e}")
+
+        audio_cache_path = ""
+        try:
+            audio_cache_path = ten.get_property_string(PROPERTY_AUDIO_CACHE_PATH)
+        except Exception as e:
+            logger.warning(f"on_start get_property_string {PROPERTY_AUDIO_CACHE_PATH} error: {e}")
+
+        audio_cache_phrases = []
+        try:
+            audio_cache_phrases = load_phrases(ten.get_property_string(PROPERTY_AUDIO_CACHE_PHRASES))
+        except Exception as e:
+            logger.warning(f"on_start get_property_string {PROPERTY_AUDIO_CACHE_PHRASES} error: {e}")
+
+        if audio_cache_memory_mb > 0 or len(audio_cache_path) > 0:
+            self.audio_cache = AudioCache(max(audio_cache_memory_mb, 0) * 1024 * 1024, audio_cache_path)
+            if len(audio_cache_phrases) > 0:
+                threading.Thread(
+                    target=self.audio_cache.prerender,
+                    args=(audio_cache_phrases, self.cache_key, self.render),
+                    daemon=True,
+                ).start()
 
         threading.Thread(target=self.process_text_queue, args=(ten,)).start()
 
@@ -118,6 +279,22 @@ class ElevenlabsTTSExtension(Extension):
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("on_stop")
+        if self.coalescer is not None:
+            logger.info(f"coalescer stats: {self.coalescer.stats()}")
+            self.coalescer.stop()
+        if self.input_stream is not None:
+            self.input_stream.close()
+        if self.timelines is not None:
+            self.timelines.report()
+        if self.fragment_ttfb.count > 0:
+            h = self.fragment_ttfb.to_dict()
+            logger.info(f"stream input fragment TTFB: count {h['count']} avg {h['avg']:.0f}ms p50 {h['p50']:.0f}ms p90 {h['p90']:.0f}ms max {h['max']:.0f}ms")
+        if self.audio_cache is not None:
+            logger.info(f"audio cache stats: {self.audio_cache.stats()}")
+            self.audio_cache.close()
+        if self.pacer is not None:
+            logger.info(f"pacer stats: {self.pacer.stats()}")
+            self.pacer.stop()
         ten.on_stop_done()
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
@@ -133,8 +310,16 @@ class ElevenlabsTTSExtension(Extension):
 
         logger.info(f"on_cmd [{cmd_name}]")
 
-        if cmd_name is CMD_IN_FLUSH:
+        if cmd_name == CMD_IN_FLUSH:
             self.outdate_ts = int(time.time() * 1000000)
+            self.coalescer.clear()
+            self.pacer.clear()
+            # stop the audio of the streaming input session right away
+            input_stream = self.input_stream
+            if input_stream is not None:
+                input_stream.close()
+                # finishes the closed session now rather than at the next text
+                self.text_queue.put(Message("", int(time.time() * 1000000)))
 
             # send out
             out_cmd = Cmd.create(CMD_OUT_FLUSH)
@@ -160,13 +345,50 @@ class ElevenlabsTTSExtension(Extension):
             logger.warning(f"on_data get_property_string {DATA_IN_TEXT_DATA_PROPERTY_TEXT} error: {e}")
             return
 
-        if len(text) == 0:
+        end_of_segment = False
+        try:
+            end_of_segment = data.get_property_bool(DATA_IN_TEXT_DATA_PROPERTY_END_OF_SEGMENT)
+        except Exception as e:
+            logger.debug(f"on_data get_property_bool {DATA_IN_TEXT_DATA_PROPERTY_END_OF_SEGMENT} error: {e}")
+
+        logger.info(f"OnData input text: [{text}], end_of_segment: {end_of_segment}")
+
+        # texts the coalescer merges are of one turn
+        self.turn_id = get_turn_id(data)
+        self.coalescer.put(text, end_of_segment)
+
+    def put_text(self, text: str, end_of_segment: bool) -> None:
+        # an empty text still ends the segment of a streaming input session
+        if len(text) == 0 and not (end_of_segment and self.elevenlabs_tts.config.stream_input):
             logger.debug("on_data text is empty, ignored")
             return
 
-        logger.info(f"OnData input text: [{text}]")
-
-        self.text_queue.put(Message(text, int(time.time() * 1000000)))
+        self.text_queue.put(Message(text, int(time.time() * 1000000), end_of_segment, self.turn_id))
+
+    def cache_key(self, text: str) -> str:
+        config = self.elevenlabs_tts.config
+        return AudioCache.make_key(
+            "elevenlabs",
+            config.voice_id,
+            config.model_id,
+            config.sample_rate,
+            text,
+            {
+                "similarity_boost": config.similarity_boost,
+                "speaker_boost": config.speaker_boost,
+                "stability": config.stability,
+                "style": config.style,
+            },
+        )
+
+    def render(self, text: str) -> bytes:
+        return b"".join(self.elevenlabs_tts.text_to_speech_stream(text))
+
+    def send_frame(self, buf: memoryview, timestamp: int) -> None:
+        try:
+            self.pacer.put(self.pcm.get_pcm_frame(buf, timestamp))
+        except Exception as e:
+            logger.error(f"send frame failed, {e}")
 
     def process_text_queue(self, ten: TenEnv):
         logger.info("process_text_queue")
@@ -179,50 +401,186 @@ class ElevenlabsTTSExtension(Extension):
                 logger.info(f"textChan interrupt and flushing for input text: [{msg.text}], received_ts: {msg.received_ts}, outdate_ts: {self.outdate_ts}")
                 continue
 
-            start_time = time.time()
-            buf = self.pcm.new_buf()
-            first_frame_latency = 0
-            n = 0
-            pcm_frame_read = 0
-            read_bytes = 0
-            sent_frames = 0
-
+            try:
+                # a segment of a single text goes through a plain request, which the audio cache serves
+                if self.elevenlabs_tts.config.stream_input and not (self.input_stream is None and msg.end_of_segment):
+                    self.process_stream_input(msg)
+                elif len(msg.text) > 0:
+                    self.process_text(msg)
+            except Exception as e:
+                logger.exception(f"process text [{msg.text}] failed, err: {e}")
+                if self.input_stream is not None:
+                    self.input_stream.close()
+                    self.finish_input_stream()
+
+    def process_text(self, msg: Message) -> None:
+        """
+        Synthesize one text with its own request.
+        """
+        timeline = self.timelines.begin(msg.text, msg.turn_id)
+        timeline.stamp(STAGE_TTS_REQUEST)
+        last_frame_ms = None
+        first_frame_latency = 0
+        read_bytes = 0
+        sent_frames = 0
+        interrupted = False
+        self.pcm_converter.reset()
+        self.pcm_framer.reset(int(now_ms()))
+
+        cache_key = None
+        audio = None
+        if self.audio_cache is not None and self.audio_cache.cacheable(msg.text):
+            cache_key = self.cache_key(msg.text)
+            cached = self.audio_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"audio cache hit for input text: [{msg.text}]")
+                audio_stream = [cached]
+            else:
+                audio = bytearray()
+                audio_stream = self.elevenlabs_tts.text_to_speech_stream(msg.text)
+        else:
             audio_stream = self.elevenlabs_tts.text_to_speech_stream(msg.text)
 
-            for chunk in self.pcm.read_pcm_stream(audio_stream, self.pcm_frame_size):
-                if msg.received_ts < self.outdate_ts:
-                    logger.info(f"textChan interrupt and flushing for input text: [{msg.text}], received_ts: {msg.received_ts}, outdate_ts: {self.outdate_ts}")
-                    break
-
-                if not chunk:
-                    logger.info("read pcm stream EOF")
-                    break
-
-                n = len(chunk)
-                read_bytes += n
-                pcm_frame_read += n
-
-                if pcm_frame_read != self.pcm.get_pcm_frame_size():
-                    logger.debug(f"the number of bytes read is [{pcm_frame_read}] inconsistent with pcm frame size")
-                    continue
-
-                self.pcm.send(ten, buf)
-                buf = self.pcm.new_buf()
-                pcm_frame_read = 0
+        for data in audio_stream:
+            if msg.received_ts < self.outdate_ts:
+                logger.info(f"textChan interrupt and flushing for input text: [{msg.text}], received_ts: {msg.received_ts}, outdate_ts: {self.outdate_ts}")
+                timeline.stamp(STAGE_FLUSH)
+                # frames queued after the flush cleared the pacer
+                self.pacer.clear()
+                interrupted = True
+                break
+
+            read_bytes += len(data)
+            if audio is not None:
+                audio += data
+
+            for frame, timestamp in self.pcm_framer.push(self.pcm_converter.push(data)):
+                self.send_frame(frame, timestamp)
                 sent_frames += 1
+                last_frame_ms = now_ms()
 
                 if first_frame_latency == 0:
-                    first_frame_latency = int((time.time() - start_time) * 1000)
+                    timeline.stamp(STAGE_FIRST_AUDIO, last_frame_ms)
+                    first_frame_latency = int(timeline.since(STAGE_TTS_REQUEST))
                     logger.info(f"first frame available for text: [{msg.text}], received_ts: {msg.received_ts}, first_frame_latency: {first_frame_latency}ms")
 
-                logger.debug(f"sending pcm data, text: [{msg.text}]")
+            logger.debug(f"sending pcm data, text: [{msg.text}]")
 
-            if pcm_frame_read > 0:
-                self.pcm.send(ten, buf)
+        if not interrupted:
+            # the tail is padded with silence to a full frame
+            for frame, timestamp in self.pcm_framer.push(self.pcm_converter.flush()):
+                self.send_frame(frame, timestamp)
+                sent_frames += 1
+                last_frame_ms = now_ms()
+            for frame, timestamp in self.pcm_framer.flush():
+                self.send_frame(frame, timestamp)
                 sent_frames += 1
-                logger.info(f"sending pcm remain data, text: [{msg.text}], pcm_frame_read: {pcm_frame_read}")
+                last_frame_ms = now_ms()
+                logger.info(f"sending pcm remain data, text: [{msg.text}]")
+            self.pacer.end()
+            if audio is not None:
+                self.audio_cache.put(cache_key, audio)
+
+        if last_frame_ms is not None:
+            timeline.stamp(STAGE_LAST_FRAME, last_frame_ms)
+        finish_latency = int(timeline.since(STAGE_TTS_REQUEST))
+        timeline.finish()
+        logger.info(
+            f"send pcm data finished, text: [{msg.text}], received_ts: {msg.received_ts}, read_bytes: {read_bytes}, sent_frames: {sent_frames}, "
+            f"first_frame_latency: {first_frame_latency}ms, finish_latency: {finish_latency}ms"
+        )
+
+    def process_stream_input(self, msg: Message) -> None:
+        """
+        Push one text of the current LLM segment into its streaming input session,
+        opening the session with the first text and finishing it at the end of the segment.
+        """
+        if self.input_stream is not None and (self.input_stream.done() or self.input_stream_ts < self.outdate_ts):
+            # closed by a flush or by the server, e.g. after its inactivity timeout
+            logger.info("input stream closed, starting a new one")
+            self.finish_input_stream()
+
+        if len(msg.text) > 0:
+            if self.input_stream is None:
+                self.open_input_stream(msg)
+            if self.fragment_sent_ms is None:
+                self.fragment_sent_ms = now_ms()
+            self.input_stream.send(msg.text)
+            logger.debug(f"input stream sent text: [{msg.text}]")
+
+        if msg.end_of_segment and self.input_stream is not None:
+            self.input_stream.finish(self.elevenlabs_tts.config.request_timeout_seconds)
+            self.finish_input_stream()
+
+    def open_input_stream(self, msg: Message) -> None:
+        timeline = self.timelines.begin(msg.text, msg.turn_id)
+        timeline.stamp(STAGE_TTS_REQUEST)
+        self.input_stream_ts = msg.received_ts
+        self.input_stream_timeline = timeline
+        # a session frames its audio on its own, its reader may outlive it
+        audio = InputStreamAudio(self.pcm.new_framer(), self.pcm.new_converter(self.provider_sample_rate))
+        audio.framer.reset(int(now_ms()))
+        self.input_stream_audio = audio
+        session_ts = msg.received_ts
+        stream = None
+
+        def on_audio(data: bytes) -> None:
+            if session_ts < self.outdate_ts:
+                timeline.stamp(STAGE_FLUSH)
+                if stream is not None:
+                    stream.close()
+                return
+
+            if self.fragment_sent_ms is not None:
+                # the first audio after a text was pushed
+                fragment_ttfb = now_ms() - self.fragment_sent_ms
+                self.fragment_sent_ms = None
+                self.fragment_ttfb.observe(fragment_ttfb)
+                logger.info(f"input stream fragment TTFB: {fragment_ttfb:.0f}ms")
+
+            with audio.lock:
+                if audio.finished:
+                    return
+                for frame, timestamp in audio.framer.push(audio.converter.push(data)):
+                    self.send_frame(frame, timestamp)
+                    audio.last_frame_ms = now_ms()
+                    if STAGE_FIRST_AUDIO not in timeline.stamps:
+                        timeline.stamp(STAGE_FIRST_AUDIO, audio.last_frame_ms)
+                        logger.info(f"input stream first frame available, first_frame_latency: {int(timeline.since(STAGE_TTS_REQUEST))}ms")
+
+        stream = self.elevenlabs_tts.input_stream(on_audio)
+        self.input_stream = stream
+        logger.info(f"input stream opened in {int(timeline.since(STAGE_TTS_REQUEST))}ms for text: [{msg.text}]")
+
+    def finish_input_stream(self) -> None:
+        stream = self.input_stream
+        timeline = self.input_stream_timeline
+        audio = self.input_stream_audio
+        self.input_stream = None
+        self.input_stream_timeline = None
+        self.input_stream_audio = None
+        self.fragment_sent_ms = None
+        if stream is None:
+            return
 
-            finish_latency = int((time.time() - start_time) * 1000)
-            logger.info(f"send pcm data finished, text: [{msg.text}], received_ts: {msg.received_ts}, read_bytes: {read_bytes}, sent_frames: {sent_frames},
-                first_frame_latency: {first_frame_latency}ms, finish_latency: {finish_latency}ms"
-            )
+        with audio.lock:
+            audio.finished = True
+            if self.input_stream_ts < self.outdate_ts:
+                timeline.stamp(STAGE_FLUSH)
+                self.pacer.clear()
+            else:
+                # the tail is padded with silence to a full frame
+                for frame, timestamp in audio.framer.push(audio.converter.flush()):
+                    self.send_frame(frame, timestamp)
+                    audio.last_frame_ms = now_ms()
+                for frame, timestamp in audio.framer.flush():
+                    self.send_frame(frame, timestamp)
+                    audio.last_frame_ms = now_ms()
+                self.pacer.end()
+        stream.close()
+
+        if audio.last_frame_ms is not None:
+            timeline.stamp(STAGE_LAST_FRAME, audio.last_frame_ms)
+        finish_latency = int(timeline.since(STAGE_TTS_REQUEST))
+        timeline.finish()
+        logger.info(f"input stream finished, fragments: {stream.fragments}, read_bytes: {stream.received_bytes}, finish_latency: {finish_latency}ms")
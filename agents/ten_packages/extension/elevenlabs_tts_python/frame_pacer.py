@@ -0,0 +1,163 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Real time pacing of outgoing audio frames. Every TTS extension ships an
+# identical copy of this file, keep them in sync.
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict
+
+from .log import logger
+
+
+class FramePacer:
+    """
+    Releases audio frames at playout rate, at most lead_ms ahead of the audio
+    already released, instead of as fast as the provider returns them. Frames
+    still held here are dropped by clear, so a flush takes effect within
+    lead_ms of audio rather than after the whole buffered sentence.
+
+    Frames are released by a thread of the pacer through send. With lead_ms of
+    0 or less pacing is off and put sends right away.
+
+    end marks the end of a stream of frames (a sentence). A frame due while
+    nothing is queued in the middle of a stream counts as an underrun; the gap
+    after end is not one.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Any], None],
+        frame_ms: int = 10,
+        lead_ms: int = 150,
+        name: str = "pacer",
+    ):
+        self.send = send
+        self.frame_ms = frame_ms
+        self.lead_ms = lead_ms
+        self.name = name
+
+        self.cond = threading.Condition()
+        self.frames = deque()
+        self.playout_ms = 0.0  # monotonic ms at which the released audio ends
+        self.streaming = False
+        self.stopped = False
+        self.thread = None
+
+        self.released = 0
+        self.dropped = 0
+        self.underruns = 0
+        self.max_depth = 0
+
+    def start(self) -> None:
+        if self.lead_ms > 0 and self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True
+            )
+            self.thread.start()
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.frames.clear()
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, frame: Any) -> None:
+        if self.thread is None:
+            self._send(frame)
+            return
+        with self.cond:
+            self.frames.append(frame)
+            self.max_depth = max(self.max_depth, len(self.frames))
+            self.cond.notify_all()
+
+    def end(self) -> None:
+        """
+        The stream ends once the queued frames are released.
+        """
+        with self.cond:
+            self.frames.append(None)
+            self.cond.notify_all()
+
+    def clear(self) -> int:
+        """
+        Drop every frame not released yet, returns how many were dropped.
+        """
+        with self.cond:
+            dropped = sum(1 for frame in self.frames if frame is not None)
+            self.frames.clear()
+            self.dropped += dropped
+            self.streaming = False
+            self.playout_ms = _now_ms()
+            self.cond.notify_all()
+        if dropped:
+            logger.info(f"{self.name} dropped {dropped} unreleased frames")
+        return dropped
+
+    def depth(self) -> int:
+        with self.cond:
+            return sum(1 for frame in self.frames if frame is not None)
+
+    def depth_ms(self) -> int:
+        return self.depth() * self.frame_ms
+
+    def stats(self) -> Dict[str, int]:
+        with self.cond:
+            depth = sum(1 for frame in self.frames if frame is not None)
+            return {
+                "depth": depth,
+                "depth_ms": depth * self.frame_ms,
+                "max_depth_ms": self.max_depth * self.frame_ms,
+                "released": self.released,
+                "dropped": self.dropped,
+                "underruns": self.underruns,
+                "lead_ms": self.lead_ms,
+            }
+
+    def _send(self, frame: Any) -> None:
+        try:
+            self.send(frame)
+        except Exception as e:
+            logger.warning(f"{self.name} send frame failed, err: {e}")
+        self.released += 1
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.frames and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+
+                if self.frames[0] is None:
+                    self.frames.popleft()
+                    self.streaming = False
+                    continue
+
+                now = _now_ms()
+                wait_ms = self.playout_ms - self.lead_ms - now
+                if wait_ms > 0:
+                    # woken early by clear or stop, the head is looked at again
+                    self.cond.wait(wait_ms / 1000)
+                    continue
+
+                frame = self.frames.popleft()
+                if self.playout_ms < now:
+                    if self.streaming:
+                        self.underruns += 1
+                    self.playout_ms = now
+                self.playout_ms += self.frame_ms
+                self.streaming = True
+
+            self._send(frame)
+
+
+def _now_ms() -> float:
+    return time.monotonic() * 1000
@@ -6,25 +6,25 @@
 #
 #
 
-import logging
-from typing import Iterator
-from ten import AudioFrame, TenEnv, AudioFrameDataFmt
+from ten import AudioFrame, AudioFrameDataFmt
+from .pcm_converter import PcmConverter
+from .pcm_framer import PcmFramer
 
 
 class Pcm:
     def __init__(self, config) -> None:
         self.config = config
 
-    def get_pcm_frame(self, buf: memoryview) -> AudioFrame:
+    def get_pcm_frame(self, buf: memoryview, timestamp: int = 0) -> AudioFrame:
         frame = AudioFrame.create(self.config.name)
         frame.set_bytes_per_sample(self.config.bytes_per_sample)
         frame.set_sample_rate(self.config.sample_rate)
-        frame.set_number_of_channels(self.config.num_channels)
-        frame.set_timestamp(self.config.timestamp)
+        frame.set_number_of_channels(self.config.channel)
+        frame.set_timestamp(timestamp)
         frame.set_data_fmt(AudioFrameDataFmt.INTERLEAVE)
-        frame.set_samples_per_channel(self.config.samples_per_channel // self.config.channel)
+        frame.set_samples_per_channel(len(buf) // (self.config.bytes_per_sample * self.config.channel))
 
-        frame.alloc_buf(self.get_pcm_frame_size())
+        frame.alloc_buf(len(buf))
         frame_buf = frame.lock_buf()
         # copy data
         frame_buf[:] = buf
@@ -35,26 +35,23 @@ class Pcm:
     def get_pcm_frame_size(self) -> int:
         return (self.config.samples_per_channel * self.config.channel * self.config.bytes_per_sample)
 
-    def new_buf(self) -> bytearray:
-        return bytearray(self.get_pcm_frame_size())
+    def new_framer(self) -> PcmFramer:
+        return PcmFramer(
+            self.config.sample_rate,
+            self.config.frame_ms,
+            self.config.bytes_per_sample,
+            self.config.channel,
+        )
 
-    def read_pcm_stream(self, stream: Iterator[bytes], chunk_size: int) -> Iterator[bytes]:
-        chunk = b""
-        for data in stream:
-            chunk += data
-            while len(chunk) >= chunk_size:
-                yield chunk[:chunk_size]
-                chunk = chunk[chunk_size:]
-
-        if chunk:
-            yield chunk
-
-    def send(self, ten: TenEnv, buf: memoryview) -> None:
-        try:
-            frame = self.get_pcm_frame(buf)
-            ten.send_audio_frame(frame)
-        except Exception as e:
-            logging.error(f"send frame failed, {e}")
+    def new_converter(self, provider_sample_rate: int) -> PcmConverter:
+        return PcmConverter(
+            provider_sample_rate,
+            self.config.sample_rate,
+            self.config.channel,
+            self.config.channel,
+            self.config.bytes_per_sample,
+            self.config.bytes_per_sample,
+        )
 
 
 class PcmConfig:
@@ -63,5 +60,6 @@ class PcmConfig:
         self.channel = 1
         self.name = "pcm_frame"
         self.sample_rate = 16000
+        self.frame_ms = 10
         self.samples_per_channel = 16000 // 100
         self.timestamp = 0
@@ -0,0 +1,79 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Local stand-in for the ElevenLabs websocket input streaming API, for running
+# the extension without an account or network. It speaks the same messages
+# and answers every text fragment with a tone whose length follows the text.
+# Run it and point stream_input_url at it:
+#
+#   python stream_input_stub.py --port 8765
+#   "stream_input_url": "ws://127.0.0.1:8765/v1/text-to-speech/{voice_id}/stream-input"
+import argparse
+import base64
+import json
+import math
+import struct
+import time
+
+from websockets.sync.server import serve
+
+SAMPLE_RATE = 16000
+
+
+def tone(duration_ms: int, freq: int = 440) -> bytes:
+    samples = SAMPLE_RATE * duration_ms // 1000
+    return struct.pack(
+        f"<{samples}h",
+        *(int(8000 * math.sin(2 * math.pi * freq * i / SAMPLE_RATE)) for i in range(samples)),
+    )
+
+
+def handler(ws, warmup_ms: int, ms_per_char: int, chunk_ms: int) -> None:
+    first = True
+    for message in ws:
+        text = json.loads(message).get("text")
+        if text is None:
+            continue
+        if text == "":
+            ws.send(json.dumps({"audio": None, "isFinal": True}))
+            return
+        if not text.strip():
+            # the opening message
+            continue
+        if first:
+            # model warm-up, paid once per stream
+            time.sleep(warmup_ms / 1000)
+            first = False
+        audio = tone(len(text.strip()) * ms_per_char)
+        chunk = SAMPLE_RATE * 2 * chunk_ms // 1000
+        for i in range(0, len(audio), chunk):
+            ws.send(
+                json.dumps(
+                    {"audio": base64.b64encode(audio[i : i + chunk]).decode(), "isFinal": False}
+                )
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--warmup-ms", type=int, default=300)
+    parser.add_argument("--ms-per-char", type=int, default=60)
+    parser.add_argument("--chunk-ms", type=int, default=100)
+    args = parser.parse_args()
+
+    with serve(
+        lambda ws: handler(ws, args.warmup_ms, args.ms_per_char, args.chunk_ms),
+        args.host,
+        args.port,
+    ) as server:
+        print(f"stream input stub on ws://{args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Per turn latency timeline of the voice pipeline. Every extension that stamps
+# a timeline ships an identical copy of this file, keep them in sync.
+import bisect
+import itertools
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+from .log import logger
+
+STAGE_ASR_FINAL = "asr_final"
+STAGE_LLM_REQUEST = "llm_request"
+STAGE_FIRST_TOKEN = "first_token"
+STAGE_FIRST_SENTENCE = "first_sentence"
+STAGE_TTS_REQUEST = "tts_request"
+STAGE_FIRST_AUDIO = "first_audio"
+STAGE_LAST_FRAME = "last_frame"
+STAGE_FLUSH = "flush"
+
+# pipeline order, intervals are measured between consecutive stamped stages
+STAGES = [
+    STAGE_ASR_FINAL,
+    STAGE_LLM_REQUEST,
+    STAGE_FIRST_TOKEN,
+    STAGE_FIRST_SENTENCE,
+    STAGE_TTS_REQUEST,
+    STAGE_FIRST_AUDIO,
+    STAGE_LAST_FRAME,
+    STAGE_FLUSH,
+]
+
+# upper bounds of the histogram buckets in ms, the last bucket is open
+BUCKETS_MS = [10, 20, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000]
+
+REPORT_EVERY_TURNS = 20
+
+# property of a final text_data, when the ASR produced it in now_ms
+DATA_PROPERTY_ASR_FINAL_TS = "asr_final_ts"
+# property of the text_data an LLM sends, the id of its timeline, which the
+# TTS timelines of the text take on so the records of a turn can be joined
+DATA_PROPERTY_TURN_ID = "turn_id"
+
+
+def now_ms() -> float:
+    """
+    The clock of every stamp: unix epoch in ms, so timelines of different
+    extensions line up.
+    """
+    return time.time() * 1000
+
+
+def get_asr_final_ms(data) -> float:
+    """
+    The asr_final_ts of a final text_data, now if the ASR did not stamp it.
+    """
+    try:
+        ts = data.get_property_int(DATA_PROPERTY_ASR_FINAL_TS)
+        if ts > 0:
+            return float(ts)
+    except Exception:
+        pass
+    return now_ms()
+
+
+def get_turn_id(data) -> Optional[str]:
+    """
+    The turn_id of a text_data, None if the LLM did not set it.
+    """
+    try:
+        return data.get_property_string(DATA_PROPERTY_TURN_ID) or None
+    except Exception:
+        return None
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def percentile(self, p: float) -> float:
+        """
+        Upper bound of the bucket holding the p-th percentile, capped by the
+        max seen.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(float(BUCKETS_MS[i]), self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([str(b) for b in BUCKETS_MS] + ["+Inf"], self.counts)),
+        }
+
+
+class TurnTimeline:
+    """
+    Stamps of one turn. The first stamp of a stage wins, so it is safe to
+    stamp first_audio on every frame.
+    """
+
+    def __init__(self, recorder: "TimelineRecorder", turn_id: str, text: str = ""):
+        self.recorder = recorder
+        self.turn_id = turn_id
+        self.text = text
+        self.stamps: Dict[str, float] = {}
+        self.finished = False
+
+    def stamp(self, stage: str, ts_ms: Optional[float] = None) -> None:
+        if stage not in self.stamps:
+            self.stamps[stage] = ts_ms if ts_ms is not None else now_ms()
+
+    def since(self, stage: str) -> float:
+        """
+        ms elapsed since a stage, 0 if it was not stamped.
+        """
+        if stage not in self.stamps:
+            return 0.0
+        return now_ms() - self.stamps[stage]
+
+    def intervals(self) -> Dict[str, float]:
+        stamped = [stage for stage in STAGES if stage in self.stamps]
+        result = {}
+        for a, b in zip(stamped, stamped[1:]):
+            result[f"{a}->{b}"] = self.stamps[b] - self.stamps[a]
+        if len(stamped) > 1:
+            result["total"] = self.stamps[stamped[-1]] - self.stamps[stamped[0]]
+        return result
+
+    def finish(self) -> None:
+        if not self.finished:
+            self.finished = True
+            self.recorder.record(self)
+
+
+class TimelineRecorder:
+    """
+    Collects finished timelines of an extension into a histogram per interval
+    and, if path is set, appends each one to it as a JSON line.
+    """
+
+    def __init__(self, source: str, path: str = ""):
+        self.source = source
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.turns = 0
+
+    def begin(self, text: str = "", turn_id: Optional[str] = None) -> TurnTimeline:
+        if turn_id is None:
+            turn_id = f"{self.source}-{next(self.ids)}"
+        return TurnTimeline(self, turn_id, text)
+
+    def record(self, timeline: TurnTimeline) -> None:
+        intervals = timeline.intervals()
+        with self.lock:
+            self.turns += 1
+            for name, value in intervals.items():
+                self.histograms.setdefault(name, LatencyHistogram()).observe(value)
+            report = self.turns % REPORT_EVERY_TURNS == 0
+
+        if self.path:
+            line = json.dumps(
+                {
+                    "source": self.source,
+                    "turn": timeline.turn_id,
+                    "text": timeline.text,
+                    "stamps": timeline.stamps,
+                    "intervals": intervals,
+                },
+                ensure_ascii=False,
+            )
+            try:
+                with self.lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except Exception as e:
+                logger.warning(f"write timeline to {self.path} failed, err: {e}")
+
+        logger.info(
+            "turn timeline {}: {}".format(
+                timeline.turn_id,
+                ", ".join(f"{k} {v:.0f}ms" for k, v in intervals.items()),
+            )
+        )
+        if report:
+            self.report()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {name: h.to_dict() for name, h in self.histograms.items()}
+
+    def report(self) -> None:
+        for name, h in self.stats().items():
+            logger.info(
+                "latency {} {}: count {} avg {:.0f}ms p50 {:.0f}ms p90 {:.0f}ms p99 {:.0f}ms max {:.0f}ms".format(
+                    self.source, name, h["count"], h["avg"], h["p50"], h["p90"], h["p99"], h["max"]
+                )
+            )
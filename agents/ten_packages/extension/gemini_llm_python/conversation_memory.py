@@ -0,0 +1,138 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Token budgeted conversation memory shared by the LLM extensions. Every LLM
+# extension ships an identical copy of this file, keep them in sync.
+import copy
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List
+
+# per message overhead of the chat formats (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _is_wide(c: str) -> bool:
+    # CJK, kana and hangul are roughly one token per character
+    o = ord(c)
+    return (
+        0x3040 <= o <= 0x30FF
+        or 0x3400 <= o <= 0x4DBF
+        or 0x4E00 <= o <= 0x9FFF
+        or 0xAC00 <= o <= 0xD7AF
+        or 0xF900 <= o <= 0xFAFF
+    )
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Cheap token estimate without a tokenizer: one token per wide character and
+    about four characters per token for everything else.
+    """
+    wide = sum(1 for c in text if _is_wide(c))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def estimate_tokens(message: Dict[str, Any]) -> int:
+    """
+    Estimate the tokens of a chat message. Understands the string content of
+    openai, the list of text parts of bedrock and openai vision, and the parts
+    of gemini.
+    """
+    content = message.get("content", message.get("parts", ""))
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + estimate_text_tokens(content)
+
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content or []:
+        if isinstance(part, str):
+            tokens += estimate_text_tokens(part)
+        elif isinstance(part, dict) and isinstance(part.get("text"), str):
+            tokens += estimate_text_tokens(part["text"])
+    return tokens
+
+
+class ConversationMemory:
+    """
+    Chat history trimmed by a token budget and a message count.
+
+    The token count of a message is computed once when it is appended and a
+    running total is kept, so trimming pops from the front of a deque and
+    costs O(1) amortized per message. The oldest turn is dropped as a whole:
+    after popping a message, messages up to the next user message go too, so
+    the history always starts with a user message. The newest message is never
+    dropped, even if it alone is over budget.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 2048,
+        max_messages: int = 0,
+        count_tokens: Callable[[Dict[str, Any]], int] = estimate_tokens,
+        user_role: str = "user",
+    ):
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.count_tokens = count_tokens
+        self.user_role = user_role
+        self.items: Deque[List[Any]] = deque()
+        self.total_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return self.items[index][0]
+
+    def append(self, message: Dict[str, Any]) -> None:
+        tokens = self.count_tokens(message)
+        self.items.append([message, tokens])
+        self.total_tokens += tokens
+        self.trim()
+
+    def merge_last(self, part: Any) -> None:
+        """
+        Append a content part to the last message, which must have list content.
+        """
+        item = self.items[-1]
+        item[0]["content"].append(part)
+        self.total_tokens -= item[1]
+        item[1] = self.count_tokens(item[0])
+        self.total_tokens += item[1]
+        self.trim()
+
+    def trim(self) -> None:
+        while len(self.items) > 1 and self._over_budget():
+            self._pop_turn()
+
+    def clear(self) -> None:
+        self.items.clear()
+        self.total_tokens = 0
+
+    def messages(self) -> List[Dict[str, Any]]:
+        """
+        Snapshot of the messages, oldest first, for building a request.
+        """
+        return [item[0] for item in self.items]
+
+    def copy(self) -> "ConversationMemory":
+        memory = ConversationMemory(
+            self.max_tokens, self.max_messages, self.count_tokens, self.user_role
+        )
+        memory.items = deque([copy.deepcopy(m), t] for m, t in self.items)
+        memory.total_tokens = self.total_tokens
+        return memory
+
+    def _over_budget(self) -> bool:
+        if self.max_tokens > 0 and self.total_tokens > self.max_tokens:
+            return True
+        return self.max_messages > 0 and len(self.items) > self.max_messages
+
+    def _pop_turn(self) -> None:
+        _, tokens = self.items.popleft()
+        self.total_tokens -= tokens
+        while len(self.items) > 1 and self.items[0][0].get("role") != self.user_role:
+            _, tokens = self.items.popleft()
+            self.total_tokens -= tokens
@@ -14,9 +14,23 @@ from ten import (
     StatusCode,
     CmdResult,
 )
+from .conversation_memory import ConversationMemory
 from .gemini_llm import GeminiLLM, GeminiLLMConfig
+from .inflight_streams import InflightStreams
 from .log import logger
-from .utils import get_micro_ts, parse_sentence
+from .sentence_segmenter import SentenceSegmenter, get_punctuations
+from .speculative import Speculator, TurnOutput
+from .turn_timeline import (
+    STAGE_ASR_FINAL,
+    STAGE_FIRST_SENTENCE,
+    STAGE_FIRST_TOKEN,
+    STAGE_FLUSH,
+    DATA_PROPERTY_TURN_ID,
+    STAGE_LLM_REQUEST,
+    TimelineRecorder,
+    get_asr_final_ms,
+)
+from .utils import get_micro_ts
 
 
 CMD_IN_FLUSH = "flush"
@@ -29,22 +43,35 @@ DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT = "end_of_segment"
 PROPERTY_API_KEY = "api_key"  # Required
 PROPERTY_GREETING = "greeting"  # Optional
 PROPERTY_MAX_MEMORY_LENGTH = "max_memory_length"  # Optional
+PROPERTY_MAX_MEMORY_TOKENS = "max_memory_tokens"  # Optional
+PROPERTY_MIN_SENTENCE_LENGTH = "min_sentence_length"  # Optional
 PROPERTY_MAX_OUTPUT_TOKENS = "max_output_tokens"  # Optional
 PROPERTY_MODEL = "model"  # Optional
 PROPERTY_PROMPT = "prompt"  # Optional
+PROPERTY_SENTENCE_LANGUAGE = "sentence_language"  # Optional
+PROPERTY_SPECULATIVE_COMPLETION = "speculative_completion"  # Optional
+PROPERTY_SPECULATIVE_STABLE_MS = "speculative_stable_ms"  # Optional
 PROPERTY_TEMPERATURE = "temperature"  # Optional
+PROPERTY_TIMELINE_PATH = "timeline_path"  # Optional
 PROPERTY_TOP_K = "top_k"  # Optional
 PROPERTY_TOP_P = "top_p"  # Optional
 
 
 class GeminiLLMExtension(Extension):
-    memory = []
+    memory = None
     max_memory_length = 10
+    max_memory_tokens = 2048
     outdate_ts = 0
     gemini_llm = None
+    sentence_punctuations = get_punctuations("default")
+    min_sentence_length = 0
+    inflight_streams = None
+    speculator = None
+    timelines = None
 
     def on_start(self, ten: TenEnv) -> None:
         logger.info("GeminiLLMExtension on_start")
+        self.inflight_streams = InflightStreams()
         # Prepare configuration
         gemini_llm_config = GeminiLLMConfig.default_config()
 
@@ -84,8 +111,78 @@ class GeminiLLMExtension(Extension):
                 f"GetProperty optional {PROPERTY_MAX_MEMORY_LENGTH} failed, err: {err}"
             )
 
+        try:
+            prop_max_memory_tokens = ten.get_property_int(PROPERTY_MAX_MEMORY_TOKENS)
+            if prop_max_memory_tokens > 0:
+                self.max_memory_tokens = int(prop_max_memory_tokens)
+        except Exception as err:
+            logger.warning(
+                f"GetProperty optional {PROPERTY_MAX_MEMORY_TOKENS} failed, err: {err}"
+            )
+
+        self.memory = ConversationMemory(
+            self.max_memory_tokens, self.max_memory_length
+        )
+
+        try:
+            sentence_language = ten.get_property_string(PROPERTY_SENTENCE_LANGUAGE)
+            self.sentence_punctuations = get_punctuations(sentence_language)
+        except Exception as e:
+            logger.warning(
+                f"get_property_string optional {PROPERTY_SENTENCE_LANGUAGE} failed, err: {e}"
+            )
+
+        try:
+            min_sentence_length = ten.get_property_int(PROPERTY_MIN_SENTENCE_LENGTH)
+            if min_sentence_length > 0:
+                self.min_sentence_length = int(min_sentence_length)
+        except Exception as e:
+            logger.warning(
+                f"get_property_int optional {PROPERTY_MIN_SENTENCE_LENGTH} failed, err: {e}"
+            )
+
+        speculative_completion = False
+        try:
+            speculative_completion = ten.get_property_bool(
+                PROPERTY_SPECULATIVE_COMPLETION
+            )
+        except Exception as e:
+            logger.warning(
+                f"get_property_bool optional {PROPERTY_SPECULATIVE_COMPLETION} failed, err: {e}"
+            )
+
+        speculative_stable_ms = 400
+        try:
+            prop_speculative_stable_ms = ten.get_property_int(
+                PROPERTY_SPECULATIVE_STABLE_MS
+            )
+            if prop_speculative_stable_ms > 0:
+                speculative_stable_ms = int(prop_speculative_stable_ms)
+        except Exception as e:
+            logger.warning(
+                f"get_property_int optional {PROPERTY_SPECULATIVE_STABLE_MS} failed, err: {e}"
+            )
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH)
+        except Exception as e:
+            logger.warning(
+                f"get_property_string optional {PROPERTY_TIMELINE_PATH} failed, err: {e}"
+            )
+        self.timelines = TimelineRecorder("gemini_llm_python", timeline_path)
+
+        if speculative_completion:
+            self.speculator = Speculator(
+                speculative_stable_ms,
+                lambda turn: self.start_speculation(ten, turn),
+            )
+
         # Create GeminiLLM instance
         self.gemini_llm = GeminiLLM(gemini_llm_config)
+        self.inflight_streams.default_completion_tokens = (
+            gemini_llm_config.max_output_tokens
+        )
         logger.info(
             f"newGeminiLLM succeed with max_output_tokens: {gemini_llm_config.max_output_tokens}, model: {gemini_llm_config.model}"
         )
@@ -110,6 +207,12 @@ class GeminiLLMExtension(Extension):
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("GeminiLLMExtension on_stop")
+        if self.speculator is not None:
+            self.speculator.cancel()
+        self.outdate_ts = get_micro_ts()
+        self.inflight_streams.cancel_all()
+        if self.timelines is not None:
+            self.timelines.report()
         ten.on_stop_done()
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
@@ -121,6 +224,9 @@ class GeminiLLMExtension(Extension):
 
         if cmd_name == CMD_IN_FLUSH:
             self.outdate_ts = get_micro_ts()
+            # cancel in-flight grpc streams, gemini stops generating right away
+            self.inflight_streams.cancel_all(self.outdate_ts)
+            logger.info(f"in-flight streams stats: {self.inflight_streams.stats()}")
             cmd_out = Cmd.create(CMD_OUT_FLUSH)
             ten.send_cmd(cmd_out, None)
             logger.info(f"GeminiLLMExtension on_cmd sent flush")
@@ -148,7 +254,7 @@ class GeminiLLMExtension(Extension):
         # Assume 'data' is an object from which we can get properties
         try:
             is_final = data.get_property_bool(DATA_IN_TEXT_DATA_PROPERTY_IS_FINAL)
-            if not is_final:
+            if not is_final and self.speculator is None:
                 logger.info("ignore non-final input")
                 return
         except Exception as e:
@@ -170,113 +276,155 @@ class GeminiLLMExtension(Extension):
             )
             return
 
+        if not is_final:
+            self.speculator.on_partial(input_text)
+            return
+
+        start_time = get_micro_ts()
+        final_ms = get_asr_final_ms(data)
+        if self.speculator is not None:
+            turn = self.speculator.on_final(input_text)
+            if turn is not None:
+                # the speculative answer is already on its way, let it out
+                self.append_memory({"role": "user", "parts": input_text})
+                turn.commit(start_time, final_ms)
+                return
+
         # Prepare memory
-        if len(self.memory) > self.max_memory_length:
-            self.memory.pop(0)
-        self.memory.append({"role": "user", "parts": input_text})
+        self.append_memory({"role": "user", "parts": input_text})
 
-        def chat_completions_stream_worker(start_time, input_text, memory):
-            try:
+        # Start thread to request and read responses from GeminiLLM
+        thread = Thread(
+            target=self.chat_completions_stream_worker,
+            args=(
+                ten,
+                start_time,
+                input_text,
+                self.memory.messages(),
+                TurnOutput(input_text, start_time, final_ms=final_ms),
+            ),
+        )
+        thread.start()
+        logger.info(f"GeminiLLMExtension on_data end")
+
+    def start_speculation(self, ten: TenEnv, turn: TurnOutput) -> None:
+        # speculate on a copy, memory is only updated once the turn is committed
+        memory = self.memory.copy()
+        memory.append({"role": "user", "parts": turn.text})
+        thread = Thread(
+            target=self.chat_completions_stream_worker,
+            args=(ten, get_micro_ts(), turn.text, memory.messages(), turn),
+        )
+        thread.start()
+
+    def append_memory(self, message):
+        self.memory.append(message)
+
+    def send_data(self, ten, sentence, end_of_segment, input_text, turn_id=""):
+        try:
+            output_data = Data.create("text_data")
+            output_data.set_property_string(DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence)
+            output_data.set_property_bool(
+                DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, end_of_segment
+            )
+            if turn_id:
+                output_data.set_property_string(DATA_PROPERTY_TURN_ID, turn_id)
+            ten.send_data(output_data)
+            logger.info(
+                f"chat_completions_stream_worker for input text: [{input_text}] {'end of segment ' if end_of_segment else ''}sent sentence [{sentence}]"
+            )
+        except Exception as e:
+            logger.error(
+                f"chat_completions_stream_worker for input text: [{input_text}] {'end of segment ' if end_of_segment else ''}send sentence [{sentence}] failed, err: {e}"
+            )
+
+    def chat_completions_stream_worker(
+        self, ten: TenEnv, start_time, input_text, memory, turn
+    ):
+        timeline = self.timelines.begin(input_text)
+        timeline.stamp(
+            STAGE_ASR_FINAL,
+            turn.final_ms if turn.final_ms is not None else start_time / 1000,
+        )
+        try:
+            logger.info(
+                f"chat_completions_stream_worker for input text: [{input_text}] memory: {memory}"
+            )
+
+            # Get result from AI
+            timeline.stamp(STAGE_LLM_REQUEST)
+            resp = self.gemini_llm.get_chat_completions_stream(memory)
+            if resp is None:
                 logger.info(
-                    f"chat_completions_stream_worker for input text: [{input_text}] memory: {memory}"
+                    f"chat_completions_stream_worker for input text: [{input_text}] failed"
                 )
+                return
 
-                # Get result from AI
-                resp = self.gemini_llm.get_chat_completions_stream(memory)
-                if resp is None:
-                    logger.info(
-                        f"chat_completions_stream_worker for input text: [{input_text}] failed"
-                    )
-                    return
-
-                sentence = ""
-                full_content = ""
-                first_sentence_sent = False
+            segmenter = SentenceSegmenter(
+                self.sentence_punctuations, self.min_sentence_length
+            )
+            full_content = ""
+            first_sentence_sent = False
 
+            inflight = self.inflight_streams.register(resp, turn=turn)
+            try:
                 for chat_completions in resp:
-                    if start_time < self.outdate_ts:
+                    if turn.outdated(self.outdate_ts):
                         logger.info(
                             f"chat_completions_stream_worker recv interrupt and flushing for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
                         )
+                        timeline.stamp(STAGE_FLUSH)
                         break
 
                     if chat_completions.text is not None:
                         content = chat_completions.text
                     else:
                         content = ""
+                    self.inflight_streams.on_chunk(inflight)
+                    turn.on_chunk()
+                    if content:
+                        timeline.stamp(STAGE_FIRST_TOKEN)
 
                     full_content += content
 
-                    while True:
-                        sentence, content, sentence_is_final = parse_sentence(
-                            sentence, content
-                        )
-
-                        if len(sentence) == 0 or not sentence_is_final:
-                            logger.info(f"sentence {sentence} is empty or not final")
-                            break
-
+                    for sentence in segmenter.feed(content):
                         logger.info(
                             f"chat_completions_stream_worker recv for input text: [{input_text}] got sentence: [{sentence}]"
                         )
 
                         # send sentence
-                        try:
-                            output_data = Data.create("text_data")
-                            output_data.set_property_string(
-                                DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence
-                            )
-                            output_data.set_property_bool(
-                                DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, False
-                            )
-                            ten.send_data(output_data)
-                            logger.info(
-                                f"chat_completions_stream_worker recv for input text: [{input_text}] sent sentence [{sentence}]"
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f"chat_completions_stream_worker recv for input text: [{input_text}] send sentence [{sentence}] failed, err: {e}"
-                            )
-                            break
+                        turn.emit(self.send_data, ten, sentence, False, input_text, timeline.turn_id)
 
-                        sentence = ""
                         if not first_sentence_sent:
                             first_sentence_sent = True
+                            timeline.stamp(STAGE_FIRST_SENTENCE)
                             logger.info(
-                                f"chat_completions_stream_worker recv for input text: [{input_text}] first sentence sent, first_sentence_latency {get_micro_ts() - start_time}ms"
+                                "chat_completions_stream_worker recv for input text: [{}] first sentence sent, first_sentence_latency {:.0f}ms".format(
+                                    input_text, timeline.since(STAGE_ASR_FINAL)
+                                )
                             )
-
-                # remember response as assistant content in memory
-                memory.append({"role": "model", "parts": full_content})
-
-                # send end of segment
-                try:
-                    output_data = Data.create("text_data")
-                    output_data.set_property_string(
-                        DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence
-                    )
-                    output_data.set_property_bool(
-                        DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, True
-                    )
-                    ten.send_data(output_data)
-                    logger.info(
-                        f"chat_completions_stream_worker for input text: [{input_text}] end of segment with sentence [{sentence}] sent"
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"chat_completions_stream_worker for input text: [{input_text}] end of segment with sentence [{sentence}] send failed, err: {e}"
-                    )
-
             except Exception as e:
-                logger.error(
-                    f"chat_completions_stream_worker for input text: [{input_text}] failed, err: {e}"
+                if not inflight.cancelled:
+                    raise
+                timeline.stamp(STAGE_FLUSH)
+                logger.info(
+                    f"chat_completions_stream_worker stream cancelled by flush for input text: [{input_text}], err: {e}"
                 )
+            finally:
+                self.inflight_streams.unregister(inflight)
 
-        # Start thread to request and read responses from GeminiLLM
-        start_time = get_micro_ts()
-        thread = Thread(
-            target=chat_completions_stream_worker,
-            args=(start_time, input_text, self.memory),
-        )
-        thread.start()
-        logger.info(f"GeminiLLMExtension on_data end")
+            # remember response as assistant content in memory
+            turn.emit(self.append_memory, {"role": "model", "parts": full_content})
+
+            # send end of segment
+            turn.emit(self.send_data, ten, segmenter.flush(), True, input_text, timeline.turn_id)
+
+        except Exception as e:
+            logger.error(
+                f"chat_completions_stream_worker for input text: [{input_text}] failed, err: {e}"
+            )
+        finally:
+            # a speculative turn that was never committed is not a turn of the user
+            if turn.final_ms is not None:
+                timeline.stamps[STAGE_ASR_FINAL] = turn.final_ms
+                timeline.finish()
@@ -0,0 +1,193 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Bookkeeping of in-flight provider streams shared by the LLM extensions. Every
+# LLM extension ships an identical copy of this file, keep them in sync.
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from .log import logger
+
+
+def close_stream(stream: Any) -> bool:
+    """
+    Best effort close of a provider response stream, so the provider stops
+    generating and the connection is released. Returns True if some close or
+    cancel method succeeded.
+    """
+    # grpc based streams (e.g. gemini) expose cancel on the wrapped iterator
+    for target in [stream, getattr(stream, "_iterator", None)]:
+        if target is None:
+            continue
+        for method in ["cancel", "close"]:
+            fn = getattr(target, method, None)
+            if callable(fn):
+                try:
+                    fn()
+                    return True
+                except Exception as e:
+                    logger.debug(f"close_stream {method} failed, err: {e}")
+    return False
+
+
+class InflightStream:
+    def __init__(
+        self,
+        stream: Any,
+        closer: Optional[Callable[[], Any]],
+        start_ts: Any,
+        turn: Any,
+    ):
+        self.stream = stream
+        self.closer = closer
+        self.start_ts = start_ts
+        self.turn = turn
+        self.begin = time.perf_counter()
+        self.last = self.begin
+        self.tokens = 0
+        self.cancelled = False
+
+
+class InflightStreams:
+    """
+    Tracks the provider streams an extension is currently reading so a flush
+    can close all of them right away instead of waiting for the next chunk.
+
+    Tokens are approximated by received chunks, which is close to one token per
+    chunk for the streaming APIs in use. The saving of a cancellation is
+    estimated from the average length of the completions that ran to the end
+    and the chunk rate of the cancelled stream. It is only counted when the
+    stream was closed; a stream whose close failed, e.g. a generator being
+    read on another thread, is counted as deferred, its reader stops it at
+    the next chunk.
+    """
+
+    def __init__(self, default_completion_tokens: int = 256):
+        self.lock = threading.Lock()
+        self.streams: Dict[int, InflightStream] = {}
+        self.completed = 0
+        self.completed_tokens = 0
+        self.default_completion_tokens = default_completion_tokens
+        self.cancelled = 0
+        self.saved_tokens = 0
+        self.saved_ms = 0.0
+        self.deferred = 0
+
+    def register(
+        self,
+        stream: Any,
+        closer: Optional[Callable[[], Any]] = None,
+        start_ts: Any = None,
+        turn: Any = None,
+    ) -> InflightStream:
+        """
+        Track a stream, closer defaults to close_stream(stream). start_ts is
+        compared against the outdate_ts given to cancel_all, unless the stream
+        belongs to a turn (see speculative.TurnOutput), which decides itself.
+        """
+        inflight = InflightStream(stream, closer, start_ts, turn)
+        with self.lock:
+            self.streams[id(inflight)] = inflight
+        return inflight
+
+    def on_chunk(self, inflight: InflightStream, tokens: int = 1) -> None:
+        inflight.tokens += tokens
+        inflight.last = time.perf_counter()
+
+    def unregister(self, inflight: InflightStream) -> None:
+        with self.lock:
+            if self.streams.pop(id(inflight), None) is None:
+                return
+            if not inflight.cancelled:
+                self.completed += 1
+                self.completed_tokens += inflight.tokens
+
+    def cancel_all(self, outdate_ts: Any = None) -> List[Dict[str, float]]:
+        """
+        Close every tracked stream started before outdate_ts, or all of them
+        when outdate_ts is None. Returns the estimated saving of each closed
+        one.
+        """
+        with self.lock:
+            inflights = [
+                inflight
+                for inflight in self.streams.values()
+                if self._outdated(inflight, outdate_ts)
+            ]
+            for inflight in inflights:
+                del self.streams[id(inflight)]
+            if self.completed:
+                expected = self.completed_tokens / self.completed
+            else:
+                expected = self.default_completion_tokens
+
+        savings = []
+        for inflight in inflights:
+            # the reader stops at its next chunk either way
+            inflight.cancelled = True
+            try:
+                if inflight.closer is not None:
+                    closed = inflight.closer() is not False
+                else:
+                    closed = close_stream(inflight.stream)
+            except Exception as e:
+                logger.warning(f"cancel in-flight stream failed, err: {e}")
+                closed = False
+
+            elapsed_ms = (time.perf_counter() - inflight.begin) * 1000
+            if not closed:
+                with self.lock:
+                    self.deferred += 1
+                logger.info(
+                    "in-flight stream not closed after {} tokens, {:.0f}ms, it stops at its next chunk".format(
+                        inflight.tokens, elapsed_ms
+                    )
+                )
+                continue
+
+            saved_tokens = max(0, int(expected) - inflight.tokens)
+            if inflight.tokens > 1:
+                ms_per_token = (inflight.last - inflight.begin) * 1000 / inflight.tokens
+            else:
+                ms_per_token = 0
+            saving = {
+                "received_tokens": inflight.tokens,
+                "elapsed_ms": elapsed_ms,
+                "saved_tokens": saved_tokens,
+                "saved_ms": saved_tokens * ms_per_token,
+            }
+            savings.append(saving)
+
+            with self.lock:
+                self.cancelled += 1
+                self.saved_tokens += saving["saved_tokens"]
+                self.saved_ms += saving["saved_ms"]
+            logger.info(
+                "cancelled in-flight stream after {} tokens, {:.0f}ms, saved ~{} tokens ~{:.0f}ms".format(
+                    inflight.tokens, elapsed_ms, saved_tokens, saving["saved_ms"]
+                )
+            )
+
+        return savings
+
+    def _outdated(self, inflight: InflightStream, outdate_ts: Any) -> bool:
+        if outdate_ts is None:
+            return True
+        if inflight.turn is not None:
+            return inflight.turn.outdated(outdate_ts)
+        return inflight.start_ts is None or inflight.start_ts < outdate_ts
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "inflight": len(self.streams),
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "deferred": self.deferred,
+                "saved_tokens": self.saved_tokens,
+                "saved_ms": self.saved_ms,
+            }
@@ -0,0 +1,185 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+
+import re
+from typing import Dict, List
+
+from .log import logger
+
+# policy decisions
+FLUSH = "flush"
+SUPPRESSED_INTERRUPTED = "already_interrupted"
+SUPPRESSED_AGENT_SILENT = "agent_silent"
+SUPPRESSED_TOO_SHORT = "too_short"
+SUPPRESSED_COOLDOWN = "cooldown"
+
+# the agent counts as speaking this long after its last audio frame ended
+AGENT_SPEAKING_HOLD_MS = 300
+# the agent counts as responding this long after a final user text at most,
+# until its audio starts
+RESPONSE_TIMEOUT_MS = 10000
+
+# interrupt latencies kept for the percentiles
+LATENCY_WINDOW = 200
+
+# scripts written without spaces count a word per character
+_CJK = "\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff"
+_WORDS = re.compile(f"[{_CJK}]|[^\\s{_CJK}]+")
+
+
+def count_words(text: str) -> int:
+    return len(_WORDS.findall(text))
+
+
+class BargeInDetector:
+    """
+    Decides when the user barges in on the agent, at most once per user
+    utterance.
+
+    An utterance starts with the first text, or the VAD onset before it,
+    and ends with its final text. It interrupts the agent once a partial
+    has min_words words, or has lasted min_duration_ms if that is set, or
+    with its final text at the latest, while the agent is speaking or about
+    to, and cooldown_ms after the last interrupt. Every text that would have flushed before and did not is
+    counted by the reason it was suppressed.
+
+    The agent is speaking while its TTS audio plays, plus
+    AGENT_SPEAKING_HOLD_MS, and about to speak from a final user text until
+    its audio starts. Until any agent audio was seen, e.g. when the TTS
+    audio is not routed here, the agent is taken to be always speaking.
+
+    Times are in ms of one monotonic clock, passed in by the caller.
+    """
+
+    def __init__(
+        self,
+        min_words: int = 2,
+        min_duration_ms: int = 0,
+        only_while_speaking: bool = True,
+        cooldown_ms: int = 1000,
+    ):
+        self.min_words = min_words
+        self.min_duration_ms = min_duration_ms
+        self.only_while_speaking = only_while_speaking
+        self.cooldown_ms = cooldown_ms
+
+        self.utterance_start = None  # ms, None between utterances
+        self.vad_onset = None  # ms of the VAD onset of the next utterance
+        self.interrupted = False
+        self.last_flush = None
+
+        self.agent_audio_seen = False
+        self.agent_audio_until = 0.0
+        self.response_since = None
+
+        self.flushes = 0
+        self.suppressed = {
+            SUPPRESSED_INTERRUPTED: 0,
+            SUPPRESSED_AGENT_SILENT: 0,
+            SUPPRESSED_TOO_SHORT: 0,
+            SUPPRESSED_COOLDOWN: 0,
+        }
+        self.latencies: List[float] = []
+
+    def on_agent_audio(self, duration_ms: float, now: float) -> None:
+        if not self.agent_audio_seen:
+            logger.info("agent audio seen, interrupting only while the agent speaks")
+        self.agent_audio_seen = True
+        self.agent_audio_until = max(self.agent_audio_until, now) + duration_ms
+        self.response_since = None
+
+    def on_vad(self, speaking: bool, now: float) -> None:
+        if speaking and self.utterance_start is None:
+            self.vad_onset = now
+
+    def agent_speaking(self, now: float) -> bool:
+        if not self.agent_audio_seen:
+            return True
+        if now < self.agent_audio_until + AGENT_SPEAKING_HOLD_MS:
+            return True
+        return self.response_since is not None and now - self.response_since < RESPONSE_TIMEOUT_MS
+
+    def on_text(self, text: str, final: bool, now: float) -> str:
+        """
+        Take a user text, returns FLUSH or why it is not flushed.
+        """
+        if self.utterance_start is None:
+            self.utterance_start = self.vad_onset if self.vad_onset is not None else now
+            self.vad_onset = None
+            self.interrupted = False
+
+        decision = self._decide(text, final, now)
+        if final:
+            self.utterance_start = None
+            # the agent responds to the final text
+            self.response_since = now
+        return decision
+
+    def on_cmd(self, now: float) -> str:
+        """
+        Take a command that used to flush right away, returns FLUSH or why it
+        is not flushed.
+        """
+        if self.interrupted and self.utterance_start is not None:
+            return self._suppress(SUPPRESSED_INTERRUPTED)
+        if self._cooling_down(now):
+            return self._suppress(SUPPRESSED_COOLDOWN)
+        return self._flush(now, None)
+
+    def stats(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        return {
+            "flushes": self.flushes,
+            **{f"suppressed_{reason}": count for reason, count in self.suppressed.items()},
+            "latency_p50_ms": _percentile(latencies, 0.5),
+            "latency_p90_ms": _percentile(latencies, 0.9),
+            "latency_max_ms": latencies[-1] if latencies else 0.0,
+        }
+
+    def _decide(self, text: str, final: bool, now: float) -> str:
+        if not final and len(text) < 2:
+            # never flushed before either
+            return ""
+        if self.interrupted:
+            return self._suppress(SUPPRESSED_INTERRUPTED)
+        if self.only_while_speaking and not self.agent_speaking(now):
+            return self._suppress(SUPPRESSED_AGENT_SILENT)
+        # a final is what the agent answers next, even a one word "stop"
+        long_enough = final or count_words(text) >= self.min_words or (
+            self.min_duration_ms > 0 and now - self.utterance_start >= self.min_duration_ms
+        )
+        if not long_enough:
+            return self._suppress(SUPPRESSED_TOO_SHORT)
+        if self._cooling_down(now):
+            return self._suppress(SUPPRESSED_COOLDOWN)
+        return self._flush(now, self.utterance_start)
+
+    def _cooling_down(self, now: float) -> bool:
+        return self.last_flush is not None and now - self.last_flush < self.cooldown_ms
+
+    def _flush(self, now: float, onset) -> str:
+        self.flushes += 1
+        self.last_flush = now
+        self.interrupted = True
+        # the agent stops
+        self.agent_audio_until = 0.0
+        self.response_since = None
+        if onset is not None:
+            self.latencies.append(now - onset)
+            if len(self.latencies) > LATENCY_WINDOW:
+                del self.latencies[0]
+        return FLUSH
+
+    def _suppress(self, reason: str) -> str:
+        self.suppressed[reason] += 1
+        return reason
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(p * len(values)), len(values) - 1)]
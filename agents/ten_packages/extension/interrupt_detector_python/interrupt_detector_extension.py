@@ -6,7 +6,10 @@
 #
 #
 
+import time
+
 from ten import (
+    AudioFrame,
     Extension,
     TenEnv,
     Cmd,
@@ -14,24 +17,73 @@ from ten import (
     StatusCode,
     CmdResult,
 )
+from .barge_in import BargeInDetector, FLUSH
 from .log import logger
 
 
 CMD_NAME_FLUSH = "flush"
 
+DATA_NAME_VAD = "vad_data"
+
 TEXT_DATA_TEXT_FIELD = "text"
 TEXT_DATA_FINAL_FIELD = "is_final"
+TEXT_DATA_ASR_FINAL_TS_FIELD = "asr_final_ts"
+VAD_DATA_SPEAKING_FIELD = "speaking"
+
+PROPERTY_MIN_WORDS = "min_words"  # Optional
+PROPERTY_MIN_DURATION_MS = "min_duration_ms"  # Optional
+PROPERTY_ONLY_WHILE_SPEAKING = "only_while_speaking"  # Optional
+PROPERTY_COOLDOWN_MS = "cooldown_ms"  # Optional
+
+REPORT_EVERY_FLUSHES = 20
+
+
+def now_ms() -> float:
+    return time.monotonic() * 1000
 
 
 class InterruptDetectorExtension(Extension):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.detector = BargeInDetector()
+
     def on_start(self, ten: TenEnv) -> None:
         logger.info("on_start")
+
+        detector = self.detector
+        for name in [PROPERTY_MIN_WORDS, PROPERTY_MIN_DURATION_MS, PROPERTY_COOLDOWN_MS]:
+            try:
+                value = ten.get_property_int(name)
+                if value >= 0:
+                    setattr(detector, name, value)
+            except Exception as e:
+                logger.info(f"on_start get_property_int {name} error: {e}")
+
+        try:
+            detector.only_while_speaking = ten.get_property_bool(PROPERTY_ONLY_WHILE_SPEAKING)
+        except Exception as e:
+            logger.info(f"on_start get_property_bool {PROPERTY_ONLY_WHILE_SPEAKING} error: {e}")
+
+        logger.info(
+            f"barge-in policy: min_words {detector.min_words}, min_duration_ms {detector.min_duration_ms}, "
+            f"only_while_speaking {detector.only_while_speaking}, cooldown_ms {detector.cooldown_ms}"
+        )
         ten.on_start_done()
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("on_stop")
+        logger.info(f"barge-in stats: {self.detector.stats()}")
         ten.on_stop_done()
 
+    def interrupt(self, ten: TenEnv, decision: str, cause: str) -> None:
+        if decision != FLUSH:
+            if decision:
+                logger.debug(f"flush suppressed ({decision}) on {cause}")
+            return
+        self.send_flush_cmd(ten)
+        if self.detector.flushes % REPORT_EVERY_FLUSHES == 0:
+            logger.info(f"barge-in stats: {self.detector.stats()}")
+
     def send_flush_cmd(self, ten: TenEnv) -> None:
         flush_cmd = Cmd.create(CMD_NAME_FLUSH)
         ten.send_cmd(
@@ -45,8 +97,11 @@ class InterruptDetectorExtension(Extension):
         cmd_name = cmd.get_name()
         logger.info("on_cmd name {}".format(cmd_name))
 
-        # flush whatever cmd incoming at the moment
-        self.send_flush_cmd(ten)
+        # flush whatever cmd incoming at the moment, once per utterance, an
+        # incoming flush is forwarded itself
+        decision = self.detector.on_cmd(now_ms())
+        if cmd_name != CMD_NAME_FLUSH:
+            self.interrupt(ten, decision, f"cmd {cmd_name}")
 
         # then forward the cmd to downstream
         cmd_json = cmd.to_json()
@@ -66,9 +121,23 @@ class InterruptDetectorExtension(Extension):
           - name: text_data
             example:
             {name: text_data, properties: {text: "hello", is_final: false}
+          - name: vad_data
+            example:
+            {name: vad_data, properties: {speaking: true}
         """
         logger.info(f"on_data")
 
+        if data.get_name() == DATA_NAME_VAD:
+            try:
+                speaking = data.get_property_bool(VAD_DATA_SPEAKING_FIELD)
+            except Exception as e:
+                logger.warning(
+                    f"on_data get_property_bool {VAD_DATA_SPEAKING_FIELD} error: {e}"
+                )
+                return
+            self.detector.on_vad(speaking, now_ms())
+            return
+
         try:
             text = data.get_property_string(TEXT_DATA_TEXT_FIELD)
         except Exception as e:
@@ -89,10 +158,26 @@ class InterruptDetectorExtension(Extension):
             f"on_data {TEXT_DATA_TEXT_FIELD}: {text} {TEXT_DATA_FINAL_FIELD}: {final}"
         )
 
-        if final or len(text) >= 2:
-            self.send_flush_cmd(ten)
+        self.interrupt(ten, self.detector.on_text(text, final, now_ms()), "text")
 
         d = Data.create("text_data")
         d.set_property_bool(TEXT_DATA_FINAL_FIELD, final)
         d.set_property_string(TEXT_DATA_TEXT_FIELD, text)
+        if final:
+            # the latency timeline of the turn starts at the ASR final
+            try:
+                d.set_property_int(
+                    TEXT_DATA_ASR_FINAL_TS_FIELD,
+                    data.get_property_int(TEXT_DATA_ASR_FINAL_TS_FIELD),
+                )
+            except Exception:
+                pass
         ten.send_data(d)
+
+    def on_audio_frame(self, ten: TenEnv, frame: AudioFrame) -> None:
+        # the audio of the agent, from the TTS
+        try:
+            duration_ms = frame.get_samples_per_channel() * 1000 / frame.get_sample_rate()
+        except Exception:
+            duration_ms = 10
+        self.detector.on_agent_audio(duration_ms, now_ms())
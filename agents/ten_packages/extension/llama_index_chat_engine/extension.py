@@ -16,6 +16,17 @@ from ten import (
 from .log import logger
 from .astra_llm import ASTRALLM
 from .astra_retriever import ASTRARetriever
+from .speculative import Speculator, TurnOutput
+from .turn_timeline import (
+    DATA_PROPERTY_TURN_ID,
+    STAGE_ASR_FINAL,
+    STAGE_FIRST_SENTENCE,
+    STAGE_FIRST_TOKEN,
+    STAGE_FLUSH,
+    STAGE_LLM_REQUEST,
+    TimelineRecorder,
+    get_asr_final_ms,
+)
 import queue, threading
 from datetime import datetime
 from llama_index.core.chat_engine import SimpleChatEngine, ContextChatEngine
@@ -24,6 +35,9 @@ from llama_index.core.memory import ChatMemoryBuffer
 
 PROPERTY_CHAT_MEMORY_TOKEN_LIMIT = "chat_memory_token_limit"
 PROPERTY_GREETING = "greeting"
+PROPERTY_SPECULATIVE_COMPLETION = "speculative_completion"
+PROPERTY_SPECULATIVE_STABLE_MS = "speculative_stable_ms"
+PROPERTY_TIMELINE_PATH = "timeline_path"
 
 TASK_TYPE_CHAT_REQUEST = "chat_request"
 TASK_TYPE_GREETING = "greeting"
@@ -42,12 +56,18 @@ class LlamaIndexExtension(Extension):
         self.collection_name = ""
         self.chat_memory_token_limit = 3000
         self.chat_memory = None
+        self.speculator = None
+        self.timelines = None
 
-    def _send_text_data(self, ten: TenEnv, text: str, end_of_segment: bool):
+    def _send_text_data(
+        self, ten: TenEnv, text: str, end_of_segment: bool, turn_id: str = ""
+    ):
         try:
             output_data = Data.create("text_data")
             output_data.set_property_string("text", text)
             output_data.set_property_bool("end_of_segment", end_of_segment)
+            if turn_id:
+                output_data.set_property_string(DATA_PROPERTY_TURN_ID, turn_id)
             ten.send_data(output_data)
             logger.info("text [{}] end_of_segment {} sent".format(text, end_of_segment))
         except Exception as err:
@@ -75,6 +95,33 @@ class LlamaIndexExtension(Extension):
                 f"get {PROPERTY_CHAT_MEMORY_TOKEN_LIMIT} property failed, err: {err}"
             )
 
+        try:
+            if ten.get_property_bool(PROPERTY_SPECULATIVE_COMPLETION):
+                stable_ms = 400
+                try:
+                    stable_ms = ten.get_property_int(PROPERTY_SPECULATIVE_STABLE_MS)
+                except Exception as err:
+                    logger.warning(
+                        f"get {PROPERTY_SPECULATIVE_STABLE_MS} property failed, err: {err}"
+                    )
+                self.speculator = Speculator(
+                    stable_ms,
+                    lambda turn: self.queue.put(
+                        (turn.text, datetime.now(), TASK_TYPE_CHAT_REQUEST, turn)
+                    ),
+                )
+        except Exception as err:
+            logger.warning(
+                f"get {PROPERTY_SPECULATIVE_COMPLETION} property failed, err: {err}"
+            )
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH)
+        except Exception as err:
+            logger.warning(f"get {PROPERTY_TIMELINE_PATH} property failed, err: {err}")
+        self.timelines = TimelineRecorder("llama_index_chat_engine", timeline_path)
+
         self.thread = threading.Thread(target=self.async_handle, args=[ten])
         self.thread.start()
 
@@ -94,12 +141,16 @@ class LlamaIndexExtension(Extension):
         logger.info("on_stop")
 
         self.stop = True
+        if self.speculator is not None:
+            self.speculator.cancel()
         self.flush()
         self.queue.put(None)
         if self.thread is not None:
             self.thread.join()
             self.thread = None
         self.chat_memory = None
+        if self.timelines is not None:
+            self.timelines.report()
 
         ten.on_stop_done()
 
@@ -128,14 +179,18 @@ class LlamaIndexExtension(Extension):
             # notify user
             file_chunked_text = "Your document has been processed. You can now start asking questions about your document. "
             # self._send_text_data(ten, file_chunked_text, True)
-            self.queue.put((file_chunked_text, datetime.now(), TASK_TYPE_GREETING))
+            self.queue.put(
+                (file_chunked_text, datetime.now(), TASK_TYPE_GREETING, None)
+            )
         elif cmd_name == "file_chunk":
             self.collection_name = ""  # clear current collection
 
             # notify user
             file_chunk_text = "Your document has been received. Please wait a moment while we process it for you.  "
             # self._send_text_data(ten, file_chunk_text, True)
-            self.queue.put((file_chunk_text, datetime.now(), TASK_TYPE_GREETING))
+            self.queue.put(
+                (file_chunk_text, datetime.now(), TASK_TYPE_GREETING, None)
+            )
         elif cmd_name == "update_querying_collection":
             coll = cmd.get_property_string("collection")
             logger.info(
@@ -153,7 +208,12 @@ class LlamaIndexExtension(Extension):
                 )
             # self._send_text_data(ten, update_querying_collection_text, True)
             self.queue.put(
-                (update_querying_collection_text, datetime.now(), TASK_TYPE_GREETING)
+                (
+                    update_querying_collection_text,
+                    datetime.now(),
+                    TASK_TYPE_GREETING,
+                    None,
+                )
             )
 
         elif cmd_name == "flush":
@@ -166,7 +226,7 @@ class LlamaIndexExtension(Extension):
 
     def on_data(self, ten: TenEnv, data: Data) -> None:
         is_final = data.get_property_bool("is_final")
-        if not is_final:
+        if not is_final and self.speculator is None:
             logger.info("on_data ignore non final")
             return
 
@@ -175,10 +235,28 @@ class LlamaIndexExtension(Extension):
             logger.info("on_data ignore empty text")
             return
 
+        if not is_final:
+            self.speculator.on_partial(inputText)
+            return
+
         ts = datetime.now()
+        final_ms = get_asr_final_ms(data)
 
         logger.info("on_data text [%s], ts [%s]", inputText, ts)
-        self.queue.put((inputText, ts, TASK_TYPE_CHAT_REQUEST))
+        if self.speculator is not None:
+            turn = self.speculator.on_final(inputText)
+            if turn is not None:
+                # the speculative answer is already on its way, let it out
+                turn.commit(ts, final_ms)
+                return
+        self.queue.put(
+            (
+                inputText,
+                ts,
+                TASK_TYPE_CHAT_REQUEST,
+                TurnOutput(inputText, ts, final_ms=final_ms),
+            )
+        )
 
     def async_handle(self, ten: TenEnv):
         logger.info("async_handle started")
@@ -187,9 +265,13 @@ class LlamaIndexExtension(Extension):
                 value = self.queue.get()
                 if value is None:
                     break
-                input_text, ts, task_type = value
+                input_text, ts, task_type, turn = value
 
-                if ts < self.get_outdated_ts():
+                if (
+                    turn.outdated(self.get_outdated_ts())
+                    if turn is not None
+                    else ts < self.get_outdated_ts()
+                ):
                     logger.info(
                         "text [{}] ts [{}] task_type [{}] dropped due to outdated".format(
                             input_text, ts, task_type
@@ -203,73 +285,112 @@ class LlamaIndexExtension(Extension):
                     continue
 
                 logger.info("process input text [%s] ts [%s]", input_text, ts)
-
-                # prepare chat engine
-                chat_engine = None
-                if len(self.collection_name) > 0:
-                    chat_engine = ContextChatEngine.from_defaults(
-                        llm=ASTRALLM(ten=ten),
-                        retriever=ASTRARetriever(ten=ten, coll=self.collection_name),
-                        memory=self.chat_memory,
-                        system_prompt=(
-                            # "You are an expert Q&A system that is trusted around the world.\n"
-                            "You are a voice assistant who talks in a conversational way and can chat with me like my friends. \n"
-                            "I will speak to you in English or Chinese, and you will answer in the corrected and improved version of my text with the language I use. \n"
-                            "Don’t talk like a robot, instead I would like you to talk like a real human with emotions. \n"
-                            "I will use your answer for text-to-speech, so don’t return me any meaningless characters. \n"
-                            "I want you to be helpful, when I’m asking you for advice, give me precise, practical and useful advice instead of being vague. \n"
-                            "When giving me a list of options, express the options in a narrative way instead of bullet points.\n"
-                            "Always answer the query using the provided context information, "
-                            "and not prior knowledge.\n"
-                            "Some rules to follow:\n"
-                            "1. Never directly reference the given context in your answer.\n"
-                            "2. Avoid statements like 'Based on the context, ...' or "
-                            "'The context information ...' or anything along "
-                            "those lines."
-                        ),
-                    )
-                else:
-                    chat_engine = SimpleChatEngine.from_defaults(
-                        llm=ASTRALLM(ten=ten),
-                        system_prompt=(
-                            "You are a voice assistant who talks in a conversational way and can chat with me like my friends. \n"
-                            "I will speak to you in English or Chinese, and you will answer in the corrected and improved version of my text with the language I use. \n"
-                            "Don’t talk like a robot, instead I would like you to talk like a real human with emotions. \n"
-                            "I will use your answer for text-to-speech, so don’t return me any meaningless characters. \n"
-                            "I want you to be helpful, when I’m asking you for advice, give me precise, practical and useful advice instead of being vague. \n"
-                            "When giving me a list of options, express the options in a narrative way instead of bullet points.\n"
-                        ),
-                        memory=self.chat_memory,
-                    )
-
-                resp = chat_engine.stream_chat(input_text)
-                for cur_token in resp.response_gen:
-                    if self.stop:
-                        break
-                    if ts < self.get_outdated_ts():
-                        logger.info(
-                            "stream_chat coming responses dropped due to outdated for input text [%s] ts [%s] ",
-                            input_text,
-                            ts,
-                        )
-                        break
-                    text = str(cur_token)
-
-                    # send out
-                    self._send_text_data(ten, text, False)
-
-                # send out end_of_segment
-                self._send_text_data(ten, "", True)
+                self._chat(ten, input_text, ts, turn)
             except Exception as e:
                 logger.exception(e)
         logger.info("async_handle stoped")
 
+    def _chat(self, ten: TenEnv, input_text: str, ts: datetime, turn: TurnOutput):
+        timeline = self.timelines.begin(input_text)
+        timeline.stamp(
+            STAGE_ASR_FINAL,
+            turn.final_ms if turn.final_ms is not None else ts.timestamp() * 1000,
+        )
+        try:
+            # a pending speculation must not touch the chat memory before it is committed
+            memory = self.chat_memory
+            if turn.pending:
+                memory = ChatMemoryBuffer.from_defaults(
+                    token_limit=self.chat_memory_token_limit,
+                    chat_history=self.chat_memory.get_all(),
+                )
+
+            # prepare chat engine
+            chat_engine = self._create_chat_engine(ten, memory)
+
+            timeline.stamp(STAGE_LLM_REQUEST)
+            resp = chat_engine.stream_chat(input_text)
+            for cur_token in resp.response_gen:
+                if self.stop:
+                    break
+                if turn.outdated(self.get_outdated_ts()):
+                    logger.info(
+                        "stream_chat coming responses dropped due to outdated for input text [%s] ts [%s] ",
+                        input_text,
+                        ts,
+                    )
+                    timeline.stamp(STAGE_FLUSH)
+                    break
+                text = str(cur_token)
+                turn.on_chunk()
+                timeline.stamp(STAGE_FIRST_TOKEN)
+
+                # send out, tokens are not segmented into sentences here
+                turn.emit(self._send_text_data, ten, text, False, timeline.turn_id)
+                timeline.stamp(STAGE_FIRST_SENTENCE)
+
+            if memory is not self.chat_memory:
+                turn.emit(self.chat_memory.set, memory.get_all())
+
+            # send out end_of_segment
+            turn.emit(self._send_text_data, ten, "", True, timeline.turn_id)
+        finally:
+            # a speculative turn that was never committed is not a turn of the user
+            if turn.final_ms is not None:
+                timeline.stamps[STAGE_ASR_FINAL] = turn.final_ms
+                timeline.finish()
+
+    def _create_chat_engine(self, ten: TenEnv, memory):
+        chat_engine = None
+        if len(self.collection_name) > 0:
+            chat_engine = ContextChatEngine.from_defaults(
+                llm=ASTRALLM(ten=ten),
+                retriever=ASTRARetriever(ten=ten, coll=self.collection_name),
+                memory=memory,
+                system_prompt=(
+                    # "You are an expert Q&A system that is trusted around the world.\n"
+                    "You are a voice assistant who talks in a conversational way and can chat with me like my friends. \n"
+                    "I will speak to you in English or Chinese, and you will answer in the corrected and improved version of my text with the language I use. \n"
+                    "Don’t talk like a robot, instead I would like you to talk like a real human with emotions. \n"
+                    "I will use your answer for text-to-speech, so don’t return me any meaningless characters. \n"
+                    "I want you to be helpful, when I’m asking you for advice, give me precise, practical and useful advice instead of being vague. \n"
+                    "When giving me a list of options, express the options in a narrative way instead of bullet points.\n"
+                    "Always answer the query using the provided context information, "
+                    "and not prior knowledge.\n"
+                    "Some rules to follow:\n"
+                    "1. Never directly reference the given context in your answer.\n"
+                    "2. Avoid statements like 'Based on the context, ...' or "
+                    "'The context information ...' or anything along "
+                    "those lines."
+                ),
+            )
+        else:
+            chat_engine = SimpleChatEngine.from_defaults(
+                llm=ASTRALLM(ten=ten),
+                system_prompt=(
+                    "You are a voice assistant who talks in a conversational way and can chat with me like my friends. \n"
+                    "I will speak to you in English or Chinese, and you will answer in the corrected and improved version of my text with the language I use. \n"
+                    "Don’t talk like a robot, instead I would like you to talk like a real human with emotions. \n"
+                    "I will use your answer for text-to-speech, so don’t return me any meaningless characters. \n"
+                    "I want you to be helpful, when I’m asking you for advice, give me precise, practical and useful advice instead of being vague. \n"
+                    "When giving me a list of options, express the options in a narrative way instead of bullet points.\n"
+                ),
+                memory=memory,
+            )
+        return chat_engine
+
     def flush(self):
         with self.outdate_ts_lock:
             self.outdate_ts = datetime.now()
 
+        # pending speculative turns outlive flushes, see TurnOutput.outdated
+        kept = []
         while not self.queue.empty():
-            self.queue.get()
+            value = self.queue.get()
+            if value is not None and value[3] is not None and value[3].pending:
+                kept.append(value)
+        for value in kept:
+            self.queue.put(value)
 
     def get_outdated_ts(self):
         with self.outdate_ts_lock:
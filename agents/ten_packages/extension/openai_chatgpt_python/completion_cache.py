@@ -0,0 +1,133 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .log import logger
+from .speculative import normalize_text
+
+
+class CompletionCache:
+    """
+    Cache of completed answers, stored as the sentences that were sent.
+
+    Entries live in an in-memory LRU with a TTL. With a path, entries are
+    also written through to a sqlite file, which serves memory misses and
+    survives restarts.
+    """
+
+    def __init__(self, capacity: int = 256, ttl_s: int = 3600, path: str = ""):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS completions "
+                    "(key TEXT PRIMARY KEY, expires REAL, sentences TEXT)"
+                )
+                self.db.execute(
+                    "DELETE FROM completions WHERE expires < ?", (time.time(),)
+                )
+                self.db.commit()
+            except Exception as e:
+                logger.warning(f"open completion cache {path} failed, err: {e}")
+                self.db = None
+
+    @staticmethod
+    def make_key(
+        model: str, prompt: str, input_text: str, memory: List[Dict[str, Any]], tools: Any = None
+    ) -> str:
+        digest = hashlib.sha256()
+        digest.update(
+            json.dumps(
+                [model, prompt, normalize_text(input_text), memory, tools],
+                ensure_ascii=False,
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._insert(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key: str, sentences: List[str]) -> None:
+        entry = (time.time() + self.ttl_s, list(sentences))
+        with self.lock:
+            self._insert(key, entry)
+            if self.db is not None:
+                try:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO completions VALUES (?, ?, ?)",
+                        (key, entry[0], json.dumps(entry[1], ensure_ascii=False)),
+                    )
+                    self.db.commit()
+                except Exception as e:
+                    logger.warning(f"write completion cache failed, err: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def _insert(self, key: str, entry: tuple) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def _load(self, key: str, now: float) -> Optional[tuple]:
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute(
+                "SELECT expires, sentences FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+        except Exception as e:
+            logger.warning(f"read completion cache failed, err: {e}")
+            return None
+        if row is None or row[0] < now:
+            return None
+        return (row[0], json.loads(row[1]))
@@ -0,0 +1,170 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+import asyncio
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from .log import logger
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# request extension marking the preconnect and keepalive pings, which are not
+# counted as requests
+WARMUP_EXTENSION = "warmup"
+
+
+class TracingTransport(httpx.AsyncHTTPTransport):
+    """
+    Counts for every request whether the pool had to open a new connection,
+    using the httpcore trace extension.
+    """
+
+    def __init__(self, pool: "PooledTransport", **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        connected = False
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal connected
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+
+        warmup = bool(request.extensions.pop(WARMUP_EXTENSION, False))
+        request.extensions["trace"] = trace
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            self.pool.on_request(connected, warmup)
+
+
+class PooledTransport:
+    """
+    Shared keep-alive connection pool of an OpenAI client.
+
+    Uses HTTP/2 when the h2 package is installed and routes through proxy_url
+    if set. preconnect opens a connection ahead of the first turn, and the
+    keepalive task pings the base url after keepalive_interval_s of idleness,
+    so turns never pay DNS and TLS setup.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        proxy_url: str = "",
+        max_connections: int = 4,
+        keepalive_interval_s: int = 30,
+        timeout_s: float = 60,
+    ):
+        self.base_url = base_url
+        self.keepalive_interval_s = keepalive_interval_s
+        self.http2 = HTTP2_AVAILABLE
+        self.keepalive_task: Optional[asyncio.Task] = None
+        self.last_used = 0.0
+
+        self.requests = 0
+        self.connections = 0
+        self.pings = 0
+        self.warmup_connections = 0
+
+        # the pool must keep idle connections longer than the ping interval
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=max(keepalive_interval_s * 2, 60),
+        )
+        transport = TracingTransport(
+            self,
+            http2=self.http2,
+            limits=limits,
+            proxy=proxy_url or None,
+        )
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(timeout_s, connect=5.0),
+        )
+
+    def on_request(self, connected: bool, warmup: bool = False) -> None:
+        # pings count as use too, the keepalive task waits a full interval
+        # after each one
+        self.last_used = time.monotonic()
+        if warmup:
+            if connected:
+                self.warmup_connections += 1
+            return
+        self.requests += 1
+        if connected:
+            self.connections += 1
+
+    async def preconnect(self) -> None:
+        """
+        Open a pooled connection, any response will do.
+        """
+        start = time.monotonic()
+        try:
+            await self.client.head(
+                self.base_url, extensions={WARMUP_EXTENSION: True}
+            )
+            logger.info(
+                "preconnect to {} done in {:.0f}ms, http2: {}".format(
+                    self.base_url, (time.monotonic() - start) * 1000, self.http2
+                )
+            )
+        except Exception as e:
+            logger.warning(f"preconnect to {self.base_url} failed, err: {e}")
+
+    def start_keepalive(self) -> None:
+        """
+        Start the keepalive task, must be called on the loop of the client.
+        """
+        if self.keepalive_interval_s > 0 and self.keepalive_task is None:
+            self.keepalive_task = asyncio.ensure_future(self._keepalive())
+
+    async def _keepalive(self) -> None:
+        while True:
+            idle = time.monotonic() - self.last_used
+            if idle < self.keepalive_interval_s:
+                await asyncio.sleep(self.keepalive_interval_s - idle)
+                continue
+            self.pings += 1
+            try:
+                await self.client.head(
+                    self.base_url, extensions={WARMUP_EXTENSION: True}
+                )
+            except Exception as e:
+                logger.warning(f"keepalive ping to {self.base_url} failed, err: {e}")
+                await asyncio.sleep(self.keepalive_interval_s)
+
+    async def close(self) -> None:
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        requests, connections and reuse are of the completion requests only,
+        warmup_connections are the connections preconnect and the pings opened.
+        """
+        reused = self.requests - self.connections
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "reused": reused,
+            "reuse_rate": reused / self.requests if self.requests else 0.0,
+            "pings": self.pings,
+            "warmup_connections": self.warmup_connections,
+            "http2": self.http2,
+        }
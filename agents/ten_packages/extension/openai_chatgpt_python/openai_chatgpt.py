@@ -1,7 +1,7 @@
 import random
-import requests
-from openai import OpenAI
+from openai import AsyncOpenAI
 from typing import List, Dict, Any, Optional
+from .http_transport import PooledTransport
 from .log import logger
 
 
@@ -17,7 +17,9 @@ class OpenAIChatGPTConfig:
             temperature: float, 
             max_tokens: int, 
             seed: Optional[int] = None, 
-            proxy_url: Optional[str] = None):
+            proxy_url: Optional[str] = None,
+            max_connections: int = 4,
+            keepalive_interval_s: int = 30):
         self.base_url = base_url
         self.api_key = api_key
         self.model = model
@@ -29,6 +31,8 @@ class OpenAIChatGPTConfig:
         self.max_tokens = max_tokens
         self.seed = seed if seed is not None else random.randint(0, 10000)
         self.proxy_url = proxy_url
+        self.max_connections = max_connections
+        self.keepalive_interval_s = keepalive_interval_s
 
     @classmethod
     def default_config(cls):
@@ -43,7 +47,9 @@ class OpenAIChatGPTConfig:
             temperature=0.1,
             max_tokens=512,
             seed=random.randint(0, 10000),
-            proxy_url=""
+            proxy_url="",
+            max_connections=4,
+            keepalive_interval_s=30
         )
     
 
@@ -52,20 +58,20 @@ class OpenAIChatGPT:
     def __init__(self, config: OpenAIChatGPTConfig):
         self.config = config
         logger.info(f"OpenAIChatGPT initialized with config: {config.api_key}")
-        self.client = OpenAI(
+        # the client sends every request over this pool, proxy included
+        self.transport = PooledTransport(
+            config.base_url,
+            config.proxy_url,
+            config.max_connections,
+            config.keepalive_interval_s,
+        )
+        self.client = AsyncOpenAI(
             api_key=config.api_key,
-            base_url=config.base_url
+            base_url=config.base_url,
+            http_client=self.transport.client,
         )
-        self.session = requests.Session()
-        if config.proxy_url:
-            proxies = {
-                "http": config.proxy_url,
-                "https": config.proxy_url,
-            }
-            self.session.proxies.update(proxies)
-        self.client.session = self.session
 
-    def get_chat_completions_stream(self, messages, tools = None):
+    async def get_chat_completions_stream(self, messages, tools = None):
         req = {
             "model": self.config.model,
             "messages": [
@@ -86,7 +92,7 @@ class OpenAIChatGPT:
         }
 
         try:
-            response = self.client.chat.completions.create(**req)
+            response = await self.client.chat.completions.create(**req)
             return response
         except Exception as e:
             raise Exception(f"CreateChatCompletionStream failed, err: {e}")
\ No newline at end of file
@@ -5,11 +5,17 @@
 # Copyright (c) 2024 Agora IO. All rights reserved.
 #
 #
+import asyncio
 import json
 import random
 import traceback
 from ten.video_frame import VideoFrame
 from .openai_chatgpt import OpenAIChatGPT, OpenAIChatGPTConfig
+from .completion_cache import CompletionCache
+from .conversation_memory import ConversationMemory
+from .inflight_streams import InflightStreams
+from .speculative import Speculator, TurnOutput
+from .sentence_segmenter import SentenceSegmenter, get_punctuations
 from datetime import datetime
 from threading import Thread
 from ten import (
@@ -23,10 +29,18 @@ from ten import (
     CmdResult,
 )
 from .log import logger
-from base64 import b64encode
-import numpy as np
-from io import BytesIO
-from PIL import Image
+from .tools import ToolCallAssembler, ToolRegistry
+from .turn_timeline import (
+    STAGE_ASR_FINAL,
+    STAGE_FIRST_SENTENCE,
+    STAGE_FIRST_TOKEN,
+    STAGE_FLUSH,
+    DATA_PROPERTY_TURN_ID,
+    STAGE_LLM_REQUEST,
+    get_asr_final_ms,
+    TimelineRecorder,
+)
+from .vision_frame import VisionFrameBuffer, VisionTool
 
 
 CMD_IN_FLUSH = "flush"
@@ -49,7 +63,25 @@ PROPERTY_GREETING = "greeting"  # Optional
 PROPERTY_ENABLE_TOOLS = "enable_tools"  # Optional
 PROPERTY_PROXY_URL = "proxy_url"  # Optional
 PROPERTY_MAX_MEMORY_LENGTH = "max_memory_length"  # Optional
+PROPERTY_MAX_MEMORY_TOKENS = "max_memory_tokens"  # Optional
 PROPERTY_CHECKING_VISION_TEXT_ITEMS = "checking_vision_text_items"  # Optional
+PROPERTY_SENTENCE_LANGUAGE = "sentence_language"  # Optional
+PROPERTY_MIN_SENTENCE_LENGTH = "min_sentence_length"  # Optional
+PROPERTY_MAX_PENDING_TURNS = "max_pending_turns"  # Optional
+PROPERTY_VISION_MAX_SIZE = "vision_max_size"  # Optional
+PROPERTY_VISION_FRAME_INTERVAL_MS = "vision_frame_interval_ms"  # Optional
+PROPERTY_SPECULATIVE_COMPLETION = "speculative_completion"  # Optional
+PROPERTY_SPECULATIVE_STABLE_MS = "speculative_stable_ms"  # Optional
+PROPERTY_COMPLETION_CACHE_SIZE = "completion_cache_size"  # Optional
+PROPERTY_COMPLETION_CACHE_TTL_S = "completion_cache_ttl_s"  # Optional
+PROPERTY_COMPLETION_CACHE_PATH = "completion_cache_path"  # Optional
+PROPERTY_COMPLETION_CACHE_REPLAY_INTERVAL_MS = "completion_cache_replay_interval_ms"  # Optional
+PROPERTY_HTTP_MAX_CONNECTIONS = "http_max_connections"  # Optional
+PROPERTY_HTTP_KEEPALIVE_INTERVAL_S = "http_keepalive_interval_s"  # Optional
+PROPERTY_TOOLS = "tools"  # Optional
+PROPERTY_TOOL_POOL_SIZE = "tool_pool_size"  # Optional
+PROPERTY_TOOL_TIMEOUT_MS = "tool_timeout_ms"  # Optional
+PROPERTY_TIMELINE_PATH = "timeline_path"  # Optional
 
 
 def get_current_time():
@@ -60,111 +92,31 @@ def get_current_time():
     return unix_microseconds
 
 
-def is_punctuation(char):
-    if char in [",", "，", ".", "。", "?", "？", "!", "！"]:
-        return True
-    return False
-
-
-def parse_sentence(sentence, content):
-    remain = ""
-    found_punc = False
-
-    for char in content:
-        if not found_punc:
-            sentence += char
-        else:
-            remain += char
-
-        if not found_punc and is_punctuation(char):
-            found_punc = True
-
-    return sentence, remain, found_punc
-
-
-def rgb2base64jpeg(rgb_data, width, height):
-    # Convert the RGB image to a PIL Image
-    pil_image = Image.frombytes("RGBA", (width, height), bytes(rgb_data))
-    pil_image = pil_image.convert("RGB")
-
-    # Resize the image while maintaining its aspect ratio
-    pil_image = resize_image_keep_aspect(pil_image, 320)
-
-    # Save the image to a BytesIO object in JPEG format
-    buffered = BytesIO()
-    pil_image.save(buffered, format="JPEG")
-    # pil_image.save("test.jpg", format="JPEG")
-
-    # Get the byte data of the JPEG image
-    jpeg_image_data = buffered.getvalue()
-
-    # Convert the JPEG byte data to a Base64 encoded string
-    base64_encoded_image = b64encode(jpeg_image_data).decode("utf-8")
-
-    # Create the data URL
-    mime_type = "image/jpeg"
-    base64_url = f"data:{mime_type};base64,{base64_encoded_image}"
-    return base64_url
-
-
-def resize_image_keep_aspect(image, max_size=512):
-    """
-    Resize an image while maintaining its aspect ratio, ensuring the larger dimension is max_size.
-    If both dimensions are smaller than max_size, the image is not resized.
-
-    :param image: A PIL Image object
-    :param max_size: The maximum size for the larger dimension (width or height)
-    :return: A PIL Image object (resized or original)
-    """
-    # Get current width and height
-    width, height = image.size
-
-    # If both dimensions are already smaller than max_size, return the original image
-    if width <= max_size and height <= max_size:
-        return image
-
-    # Calculate the aspect ratio
-    aspect_ratio = width / height
-
-    # Determine the new dimensions
-    if width > height:
-        new_width = max_size
-        new_height = int(max_size / aspect_ratio)
-    else:
-        new_height = max_size
-        new_width = int(max_size * aspect_ratio)
-
-    # Resize the image with the new dimensions
-    resized_image = image.resize((new_width, new_height))
-
-    return resized_image
-
-
 class OpenAIChatGPTExtension(Extension):
-    memory = []
+    memory = None
     max_memory_length = 10
+    max_memory_tokens = 2048
     outdate_ts = 0
     openai_chatgpt = None
     enable_tools = False
-    image_data = None
-    image_width = 0
-    image_height = 0
+    vision_frames = None
     checking_vision_text_items = []
-
-    available_tools = [
-        {
-            "type": "function",
-            "function": {
-                # ensure you use gpt-4o or later model if you need image recognition, gpt-4o-mini does not work quite well in this case
-                "name": "get_vision_image",
-                "description": "Get the image from camera. Call this whenever you need to understand the input camera image like you have vision capability, for example when user asks 'What can you see?' or 'Can you see me?'",
-            },
-            "strict": True,
-        }
-    ]
+    sentence_punctuations = get_punctuations("default")
+    min_sentence_length = 0
+    max_pending_turns = 3
+    loop = None
+    thread = None
+    queue = None
+    inflight_streams = None
+    speculator = None
+    tools = None
+    timelines = None
+    completion_cache = None
+    completion_cache_replay_interval_ms = 50
 
     def on_start(self, ten: TenEnv) -> None:
         logger.info("OpenAIChatGPTExtension on_start")
+        self.inflight_streams = InflightStreams()
         # Prepare configuration
         openai_chatgpt_config = OpenAIChatGPTConfig.default_config()
 
@@ -241,6 +193,28 @@ class OpenAIChatGPTExtension(Extension):
         except Exception as err:
             logger.info(f"GetProperty optional {PROPERTY_PROXY_URL} failed, err: {err}")
 
+        try:
+            http_max_connections = ten.get_property_int(PROPERTY_HTTP_MAX_CONNECTIONS)
+            if http_max_connections > 0:
+                openai_chatgpt_config.max_connections = int(http_max_connections)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_HTTP_MAX_CONNECTIONS} failed, err: {err}"
+            )
+
+        try:
+            http_keepalive_interval_s = ten.get_property_int(
+                PROPERTY_HTTP_KEEPALIVE_INTERVAL_S
+            )
+            if http_keepalive_interval_s >= 0:
+                openai_chatgpt_config.keepalive_interval_s = int(
+                    http_keepalive_interval_s
+                )
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_HTTP_KEEPALIVE_INTERVAL_S} failed, err: {err}"
+            )
+
         try:
             greeting = ten.get_property_string(PROPERTY_GREETING)
         except Exception as err:
@@ -262,6 +236,19 @@ class OpenAIChatGPTExtension(Extension):
                 f"GetProperty optional {PROPERTY_MAX_MEMORY_LENGTH} failed, err: {err}"
             )
 
+        try:
+            prop_max_memory_tokens = ten.get_property_int(PROPERTY_MAX_MEMORY_TOKENS)
+            if prop_max_memory_tokens > 0:
+                self.max_memory_tokens = int(prop_max_memory_tokens)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_MAX_MEMORY_TOKENS} failed, err: {err}"
+            )
+
+        self.memory = ConversationMemory(
+            self.max_memory_tokens, self.max_memory_length
+        )
+
         try:
             checking_vision_text_items_str = ten.get_property_string(PROPERTY_CHECKING_VISION_TEXT_ITEMS)
             self.checking_vision_text_items = json.loads(checking_vision_text_items_str)
@@ -270,15 +257,197 @@ class OpenAIChatGPTExtension(Extension):
                 f"GetProperty optional {PROPERTY_CHECKING_VISION_TEXT_ITEMS} failed, err: {err}"
             )
 
+        vision_max_size = 320
+        try:
+            prop_vision_max_size = ten.get_property_int(PROPERTY_VISION_MAX_SIZE)
+            if prop_vision_max_size > 0:
+                vision_max_size = int(prop_vision_max_size)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_VISION_MAX_SIZE} failed, err: {err}"
+            )
+
+        vision_frame_interval_ms = 300
+        try:
+            prop_vision_frame_interval_ms = ten.get_property_int(PROPERTY_VISION_FRAME_INTERVAL_MS)
+            if prop_vision_frame_interval_ms > 0:
+                vision_frame_interval_ms = int(prop_vision_frame_interval_ms)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_VISION_FRAME_INTERVAL_MS} failed, err: {err}"
+            )
+
+        # frames are only read by the vision tool
+        if self.enable_tools:
+            self.vision_frames = VisionFrameBuffer(vision_max_size, vision_frame_interval_ms)
+            self.vision_frames.start()
+
+        tool_pool_size = 4
+        try:
+            prop_tool_pool_size = ten.get_property_int(PROPERTY_TOOL_POOL_SIZE)
+            if prop_tool_pool_size > 0:
+                tool_pool_size = int(prop_tool_pool_size)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_TOOL_POOL_SIZE} failed, err: {err}"
+            )
+
+        tool_timeout_ms = 10000
+        try:
+            prop_tool_timeout_ms = ten.get_property_int(PROPERTY_TOOL_TIMEOUT_MS)
+            if prop_tool_timeout_ms > 0:
+                tool_timeout_ms = int(prop_tool_timeout_ms)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_TOOL_TIMEOUT_MS} failed, err: {err}"
+            )
+
+        self.tools = ToolRegistry(tool_pool_size, tool_timeout_ms)
+        if self.enable_tools:
+            self.tools.register(
+                VisionTool(self.vision_frames, self.checking_vision_text_items)
+            )
+
+        try:
+            tools_config = ten.get_property_string(PROPERTY_TOOLS)
+            if tools_config:
+                self.tools.load(tools_config)
+        except Exception as err:
+            logger.info(f"GetProperty optional {PROPERTY_TOOLS} failed, err: {err}")
+
+        try:
+            sentence_language = ten.get_property_string(PROPERTY_SENTENCE_LANGUAGE)
+            self.sentence_punctuations = get_punctuations(sentence_language)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_SENTENCE_LANGUAGE} failed, err: {err}"
+            )
+
+        try:
+            min_sentence_length = ten.get_property_int(PROPERTY_MIN_SENTENCE_LENGTH)
+            if min_sentence_length > 0:
+                self.min_sentence_length = int(min_sentence_length)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_MIN_SENTENCE_LENGTH} failed, err: {err}"
+            )
+
+        try:
+            max_pending_turns = ten.get_property_int(PROPERTY_MAX_PENDING_TURNS)
+            if max_pending_turns > 0:
+                self.max_pending_turns = int(max_pending_turns)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_MAX_PENDING_TURNS} failed, err: {err}"
+            )
+
+        speculative_completion = False
+        try:
+            speculative_completion = ten.get_property_bool(
+                PROPERTY_SPECULATIVE_COMPLETION
+            )
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_SPECULATIVE_COMPLETION} failed, err: {err}"
+            )
+
+        speculative_stable_ms = 400
+        try:
+            prop_speculative_stable_ms = ten.get_property_int(
+                PROPERTY_SPECULATIVE_STABLE_MS
+            )
+            if prop_speculative_stable_ms > 0:
+                speculative_stable_ms = int(prop_speculative_stable_ms)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_SPECULATIVE_STABLE_MS} failed, err: {err}"
+            )
+
+        if speculative_completion:
+            self.speculator = Speculator(
+                speculative_stable_ms,
+                lambda turn: self.loop.call_soon_threadsafe(self.put_turn, turn),
+            )
+
+        completion_cache_size = 0
+        try:
+            completion_cache_size = int(
+                ten.get_property_int(PROPERTY_COMPLETION_CACHE_SIZE)
+            )
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_COMPLETION_CACHE_SIZE} failed, err: {err}"
+            )
+
+        completion_cache_ttl_s = 3600
+        try:
+            prop_completion_cache_ttl_s = ten.get_property_int(
+                PROPERTY_COMPLETION_CACHE_TTL_S
+            )
+            if prop_completion_cache_ttl_s > 0:
+                completion_cache_ttl_s = int(prop_completion_cache_ttl_s)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_COMPLETION_CACHE_TTL_S} failed, err: {err}"
+            )
+
+        completion_cache_path = ""
+        try:
+            completion_cache_path = ten.get_property_string(
+                PROPERTY_COMPLETION_CACHE_PATH
+            )
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_COMPLETION_CACHE_PATH} failed, err: {err}"
+            )
+
+        try:
+            prop_replay_interval_ms = ten.get_property_int(
+                PROPERTY_COMPLETION_CACHE_REPLAY_INTERVAL_MS
+            )
+            if prop_replay_interval_ms >= 0:
+                self.completion_cache_replay_interval_ms = int(prop_replay_interval_ms)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_COMPLETION_CACHE_REPLAY_INTERVAL_MS} failed, err: {err}"
+            )
+
+        if completion_cache_size > 0:
+            self.completion_cache = CompletionCache(
+                completion_cache_size, completion_cache_ttl_s, completion_cache_path
+            )
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH)
+        except Exception as err:
+            logger.info(
+                f"GetProperty optional {PROPERTY_TIMELINE_PATH} failed, err: {err}"
+            )
+        self.timelines = TimelineRecorder("openai_chatgpt_python", timeline_path)
+
         # Create openaiChatGPT instance
         try:
             self.openai_chatgpt = OpenAIChatGPT(openai_chatgpt_config)
             logger.info(
                 f"newOpenaiChatGPT succeed with max_tokens: {openai_chatgpt_config.max_tokens}, model: {openai_chatgpt_config.model}"
             )
+            self.inflight_streams.default_completion_tokens = (
+                openai_chatgpt_config.max_tokens
+            )
         except Exception as err:
             logger.info(f"newOpenaiChatGPT failed, err: {err}")
 
+        # All turns of this extension run on a single event loop, one at a time
+        self.loop = asyncio.new_event_loop()
+        self.queue = asyncio.Queue(maxsize=self.max_pending_turns)
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.async_handle(ten), self.loop)
+        if self.openai_chatgpt is not None:
+            # warm the connection pool so the first turn does not pay for it
+            asyncio.run_coroutine_threadsafe(self.prepare_transport(), self.loop)
+
         # Send greeting if available
         if greeting:
             try:
@@ -297,11 +466,89 @@ class OpenAIChatGPTExtension(Extension):
 
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("OpenAIChatGPTExtension on_stop")
+        if self.speculator is not None:
+            self.speculator.cancel()
+        if self.loop is not None:
+            self.outdate_ts = get_current_time()
+            self.inflight_streams.cancel_all()
+            self.loop.call_soon_threadsafe(self.put_turn, None)
+            self.thread.join()
+            self.loop.close()
+            if self.openai_chatgpt is not None:
+                logger.info(
+                    f"http transport stats: {self.openai_chatgpt.transport.stats()}"
+                )
+            self.loop = None
+            self.thread = None
+        if self.vision_frames is not None:
+            logger.info(f"vision frames stats: {self.vision_frames.stats()}")
+            self.vision_frames.stop()
+        if self.timelines is not None:
+            self.timelines.report()
+        if self.tools is not None:
+            logger.info(f"tools stats: {self.tools.stats()}")
+            self.tools.close()
+        if self.completion_cache is not None:
+            logger.info(f"completion cache stats: {self.completion_cache.stats()}")
+            self.completion_cache.close()
         ten.on_stop_done()
 
+    def put_turn(self, turn):
+        """
+        Enqueue a turn from the event loop thread. When the queue is full the
+        oldest pending turn is dropped, the newest utterance is the one to answer.
+        """
+        if turn is None:
+            self.clear_turns()
+        elif self.queue.full():
+            dropped = self.queue.get_nowait()
+            logger.info(f"pending turns full, drop input text: [{dropped.text}]")
+        self.queue.put_nowait(turn)
+
+    def clear_turns(self):
+        # pending speculative turns outlive flushes, see TurnOutput.outdated
+        kept = []
+        while not self.queue.empty():
+            turn = self.queue.get_nowait()
+            if turn is not None and turn.pending:
+                kept.append(turn)
+        for turn in kept:
+            self.queue.put_nowait(turn)
+
+    async def prepare_transport(self):
+        transport = self.openai_chatgpt.transport
+        await transport.preconnect()
+        transport.start_keepalive()
+
+    async def async_handle(self, ten: TenEnv):
+        while True:
+            turn = await self.queue.get()
+            if turn is None:
+                break
+
+            input_text = turn.text
+            if turn.outdated(self.outdate_ts):
+                logger.info(f"drop outdated input text: [{input_text}]")
+                continue
+
+            # a speculative turn has no start time until it is committed
+            start_time = turn.start_ts if turn.start_ts is not None else get_current_time()
+
+            # each turn runs in its own task so flush can cancel it alone
+            try:
+                await asyncio.ensure_future(
+                    self.chat_completion(
+                        ten, start_time, input_text, self.memory.messages(), turn
+                    )
+                )
+            except asyncio.CancelledError:
+                logger.info(f"turn cancelled for input text: [{input_text}]")
+
+        if self.openai_chatgpt is not None:
+            await self.openai_chatgpt.transport.close()
+        self.loop.stop()
+
     def append_memory(self, message):
-        if len(self.memory) > self.max_memory_length:
-            self.memory.pop(0)
         self.memory.append(message)
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
@@ -313,6 +560,10 @@ class OpenAIChatGPTExtension(Extension):
 
         if cmd_name == CMD_IN_FLUSH:
             self.outdate_ts = get_current_time()
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.clear_turns)
+            self.inflight_streams.cancel_all(self.outdate_ts)
+            logger.info(f"in-flight streams stats: {self.inflight_streams.stats()}")
             cmd_out = Cmd.create(CMD_OUT_FLUSH)
             ten.send_cmd(cmd_out, None)
             logger.info(f"OpenAIChatGPTExtension on_cmd sent flush")
@@ -329,10 +580,14 @@ class OpenAIChatGPTExtension(Extension):
 
     def on_video_frame(self, ten_env: TenEnv, frame: VideoFrame) -> None:
         # logger.info(f"OpenAIChatGPTExtension on_video_frame {frame.get_width()} {frame.get_height()}")
-        self.image_data = frame.get_buf()
-        self.image_width = frame.get_width()
-        self.image_height = frame.get_height()
-        return
+        if self.vision_frames is None:
+            return
+        try:
+            self.vision_frames.put(
+                frame.get_buf(), frame.get_width(), frame.get_height()
+            )
+        except Exception as err:
+            logger.warning(f"on_video_frame put frame failed, err: {err}")
 
     def on_data(self, ten: TenEnv, data: Data) -> None:
         """
@@ -347,7 +602,7 @@ class OpenAIChatGPTExtension(Extension):
         # Assume 'data' is an object from which we can get properties
         try:
             is_final = data.get_property_bool(DATA_IN_TEXT_DATA_PROPERTY_IS_FINAL)
-            if not is_final:
+            if not is_final and self.speculator is None:
                 logger.info("ignore non-final input")
                 return
         except Exception as err:
@@ -369,25 +624,38 @@ class OpenAIChatGPTExtension(Extension):
             )
             return
 
-        def chat_completions_stream_worker(start_time, input_text, memory):
-            self.chat_completion(ten, start_time, input_text, memory)
+        if self.loop is None:
+            logger.info("ignore input text, extension not started")
+            return
+
+        if not is_final:
+            self.speculator.on_partial(input_text)
+            return
 
-        # Start thread to request and read responses from OpenAI
         start_time = get_current_time()
-        thread = Thread(
-            target=chat_completions_stream_worker,
-            args=(start_time, input_text, self.memory),
+        final_ms = get_asr_final_ms(data)
+        if self.speculator is not None:
+            turn = self.speculator.on_final(input_text)
+            if turn is not None:
+                # the speculative answer is already on its way, let it out
+                turn.commit(start_time, final_ms)
+                return
+
+        # Queue the turn, the event loop answers turns in arrival order
+        self.loop.call_soon_threadsafe(
+            self.put_turn, TurnOutput(input_text, start_time, final_ms=final_ms)
         )
-        thread.start()
         logger.info(f"OpenAIChatGPTExtension on_data end")
 
-    def send_data(self, ten, sentence, end_of_segment, input_text):
+    def send_data(self, ten, sentence, end_of_segment, input_text, turn_id=""):
         try:
             output_data = Data.create("text_data")
             output_data.set_property_string(DATA_OUT_TEXT_DATA_PROPERTY_TEXT, sentence)
             output_data.set_property_bool(
                 DATA_OUT_TEXT_DATA_PROPERTY_TEXT_END_OF_SEGMENT, end_of_segment
             )
+            if turn_id:
+                output_data.set_property_string(DATA_PROPERTY_TURN_ID, turn_id)
             ten.send_data(output_data)
             logger.info(
                 f"for input text: [{input_text}] {'end of segment ' if end_of_segment else ''}sent sentence [{sentence}]"
@@ -397,102 +665,225 @@ class OpenAIChatGPTExtension(Extension):
                 f"for input text: [{input_text}] send sentence [{sentence}] failed, err: {err}"
             )
 
-    def process_completions(
-        self, chat_completions, ten, start_time, input_text, memory
+    async def process_completions(
+        self, chat_completions, ten, start_time, input_text, memory, turn, timeline
     ):
-        sentence = ""
-        full_content = ""
-        first_sentence_sent = False
-
-        for chat_completion in chat_completions:
-            content = ""
-            if start_time < self.outdate_ts:
+        segmenter = SentenceSegmenter(
+            self.sentence_punctuations, self.min_sentence_length
+        )
+        sentences = []
+
+        content, calls, futures, interrupted = await self.read_completions(
+            chat_completions,
+            ten,
+            start_time,
+            input_text,
+            turn,
+            timeline,
+            segmenter,
+            sentences,
+        )
+        full_content = content
+
+        if calls:
+            # answer with the tool results, the tools are not offered again so
+            # a turn costs one extra round trip at most
+            messages = memory + [
+                {"role": "user", "content": input_text},
+                {
+                    "role": "assistant",
+                    "content": content or None,
+                    "tool_calls": [call.message() for call in calls],
+                },
+            ]
+            messages += await self.tools.results(calls, futures)
+            if turn.outdated(self.outdate_ts):
                 logger.info(
-                    f"recv interrupt and flushing for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
+                    f"recv interrupt after tool calls for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
                 )
-                break
-
-            # content = chat_completion.choices[0].delta.content if len(chat_completion.choices) > 0 and chat_completion.choices[0].delta.content is not None else ""
-            if len(chat_completion.choices) > 0:
-                if chat_completion.choices[0].delta.tool_calls is not None:
-                    for tool_call in chat_completion.choices[0].delta.tool_calls:
-                        logger.info(f"tool_call: {tool_call}")
-                        if tool_call.function.name == "get_vision_image":
-                            if full_content == "" and len(self.checking_vision_text_items) > 0:
-                                # if no text content, send a message to ask user to wait
-                                self.send_data(ten, random.choice(self.checking_vision_text_items), True, input_text)
-                            # for get_vision_image, re-run the completion with vision, memory should not be affected
-                            self.chat_completion_with_vision(
-                                ten, start_time, input_text, memory
-                            )
-                            return
-                elif chat_completion.choices[0].delta.content is not None:
-                    content = chat_completion.choices[0].delta.content
+                interrupted = True
+                timeline.stamp(STAGE_FLUSH)
             else:
-                content = ""
-
-            full_content += content
-
-            while True:
-                sentence, content, sentence_is_final = parse_sentence(sentence, content)
-                if len(sentence) == 0 or not sentence_is_final:
-                    logger.info(f"sentence {sentence} is empty or not final")
-                    break
-                logger.info(
-                    f"recv for input text: [{input_text}] got sentence: [{sentence}]"
+                chat_completions = (
+                    await self.openai_chatgpt.get_chat_completions_stream(messages)
                 )
-                self.send_data(ten, sentence, False, input_text)
-                sentence = ""
-
-                if not first_sentence_sent:
-                    first_sentence_sent = True
-                    logger.info(
-                        f"recv for input text: [{input_text}] first sentence sent, first_sentence_latency {get_current_time() - start_time}ms"
-                    )
+                content, _, _, interrupted = await self.read_completions(
+                    chat_completions,
+                    ten,
+                    start_time,
+                    input_text,
+                    turn,
+                    timeline,
+                    segmenter,
+                    sentences,
+                )
+                full_content += content
 
         # memory is recorded only when completion is completely done, with single pair of user and assistant message
-        self.append_memory({"role": "user", "content": input_text})
-        self.append_memory({"role": "assistant", "content": full_content})
-        self.send_data(ten, sentence, True, input_text)
+        turn.emit(self.append_memory, {"role": "user", "content": input_text})
+        turn.emit(self.append_memory, {"role": "assistant", "content": full_content})
+        last_sentence = segmenter.flush()
+        turn.emit(self.send_data, ten, last_sentence, True, input_text, timeline.turn_id)
+
+        # the sentences of an answer that ran to the end, for the completion cache
+        if interrupted or calls:
+            return None
+        return sentences + [last_sentence]
+
+    async def read_completions(
+        self,
+        chat_completions,
+        ten,
+        start_time,
+        input_text,
+        turn,
+        timeline,
+        segmenter,
+        sentences,
+    ):
+        """
+        Read a completion stream and send its sentences as they complete. A
+        tool call starts running as soon as its arguments are complete.
+        Returns the content, the tool calls and their futures, and whether the
+        stream was interrupted.
+        """
+        content = ""
+        interrupted = False
+        filler_sent = False
+        futures = {}
 
-    def chat_completion_with_vision(self, ten: TenEnv, start_time, input_text, memory):
+        def on_tool_call(call):
+            nonlocal filler_sent
+            logger.info(
+                f"for input text: [{input_text}] tool_call: {call.name}({call.arguments})"
+            )
+            futures[call.index] = self.tools.start(call)
+            tool = self.tools.get(call.name)
+            if content == "" and not filler_sent and tool is not None and tool.filler_texts:
+                # if no text content, send a message to ask user to wait
+                filler_sent = True
+                turn.emit(self.send_data, ten, random.choice(tool.filler_texts), True, input_text, timeline.turn_id)
+
+        assembler = ToolCallAssembler(on_tool_call)
+
+        # flush cancels the reading task, which closes the http response below
+        task = asyncio.current_task()
+        inflight = self.inflight_streams.register(
+            chat_completions,
+            lambda: self.loop.call_soon_threadsafe(task.cancel),
+            start_time,
+            turn,
+        )
         try:
-            logger.info(f"for input text: [{input_text}] memory: {memory}")
-            message = {"role": "user", "content": input_text}
-
-            if self.image_data is not None:
-                url = rgb2base64jpeg(
-                    self.image_data, self.image_width, self.image_height
-                )
-                message = {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": input_text},
-                        {"type": "image_url", "image_url": {"url": url}},
-                    ],
-                }
-                logger.info(f"msg: {message}")
-
-            resp = self.openai_chatgpt.get_chat_completions_stream(memory + [message])
-            if resp is None:
-                logger.error(
-                    f"get_chat_completions_stream Response is None: {input_text}"
+            async for chat_completion in chat_completions:
+                if turn.outdated(self.outdate_ts):
+                    logger.info(
+                        f"recv interrupt and flushing for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
+                    )
+                    interrupted = True
+                    timeline.stamp(STAGE_FLUSH)
+                    break
+                self.inflight_streams.on_chunk(inflight)
+                turn.on_chunk()
+
+                if len(chat_completion.choices) == 0:
+                    continue
+                delta = chat_completion.choices[0].delta
+                if delta.tool_calls is not None or delta.content:
+                    timeline.stamp(STAGE_FIRST_TOKEN)
+                if delta.tool_calls is not None:
+                    assembler.feed(delta.tool_calls)
+                if not delta.content:
+                    continue
+
+                content += delta.content
+                for sentence in segmenter.feed(delta.content):
+                    logger.info(
+                        f"recv for input text: [{input_text}] got sentence: [{sentence}]"
+                    )
+                    turn.emit(self.send_data, ten, sentence, False, input_text, timeline.turn_id)
+                    if not sentences:
+                        timeline.stamp(STAGE_FIRST_SENTENCE)
+                        logger.info(
+                            "recv for input text: [{}] first sentence sent, first_sentence_latency {:.0f}ms".format(
+                                input_text, timeline.since(STAGE_ASR_FINAL)
+                            )
+                        )
+                    sentences.append(sentence)
+        except asyncio.CancelledError:
+            interrupted = True
+            timeline.stamp(STAGE_FLUSH)
+            logger.info(
+                f"recv cancel and closing stream for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
+            )
+        finally:
+            self.inflight_streams.unregister(inflight)
+            await chat_completions.close()
+
+        if interrupted:
+            for future in futures.values():
+                future.cancel()
+            return content, [], {}, True
+        return content, assembler.finish(), futures, False
+
+    async def replay_completion(
+        self, ten: TenEnv, start_time, input_text, sentences, turn, timeline
+    ):
+        """
+        Send a cached answer through the same path as a streamed one, paced by
+        completion_cache_replay_interval_ms so downstream sees a similar flow.
+        """
+        logger.info(
+            f"completion cache hit for input text: [{input_text}], stats: {self.completion_cache.stats()}"
+        )
+        for sentence in sentences[:-1]:
+            if turn.outdated(self.outdate_ts):
+                logger.info(
+                    f"recv interrupt and stop replay for input text: [{input_text}], startTs: {start_time}, outdateTs: {self.outdate_ts}"
                 )
+                timeline.stamp(STAGE_FLUSH)
                 return
+            turn.emit(self.send_data, ten, sentence, False, input_text, timeline.turn_id)
+            timeline.stamp(STAGE_FIRST_SENTENCE)
+            if self.completion_cache_replay_interval_ms > 0:
+                await asyncio.sleep(self.completion_cache_replay_interval_ms / 1000)
+
+        turn.emit(self.append_memory, {"role": "user", "content": input_text})
+        turn.emit(
+            self.append_memory, {"role": "assistant", "content": "".join(sentences)}
+        )
+        turn.emit(self.send_data, ten, sentences[-1], True, input_text, timeline.turn_id)
 
-            self.process_completions(resp, ten, start_time, input_text, memory)
-
-        except Exception as e:
-            logger.error(f"err: {str(e)}: {input_text}")
-
-    def chat_completion(self, ten: TenEnv, start_time, input_text, memory):
+    async def chat_completion(
+        self, ten: TenEnv, start_time, input_text, memory, turn
+    ):
+        timeline = self.timelines.begin(input_text)
+        timeline.stamp(
+            STAGE_ASR_FINAL,
+            turn.final_ms if turn.final_ms is not None else start_time / 1000,
+        )
         try:
             logger.info(f"for input text: [{input_text}] memory: {memory}")
             message = {"role": "user", "content": input_text}
 
-            tools = self.available_tools if self.enable_tools else None
+            tools = self.tools.specs()
             logger.info(f"chat_completion tools: {tools}")
-            resp = self.openai_chatgpt.get_chat_completions_stream(
+
+            cache_key = None
+            if self.completion_cache is not None:
+                config = self.openai_chatgpt.config
+                cache_key = CompletionCache.make_key(
+                    config.model, config.prompt, input_text, memory, tools
+                )
+                sentences = self.completion_cache.get(cache_key)
+                if sentences:
+                    await self.replay_completion(
+                        ten, start_time, input_text, sentences, turn, timeline
+                    )
+                    return
+
+            timeline.stamp(STAGE_LLM_REQUEST)
+            resp = await self.openai_chatgpt.get_chat_completions_stream(
                 memory + [message], tools
             )
             if resp is None:
@@ -501,10 +892,29 @@ class OpenAIChatGPTExtension(Extension):
                 )
                 return
 
-            self.process_completions(resp, ten, start_time, input_text, memory)
+            sentences = await self.process_completions(
+                resp, ten, start_time, input_text, memory, turn, timeline
+            )
+            logger.info(
+                f"for input text: [{input_text}] http transport stats: {self.openai_chatgpt.transport.stats()}"
+            )
+            if cache_key is not None and sentences is not None:
+                self.completion_cache.put(cache_key, sentences)
+                logger.info(
+                    f"completion cache miss for input text: [{input_text}], stats: {self.completion_cache.stats()}"
+                )
 
+        except asyncio.CancelledError:
+            timeline.stamp(STAGE_FLUSH)
+            raise
         except Exception as e:
             logger.error(f"err: {traceback.format_exc()}: {input_text}")
+        finally:
+            # a speculative turn knows when its final transcript came only once
+            # it is committed, one that never was is not a turn of the user
+            if turn.final_ms is not None:
+                timeline.stamps[STAGE_ASR_FINAL] = turn.final_ms
+                timeline.finish()
 
 
 @register_addon_as_extension("openai_chatgpt_python")
@@ -0,0 +1,250 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Speculative completion on stable partial transcripts, shared by the LLM
+# extensions. Every LLM extension ships an identical copy of this file, keep
+# them in sync.
+import re
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .log import logger
+
+TURN_PENDING = "pending"
+TURN_COMMITTED = "committed"
+TURN_CANCELLED = "cancelled"
+
+# scripts written without spaces count a word per character
+_CJK = "\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff"
+_WORDS = re.compile(f"[{_CJK}]|[^\\s{_CJK}]+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lower case text without punctuation and spaces, ASR partials and finals
+    often only differ in those.
+    """
+    return "".join(
+        c
+        for c in text.lower()
+        if not unicodedata.category(c).startswith(("P", "Z", "C"))
+    )
+
+
+def normalize_words(text: str) -> List[str]:
+    """
+    The normalized words of text, without the ones that are only punctuation.
+    """
+    words = (normalize_text(word) for word in _WORDS.findall(text))
+    return [word for word in words if word]
+
+
+def matches_speculation(final: List[str], speculated: List[str]) -> bool:
+    """
+    Whether the final words are the speculated ones, or all but the last of
+    them (ASR sometimes drops a trailing word when finalizing) and at least
+    two words, a single word says too little about the rest.
+    """
+    if not final:
+        return False
+    if final == speculated:
+        return True
+    return len(final) >= 2 and len(final) == len(speculated) - 1 and speculated[: len(final)] == final
+
+
+class TurnOutput:
+    """
+    Output gate of a single completion turn.
+
+    Every side effect of a turn (sending text data, writing memory) goes
+    through emit. A regular turn is committed from the start and runs them
+    right away. A speculative turn buffers them until the final transcript
+    commits it, or drops them if it gets cancelled.
+
+    final_ms is when the ASR produced the final transcript of the turn, for
+    its latency timeline, None until a speculative turn is committed.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        start_ts: Any = None,
+        speculative: bool = False,
+        final_ms: Optional[float] = None,
+    ):
+        self.text = text
+        self.start_ts = start_ts
+        self.final_ms = final_ms
+        self.state = TURN_PENDING if speculative else TURN_COMMITTED
+        self.tokens = 0
+        self.lock = threading.Lock()
+        self.actions: List[Tuple[Callable, tuple]] = []
+
+    @property
+    def pending(self) -> bool:
+        return self.state == TURN_PENDING
+
+    @property
+    def cancelled(self) -> bool:
+        return self.state == TURN_CANCELLED
+
+    def outdated(self, outdate_ts: Any) -> bool:
+        """
+        A pending speculative turn ignores flushes, the flush it sees comes from
+        the utterance it speculates on. Whether it survives is decided by the
+        final transcript.
+        """
+        if self.state == TURN_PENDING:
+            return False
+        if self.state == TURN_CANCELLED:
+            return True
+        return self.start_ts < outdate_ts
+
+    def on_chunk(self, tokens: int = 1) -> None:
+        self.tokens += tokens
+
+    def emit(self, fn: Callable, *args) -> None:
+        with self.lock:
+            if self.state == TURN_PENDING:
+                self.actions.append((fn, args))
+                return
+            if self.state == TURN_CANCELLED:
+                return
+        fn(*args)
+
+    def commit(self, start_ts: Any, final_ms: Optional[float] = None) -> None:
+        with self.lock:
+            if self.state != TURN_PENDING:
+                return
+            # the turn is flushable from now on, like one started by the final
+            self.start_ts = start_ts
+            self.final_ms = final_ms
+            self.state = TURN_COMMITTED
+            actions, self.actions = self.actions, []
+        for fn, args in actions:
+            fn(*args)
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.state = TURN_CANCELLED
+            self.actions = []
+
+
+class Speculator:
+    """
+    Starts a speculative turn once a partial transcript has been stable for
+    stable_ms. The final transcript commits it when its normalized words
+    match the speculated ones, see matches_speculation; any other final
+    cancels it.
+    """
+
+    def __init__(self, stable_ms: int, start: Callable[[TurnOutput], None]):
+        self.stable_ms = stable_ms
+        self.start = start
+        self.lock = threading.Lock()
+        self.timer: Optional[threading.Timer] = None
+        self.partial = ""
+        self.turn: Optional[TurnOutput] = None
+
+        self.speculations = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted_tokens = 0
+
+    def on_partial(self, text: str) -> None:
+        normalized = normalize_text(text)
+        if not normalized:
+            return
+
+        with self.lock:
+            if normalized == self.partial:
+                return
+            self.partial = normalized
+            self._stop_timer()
+            # the running speculation no longer matches what the user says
+            self._cancel_turn()
+
+            self.timer = threading.Timer(
+                self.stable_ms / 1000, self._on_stable, args=[text, normalized]
+            )
+            self.timer.daemon = True
+            self.timer.start()
+
+    def on_final(self, text: str) -> Optional[TurnOutput]:
+        """
+        Returns the matching pending turn, which the caller commits. Returns
+        None if there is none and a regular turn has to be started.
+        """
+        with self.lock:
+            self._stop_timer()
+            self.partial = ""
+            turn, self.turn = self.turn, None
+
+        if turn is None:
+            return None
+
+        if turn.pending and matches_speculation(normalize_words(text), normalize_words(turn.text)):
+            self.hits += 1
+            logger.info(
+                f"speculation hit for final text: [{text}], speculated: [{turn.text}], stats: {self.stats()}"
+            )
+            return turn
+
+        self._miss(turn)
+        logger.info(
+            f"speculation miss for final text: [{text}], speculated: [{turn.text}], stats: {self.stats()}"
+        )
+        return None
+
+    def cancel(self) -> None:
+        with self.lock:
+            self._stop_timer()
+            self.partial = ""
+            self._cancel_turn()
+
+    def stats(self) -> Dict[str, float]:
+        resolved = self.hits + self.misses
+        return {
+            "speculations": self.speculations,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / resolved if resolved else 0.0,
+            "wasted_tokens": self.wasted_tokens,
+        }
+
+    def _on_stable(self, text: str, normalized: str) -> None:
+        with self.lock:
+            if self.partial != normalized or self.turn is not None:
+                return
+            turn = TurnOutput(text, speculative=True)
+            self.turn = turn
+            self.speculations += 1
+
+        logger.info(f"partial text stable for {self.stable_ms}ms, speculate on: [{text}]")
+        try:
+            self.start(turn)
+        except Exception as e:
+            logger.warning(f"start speculation failed, err: {e}")
+            with self.lock:
+                if self.turn is turn:
+                    self.turn = None
+            turn.cancel()
+
+    def _stop_timer(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _cancel_turn(self) -> None:
+        if self.turn is not None:
+            self._miss(self.turn)
+            self.turn = None
+
+    def _miss(self, turn: TurnOutput) -> None:
+        turn.cancel()
+        self.misses += 1
+        self.wasted_tokens += turn.tokens
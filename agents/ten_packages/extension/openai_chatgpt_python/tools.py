@@ -0,0 +1,236 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+import asyncio
+import importlib
+import inspect
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from .log import logger
+
+
+class ToolResult:
+    """
+    Result of a tool call. content goes back in the tool message, attachments
+    are content parts (e.g. image_url) that a tool message cannot carry, they
+    follow in a user message.
+    """
+
+    def __init__(self, content: str, attachments: Optional[List[Dict[str, Any]]] = None):
+        self.content = content
+        self.attachments = attachments or []
+
+
+class Tool:
+    """
+    Base class of the tools the model can call. Subclasses set name,
+    description and the JSON schema of the parameters, and implement run,
+    either as a plain function, which runs in the tool pool, or as a
+    coroutine, which runs on the event loop.
+
+    filler_texts are said while the tool runs, if the model did not say
+    anything before calling it.
+    """
+
+    name = ""
+    description = ""
+    parameters: Optional[Dict[str, Any]] = None
+    filler_texts: List[str] = []
+
+    def spec(self) -> Dict[str, Any]:
+        function = {"name": self.name, "description": self.description}
+        if self.parameters:
+            function["parameters"] = self.parameters
+        return {"type": "function", "function": function}
+
+    def run(self, arguments: Dict[str, Any]) -> Any:
+        raise NotImplementedError
+
+
+class ToolCall:
+    def __init__(self, index: int):
+        self.index = index
+        self.id = ""
+        self.name = ""
+        self.arguments = ""
+
+    def message(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": "function",
+            "function": {"name": self.name, "arguments": self.arguments},
+        }
+
+
+class ToolCallAssembler:
+    """
+    Assembles the tool_call deltas of a stream into complete calls. The id and
+    name come in the first delta of a call and the arguments are spread over
+    the following ones. Calls stream one after the other, so a call is
+    complete once a delta of a later call shows up, which is when on_complete
+    is called with it, letting the tool start before the stream ends.
+    """
+
+    def __init__(self, on_complete: Optional[Callable[[ToolCall], None]] = None):
+        self.on_complete = on_complete
+        self.calls: Dict[int, ToolCall] = {}
+        self.completed = set()
+
+    def feed(self, deltas: List[Any]) -> None:
+        for delta in deltas:
+            index = delta.index if delta.index is not None else 0
+            call = self.calls.get(index)
+            if call is None:
+                self._complete(lambda i: i < index)
+                call = ToolCall(index)
+                self.calls[index] = call
+            if delta.id:
+                call.id = delta.id
+            function = delta.function
+            if function is not None:
+                if function.name:
+                    call.name = function.name
+                if function.arguments:
+                    call.arguments += function.arguments
+
+    def finish(self) -> List[ToolCall]:
+        self._complete(lambda i: True)
+        return [self.calls[i] for i in sorted(self.calls)]
+
+    def _complete(self, selected: Callable[[int], bool]) -> None:
+        for index in sorted(self.calls):
+            if index in self.completed or not selected(index):
+                continue
+            self.completed.add(index)
+            if self.on_complete is not None:
+                self.on_complete(self.calls[index])
+
+
+class ToolRegistry:
+    """
+    Tools offered to the model and the pool that runs them. start schedules a
+    call right away and returns its future, so calls of one turn run
+    concurrently; results turns the finished calls into the follow-up
+    messages.
+    """
+
+    def __init__(self, pool_size: int = 4, timeout_ms: int = 10000):
+        self.tools: Dict[str, Tool] = {}
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="tool")
+        self.timeout_ms = timeout_ms
+
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.run_ms = 0.0
+
+    def register(self, tool: Tool) -> None:
+        self.tools[tool.name] = tool
+        logger.info(f"tool registered: {tool.name}")
+
+    def load(self, config: str) -> None:
+        """
+        Register tools from a JSON list, each entry is either the import path
+        of a Tool class, "package.module:ClassName", or an object with that
+        path under "class" and the constructor keyword arguments under
+        "options".
+        """
+        for entry in json.loads(config):
+            if isinstance(entry, str):
+                entry = {"class": entry}
+            module_name, _, class_name = entry["class"].partition(":")
+            cls = getattr(importlib.import_module(module_name), class_name)
+            self.register(cls(**entry.get("options", {})))
+
+    def get(self, name: str) -> Optional[Tool]:
+        return self.tools.get(name)
+
+    def specs(self) -> Optional[List[Dict[str, Any]]]:
+        if not self.tools:
+            return None
+        return [tool.spec() for tool in self.tools.values()]
+
+    def start(self, call: ToolCall) -> asyncio.Future:
+        """
+        Run a call, must be called on the event loop.
+        """
+        return asyncio.ensure_future(self._run(call))
+
+    async def results(
+        self, calls: List[ToolCall], futures: Dict[int, asyncio.Future]
+    ) -> List[Dict[str, Any]]:
+        """
+        Wait for the calls and return the tool messages, followed by a user
+        message with the attachments of all calls, if any.
+        """
+        for call in calls:
+            if call.index not in futures:
+                futures[call.index] = self.start(call)
+        done = await asyncio.gather(*[futures[call.index] for call in calls])
+
+        messages = []
+        attachments = []
+        for call, result in zip(calls, done):
+            messages.append(
+                {"role": "tool", "tool_call_id": call.id, "content": result.content}
+            )
+            attachments.extend(result.attachments)
+        if attachments:
+            messages.append({"role": "user", "content": attachments})
+        return messages
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "tools": len(self.tools),
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "avg_run_ms": self.run_ms / self.calls if self.calls else 0.0,
+        }
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
+
+    async def _run(self, call: ToolCall) -> ToolResult:
+        self.calls += 1
+        start = time.monotonic()
+        try:
+            tool = self.tools.get(call.name)
+            if tool is None:
+                raise Exception(f"unknown tool {call.name}")
+            arguments = json.loads(call.arguments) if call.arguments else {}
+
+            if inspect.iscoroutinefunction(tool.run):
+                pending = tool.run(arguments)
+            else:
+                pending = asyncio.get_running_loop().run_in_executor(
+                    self.pool, tool.run, arguments
+                )
+            result = await asyncio.wait_for(pending, self.timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"tool call {call.name} timed out after {self.timeout_ms}ms")
+            result = ToolResult(f"error: {call.name} timed out")
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"tool call {call.name} failed, err: {e}")
+            result = ToolResult(f"error: {e}")
+        finally:
+            self.run_ms += (time.monotonic() - start) * 1000
+
+        if not isinstance(result, ToolResult):
+            if not isinstance(result, str):
+                result = json.dumps(result, ensure_ascii=False)
+            result = ToolResult(result)
+        logger.info(
+            "tool call {}({}) done in {:.0f}ms".format(
+                call.name, call.arguments, (time.monotonic() - start) * 1000
+            )
+        )
+        return result
@@ -0,0 +1,171 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+import math
+import threading
+import time
+from base64 import b64encode
+from io import BytesIO
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from .log import logger
+from .tools import Tool, ToolResult
+
+
+class VisionFrameBuffer:
+    """
+    Keeps only the newest video frame for the vision tool. The frame slot is
+    swapped under a lock while the encoder works on the previous reference,
+    so ingest never waits for an encode.
+
+    Frames are downsampled at ingest with numpy stride slicing, which copies
+    only the kept pixels, and ingest is throttled to one frame per
+    interval_ms. Once the vision tool asked for a frame, a background thread
+    encodes the newest frame to a JPEG data URL, cached by frame sequence
+    number, so later get_data_url calls usually return without encoding
+    anything. Until then no frame is encoded.
+    """
+
+    def __init__(self, max_size: int = 320, interval_ms: int = 300, quality: int = 75):
+        self.max_size = max_size
+        self.interval_ms = interval_ms
+        self.quality = quality
+
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.frame: Optional[np.ndarray] = None
+        self.last_ingest = 0.0
+        self.encoded_seq = 0
+        self.encoded_url = None
+        self.picked_seq = 0
+        # set by the first get_data_url, frames are encoded ahead from then on
+        self.wanted = False
+
+        self.stopped = False
+        self.thread = None
+
+        self.ingested = 0
+        self.skipped = 0
+        self.encoded = 0
+
+    def start(self) -> None:
+        self.stopped = False
+        self.thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, buf, width: int, height: int) -> bool:
+        """
+        Ingest an RGBA frame. Returns False if it was skipped by the interval.
+        """
+        now = time.monotonic()
+        if self.interval_ms > 0 and (now - self.last_ingest) * 1000 < self.interval_ms:
+            self.skipped += 1
+            return False
+        self.last_ingest = now
+
+        step = max(1, math.ceil(max(width, height) / self.max_size))
+        rgba = np.frombuffer(buf, dtype=np.uint8, count=width * height * 4)
+        rgba = rgba.reshape(height, width, 4)
+        # the sliced view still points into the frame buffer, copy the kept pixels
+        frame = np.ascontiguousarray(rgba[::step, ::step, :3])
+
+        with self.cond:
+            self.seq += 1
+            self.frame = frame
+            self.ingested += 1
+            self.cond.notify()
+        return True
+
+    def get_data_url(self) -> Optional[str]:
+        """
+        JPEG data URL of the newest frame, None if no frame arrived yet.
+        """
+        with self.cond:
+            if not self.wanted:
+                self.wanted = True
+                self.picked_seq = self.seq
+            if self.frame is None:
+                return None
+            if self.encoded_seq == self.seq:
+                return self.encoded_url
+            seq, frame = self.seq, self.frame
+
+        # background encode is behind, do it on the caller
+        url = self._encode(frame)
+        self._store(seq, url)
+        return url
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "ingested": self.ingested,
+                "skipped": self.skipped,
+                "encoded": self.encoded,
+                "seq": self.seq,
+            }
+
+    def _store(self, seq: int, url: str) -> None:
+        with self.cond:
+            if seq > self.encoded_seq:
+                self.encoded_seq = seq
+                self.encoded_url = url
+
+    def _encode(self, frame: np.ndarray) -> str:
+        buffered = BytesIO()
+        Image.fromarray(frame, "RGB").save(buffered, format="JPEG", quality=self.quality)
+        self.encoded += 1
+        return "data:image/jpeg;base64," + b64encode(buffered.getvalue()).decode("utf-8")
+
+    def _encode_loop(self) -> None:
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.wanted or self.picked_seq == self.seq):
+                    self.cond.wait()
+                if self.stopped:
+                    break
+                seq, frame = self.seq, self.frame
+                self.picked_seq = seq
+
+            try:
+                self._store(seq, self._encode(frame))
+            except Exception as e:
+                # skip this frame, get_data_url retries it on the caller
+                logger.warning(f"encode vision frame {seq} failed, err: {e}")
+
+
+class VisionTool(Tool):
+    """
+    Lets the model look at the newest camera frame. Tool messages carry text
+    only, so the frame follows the tool result as an image attachment.
+    """
+
+    # ensure you use gpt-4o or later model if you need image recognition, gpt-4o-mini does not work quite well in this case
+    name = "get_vision_image"
+    description = "Get the image from camera. Call this whenever you need to understand the input camera image like you have vision capability, for example when user asks 'What can you see?' or 'Can you see me?'"
+
+    def __init__(self, frames: VisionFrameBuffer, filler_texts: Optional[List[str]] = None):
+        self.frames = frames
+        self.filler_texts = filler_texts or []
+
+    def run(self, arguments: dict) -> ToolResult:
+        url = self.frames.get_data_url()
+        if url is None:
+            return ToolResult("no camera image is available")
+        return ToolResult(
+            "the camera image is attached",
+            [{"type": "image_url", "image_url": {"url": url}}],
+        )
@@ -0,0 +1,104 @@
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Iterator, List, Optional
+
+from .log import logger
+
+
+class SynthesisJob:
+    """
+    Audio of one queued sentence. run reads the Polly stream in a pool
+    thread, so the sentences after the playing one are requested and
+    buffered while it plays, and iter_chunks hands the chunks to the player
+    as they arrive. A cancelled job stops reading and drops what it buffered.
+    marks are the viseme SpeechMarks of the sentence, if requested, and
+    timeline its latency timeline, stamped by the player. first_chunk_ms is
+    the unix epoch ms the first audio chunk arrived at.
+    """
+
+    def __init__(self, text: str, ts, generation: int, cache_key: Optional[str] = None):
+        self.text = text
+        self.ts = ts
+        self.generation = generation
+        self.cache_key = cache_key
+        self.future = None
+        self.marks = None
+        self.timeline = None
+        self.first_chunk_ms = None
+
+        self.cond = threading.Condition()
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.cancelled = False
+        self.error = None
+
+    @classmethod
+    def cached(cls, text: str, ts, generation: int, data) -> "SynthesisJob":
+        job = cls(text, ts, generation)
+        job.chunks.append(data)
+        job.first_chunk_ms = time.time() * 1000
+        job.done = True
+        return job
+
+    def run(self, synthesize: Callable, chunk_size: int) -> None:
+        try:
+            if self.cancelled:
+                return
+            audio_stream, marks = synthesize(self.text)
+            with self.cond:
+                self.marks = marks
+                cancelled = self.cancelled
+            if cancelled and marks is not None:
+                marks.cancel()
+            with closing(audio_stream) as stream:
+                for chunk in stream.iter_chunks(chunk_size=chunk_size):
+                    with self.cond:
+                        if self.cancelled:
+                            break
+                        if self.first_chunk_ms is None:
+                            self.first_chunk_ms = time.time() * 1000
+                        self.chunks.append(chunk)
+                        self.cond.notify_all()
+        except Exception as e:
+            logger.exception(e)
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def cancel(self) -> None:
+        with self.cond:
+            self.cancelled = True
+            self.chunks = []
+            marks = self.marks
+            self.cond.notify_all()
+        if marks is not None:
+            marks.cancel()
+        if self.future is not None:
+            self.future.cancel()
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """
+        Yield the chunks in order, waiting for the ones still in flight. Stops
+        early if the job is cancelled.
+        """
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done and not self.cancelled:
+                    self.cond.wait()
+                if self.cancelled:
+                    return
+                if index >= len(self.chunks):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                chunk = self.chunks[index]
+            index += 1
+            yield chunk
+
+    def audio(self) -> bytes:
+        with self.cond:
+            return b"".join(self.chunks)
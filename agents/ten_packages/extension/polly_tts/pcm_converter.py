@@ -0,0 +1,278 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Streaming PCM sample rate, channel and sample width conversion shared by the
+# TTS extensions. Every TTS extension ships an identical copy of this file,
+# keep them in sync. It has no package imports, run it directly for a CPU cost
+# benchmark.
+import math
+import time
+from typing import Dict, Iterable, Union
+
+import numpy as np
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# little endian integer PCM by sample width, 8 bit PCM is unsigned
+_DTYPES = {1: np.dtype("u1"), 2: np.dtype("<i2"), 4: np.dtype("<i4")}
+_OFFSETS = {1: 128.0, 2: 0.0, 4: 0.0}
+
+# output samples filtered at a time
+_BLOCK = 4096
+
+
+def native_rate(supported: Iterable[int], wanted: int) -> int:
+    """
+    The provider rate to request for output at wanted: wanted itself if the
+    provider has it, else the lowest supported rate above it, else the
+    highest one. Requesting from above keeps the whole band of the output.
+    """
+    rates = sorted(set(supported))
+    if wanted in rates:
+        return wanted
+    for rate in rates:
+        if rate > wanted:
+            return rate
+    return rates[-1]
+
+
+class PcmConverter:
+    """
+    Converts a stream of interleaved integer PCM of any chunking from one
+    sample rate, channel count and sample width to another.
+
+    Resampling is a polyphase windowed sinc filter at the rational ratio of
+    the two rates, evaluated with NumPy for all output samples of a chunk at
+    once. The filter history and any partial sample frame are kept across
+    chunks, so the output of a chunked stream is the same as that of the
+    whole stream. The filter delay is compensated, output sample 0 lines up
+    with input sample 0, and flush drains the tail so a stream of n input
+    samples gives round(n * out_rate / in_rate) output samples.
+
+    Channels are mixed down before resampling and copied up after it, so the
+    filter runs on the smaller channel count. With identical input and
+    output formats push returns the input unchanged.
+    """
+
+    def __init__(
+        self,
+        in_rate: int,
+        out_rate: int,
+        in_channels: int = 1,
+        out_channels: int = 1,
+        in_width: int = 2,
+        out_width: int = 2,
+        zero_crossings: int = 16,
+    ):
+        if in_width not in _DTYPES or out_width not in _DTYPES:
+            raise ValueError(f"unsupported sample width {in_width} -> {out_width}")
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.in_width = in_width
+        self.out_width = out_width
+        self.in_frame_size = in_width * in_channels
+        self.passthrough = (
+            in_rate == out_rate and in_channels == out_channels and in_width == out_width
+        )
+        self.channels = min(in_channels, out_channels)
+
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.bank = None
+        self.taps = 1
+        self.delay = 0
+        if in_rate != out_rate:
+            self.bank, self.delay = _design(self.up, self.down, zero_crossings)
+            self.taps = self.bank.shape[1]
+        self.offsets = np.arange(self.taps)
+
+        self.carry = b""
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drop the filter state and any partial input, to start a new stream.
+        """
+        self.carry = b""
+        # samples before the stream are silence
+        self.history = np.zeros((self.taps - 1, self.channels), dtype=np.float32)
+        self.consumed = 0  # input samples pushed, history included from here on
+        self.produced = 0  # output samples computed, the delay included
+
+    def push(self, data: Buffer) -> bytes:
+        """
+        Convert a chunk, returns the output samples it completes.
+        """
+        if self.passthrough:
+            return bytes(data)
+        if self.carry:
+            data = self.carry + bytes(data)
+        whole = len(data) - len(data) % self.in_frame_size
+        self.carry = bytes(data[whole:])
+        if whole == 0:
+            return b""
+        samples = self._decode(memoryview(data)[:whole])
+        return self._encode(self._resample(samples))
+
+    def flush(self) -> bytes:
+        """
+        The rest of the stream, the samples still inside the filter. Resets the
+        converter for the next stream.
+        """
+        if self.passthrough:
+            self.carry = b""
+            return b""
+        if self.bank is None:
+            self.reset()
+            return b""
+        total = int(round(self.consumed * self.up / self.down))
+        wanted = total - max(self.produced - self.delay, 0)
+        out = b""
+        if wanted > 0:
+            # enough silence to compute the last output sample
+            last = self.delay + total - 1
+            needed = (last * self.down) // self.up + 1 - self.consumed
+            consumed = self.consumed
+            y = self._resample(np.zeros((max(needed, 0), self.channels), dtype=np.float32))
+            self.consumed = consumed
+            out = self._encode(y[:wanted])
+        self.reset()
+        return out
+
+    def _decode(self, data: memoryview) -> np.ndarray:
+        x = np.frombuffer(data, dtype=_DTYPES[self.in_width]).astype(np.float32)
+        offset = _OFFSETS[self.in_width]
+        if offset:
+            x -= offset
+        x *= 1.0 / (1 << (8 * self.in_width - 1))
+        x = x.reshape(-1, self.in_channels)
+        if self.in_channels > self.out_channels:
+            if self.out_channels == 1:
+                x = x.mean(axis=1, keepdims=True)
+            else:
+                x = x[:, : self.out_channels]
+        return x
+
+    def _encode(self, y: np.ndarray) -> bytes:
+        if self.out_channels > y.shape[1]:
+            if y.shape[1] == 1:
+                y = np.repeat(y, self.out_channels, axis=1)
+            else:
+                pad = np.repeat(y[:, -1:], self.out_channels - y.shape[1], axis=1)
+                y = np.concatenate([y, pad], axis=1)
+        scale = float(1 << (8 * self.out_width - 1))
+        y = np.rint(y * scale + _OFFSETS[self.out_width])
+        info = np.iinfo(_DTYPES[self.out_width])
+        np.clip(y, info.min, info.max, out=y)
+        return y.astype(_DTYPES[self.out_width]).tobytes()
+
+    def _resample(self, x: np.ndarray) -> np.ndarray:
+        if self.bank is None:
+            self.consumed += len(x)
+            return x
+        buf = np.concatenate([self.history, x]) if len(self.history) else x
+        start = self.consumed - len(self.history)  # stream index of buf[0]
+        self.consumed += len(x)
+
+        # every output sample whose newest input sample has arrived
+        end = (self.consumed * self.up - 1) // self.down + 1
+        n = np.arange(self.produced, end, dtype=np.int64)
+        self.produced = max(end, self.produced)
+        self.history = buf[len(buf) - (self.taps - 1) :] if self.taps > 1 else buf[:0]
+        if len(n) == 0:
+            return np.zeros((0, self.channels), dtype=np.float32)
+
+        pos = n * self.down
+        base = pos // self.up - start
+        phase = pos % self.up
+        y = np.empty((len(n), self.channels), dtype=np.float32)
+        # in blocks, the gathered windows of a long chunk would take taps
+        # times its size
+        for i in range(0, len(n), _BLOCK):
+            j = i + _BLOCK
+            window = buf[base[i:j, None] - self.offsets[None, :]]  # (n, taps, channels)
+            y[i:j] = np.einsum("itc,it->ic", window, self.bank[phase[i:j]])
+
+        # drop the filter delay at the head of the stream
+        skip = self.delay - int(n[0])
+        if skip > 0:
+            y = y[skip:]
+        return y
+
+
+def _design(up: int, down: int, zero_crossings: int):
+    """
+    The polyphase bank of a Kaiser windowed sinc low pass for resampling by
+    up / down, bank[p, i] = h[p + i * up], and its delay in output samples.
+    """
+    # cut off at the lower of the two Nyquist frequencies, a little below it
+    # for the transition band
+    cutoff = 0.94 / max(up, down)
+    taps = 2 * int(math.ceil(zero_crossings * max(1.0, down / up)))
+    length = taps * up
+    # centered on a whole output sample, so the delay can be cut exactly
+    delay = int(round((length - 1) / 2.0 / down))
+    t = np.arange(length) - delay * down
+    h = cutoff * np.sinc(cutoff * t) * np.kaiser(length, 8.6) * up
+    bank = h.reshape(taps, up).T.astype(np.float32)
+    return np.ascontiguousarray(bank), delay
+
+
+def benchmark(
+    in_rate: int,
+    out_rate: int,
+    in_channels: int = 1,
+    out_channels: int = 1,
+    seconds: float = 10.0,
+    chunk_ms: int = 20,
+) -> Dict[str, float]:
+    """
+    CPU time a single core spends converting one second of audio, pushed in
+    chunks of chunk_ms.
+    """
+    converter = PcmConverter(in_rate, out_rate, in_channels, out_channels)
+    samples = in_rate * chunk_ms // 1000
+    t = np.arange(samples * in_channels) / in_rate
+    chunk = (np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2").tobytes()
+    chunks = int(seconds * 1000 / chunk_ms)
+
+    start = time.process_time()
+    out = 0
+    for _ in range(chunks):
+        out += len(converter.push(chunk))
+    out += len(converter.flush())
+    cpu = time.process_time() - start
+    audio = chunks * chunk_ms / 1000
+    return {
+        "in_rate": in_rate,
+        "out_rate": out_rate,
+        "in_channels": in_channels,
+        "out_channels": out_channels,
+        "taps": converter.taps,
+        "cpu_ms_per_audio_s": cpu * 1000 / audio,
+        "realtime_factor": audio / cpu if cpu else float("inf"),
+    }
+
+
+if __name__ == "__main__":
+    for args in [
+        (16000, 16000),
+        (16000, 48000),
+        (24000, 16000),
+        (22050, 16000),
+        (44100, 48000),
+        (48000, 16000, 2, 1),
+        (16000, 48000, 1, 2),
+    ]:
+        result = benchmark(*args)
+        print(
+            "{in_rate:>5}Hz x{in_channels} -> {out_rate:>5}Hz x{out_channels} ({taps:>3} taps): {cpu_ms_per_audio_s:6.2f} ms CPU per audio second, {realtime_factor:>8,.0f}x realtime".format(
+                **result
+            )
+        )
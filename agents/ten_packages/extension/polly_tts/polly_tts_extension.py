@@ -11,12 +11,28 @@ from ten import (
 
 import queue
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import traceback
 from contextlib import closing
 
+from .audio_cache import AudioCache, load_phrases
+from .frame_pacer import FramePacer
 from .log import logger
-from .polly_wrapper import PollyWrapper, PollyConfig
+from .lookahead import SynthesisJob
+from .pcm_converter import PcmConverter, native_rate
+from .pcm_framer import PcmFramer
+from .polly_wrapper import PCM_SAMPLE_RATES, PollyWrapper, PollyConfig
+from .text_coalescer import TextCoalescer
+from .turn_timeline import (
+    STAGE_FIRST_AUDIO,
+    STAGE_FLUSH,
+    STAGE_LAST_FRAME,
+    STAGE_TTS_REQUEST,
+    TimelineRecorder,
+    get_turn_id,
+)
 
 PROPERTY_REGION = "region"  # Optional
 PROPERTY_ACCESS_KEY = "access_key"  # Optional
@@ -24,7 +40,23 @@ PROPERTY_SECRET_KEY = "secret_key"  # Optional
 PROPERTY_ENGINE = "engine"  # Optional
 PROPERTY_VOICE = "voice"  # Optional
 PROPERTY_SAMPLE_RATE = "sample_rate"  # Optional
+PROPERTY_PROVIDER_SAMPLE_RATE = "provider_sample_rate"  # Optional
 PROPERTY_LANG_CODE = "lang_code"  # Optional
+PROPERTY_FRAME_MS = "frame_ms"  # Optional
+PROPERTY_AUDIO_CACHE_MEMORY_MB = "audio_cache_memory_mb"  # Optional
+PROPERTY_AUDIO_CACHE_PATH = "audio_cache_path"  # Optional
+PROPERTY_AUDIO_CACHE_PHRASES = "audio_cache_phrases"  # Optional
+PROPERTY_LOOKAHEAD = "lookahead"  # Optional
+PROPERTY_PACING_LEAD_MS = "pacing_lead_ms"  # Optional
+PROPERTY_COALESCE_MIN_CHARS = "coalesce_min_chars"  # Optional
+PROPERTY_COALESCE_MAX_DELAY_MS = "coalesce_max_delay_ms"  # Optional
+PROPERTY_INCLUDE_VISEMES = "include_visemes"  # Optional
+PROPERTY_TIMELINE_PATH = "timeline_path"  # Optional
+
+DATA_OUT_VISEME = "viseme_data"
+DATA_OUT_VISEME_PROPERTY_VALUE = "value"
+DATA_OUT_VISEME_PROPERTY_TIME_MS = "time_ms"
+DATA_OUT_VISEME_PROPERTY_TIMESTAMP = "timestamp"
 
 
 class PollyTTSExtension(Extension):
@@ -36,10 +68,45 @@ class PollyTTSExtension(Extension):
         self.thread = None
         self.queue = queue.Queue()
         self.frame_size = None
+        self.frame_ms = 10
+        self.framer = None
+        self.converter = None
+        self.audio_cache = None
+        self.audio_cache_memory_mb = 16
+
+        # sentences requested ahead of the playing one, a flush bumps the
+        # generation, which cancels every job issued before it
+        self.lookahead = 2
+        self.pool = None
+        self.generation = 0
+
+        # frames go out at playout rate, pacing_lead_ms ahead of real time
+        self.pacing_lead_ms = 150
+        self.pacer = None
+
+        # fragments after the first of a turn are merged before synthesis
+        self.coalesce_min_chars = 20
+        self.coalesce_max_delay_ms = 200
+        self.coalescer = None
 
         self.bytes_per_sample = 2
         self.number_of_channels = 1
 
+        # with visemes, the last frame queued and the visemes it carries
+        self.held_frame = None
+
+        # a timeline per sentence, first_audio is when its first audio
+        # arrived, last_frame the timestamp of its last frame. turn_id is the
+        # LLM timeline of the texts on_data takes
+        self.timelines = None
+        self.last_frame_ms = 0
+        self.turn_id = None
+
+        # the end of the last frame queued on the pacer and the generation it
+        # belongs to, the next sentence continues from there
+        self.frames_end_ms = None
+        self.frames_generation = 0
+
     def on_start(self, ten: TenEnv) -> None:
         logger.info("PollyTTSExtension on_start")
 
@@ -50,6 +117,7 @@ class PollyTTSExtension(Extension):
             PROPERTY_ENGINE,
             PROPERTY_VOICE,
             PROPERTY_SAMPLE_RATE,
+            PROPERTY_PROVIDER_SAMPLE_RATE,
             PROPERTY_LANG_CODE,
             PROPERTY_ACCESS_KEY,
             PROPERTY_SECRET_KEY,
@@ -63,13 +131,140 @@ class PollyTTSExtension(Extension):
                     f"GetProperty optional {optional_param} failed, err: {err}. Using default value: {polly_config.__getattribute__(optional_param)}"
                 )
 
+        # sample_rate is the rate of the outgoing frames, Polly is asked for
+        # the nearest rate it has unless provider_sample_rate names one
+        sample_rate = int(polly_config.sample_rate)
+        provider_sample_rate = polly_config.provider_sample_rate
+        if not provider_sample_rate.isdigit() or int(provider_sample_rate) not in PCM_SAMPLE_RATES:
+            if provider_sample_rate:
+                logger.warning(f"unsupported {PROPERTY_PROVIDER_SAMPLE_RATE} {provider_sample_rate}")
+            provider_sample_rate = str(native_rate(PCM_SAMPLE_RATES, sample_rate))
+        polly_config.provider_sample_rate = provider_sample_rate
+        if int(provider_sample_rate) != sample_rate:
+            logger.info(f"resampling polly audio from {provider_sample_rate} to {sample_rate}")
+
+        try:
+            polly_config.include_visemes = ten.get_property_bool(PROPERTY_INCLUDE_VISEMES)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_INCLUDE_VISEMES} failed, err: {err}. Using default value: {polly_config.include_visemes}"
+            )
+
+        try:
+            frame_ms = ten.get_property_int(PROPERTY_FRAME_MS)
+            if frame_ms > 0:
+                self.frame_ms = frame_ms
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_FRAME_MS} failed, err: {err}. Using default value: {self.frame_ms}"
+            )
+
+        audio_cache_path = ""
+        audio_cache_phrases = ""
+        try:
+            self.audio_cache_memory_mb = ten.get_property_int(PROPERTY_AUDIO_CACHE_MEMORY_MB)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_AUDIO_CACHE_MEMORY_MB} failed, err: {err}. Using default value: {self.audio_cache_memory_mb}"
+            )
+        for optional_param in [PROPERTY_AUDIO_CACHE_PATH, PROPERTY_AUDIO_CACHE_PHRASES]:
+            try:
+                value = ten.get_property_string(optional_param).strip()
+                if optional_param == PROPERTY_AUDIO_CACHE_PATH:
+                    audio_cache_path = value
+                else:
+                    audio_cache_phrases = value
+            except Exception as err:
+                logger.debug(f"GetProperty optional {optional_param} failed, err: {err}")
+
+        try:
+            lookahead = ten.get_property_int(PROPERTY_LOOKAHEAD)
+            if lookahead >= 0:
+                self.lookahead = lookahead
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_LOOKAHEAD} failed, err: {err}. Using default value: {self.lookahead}"
+            )
+
+        try:
+            self.pacing_lead_ms = ten.get_property_int(PROPERTY_PACING_LEAD_MS)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_PACING_LEAD_MS} failed, err: {err}. Using default value: {self.pacing_lead_ms}"
+            )
+
+        try:
+            self.coalesce_min_chars = ten.get_property_int(PROPERTY_COALESCE_MIN_CHARS)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_COALESCE_MIN_CHARS} failed, err: {err}. Using default value: {self.coalesce_min_chars}"
+            )
+        try:
+            self.coalesce_max_delay_ms = ten.get_property_int(PROPERTY_COALESCE_MAX_DELAY_MS)
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_COALESCE_MAX_DELAY_MS} failed, err: {err}. Using default value: {self.coalesce_max_delay_ms}"
+            )
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string(PROPERTY_TIMELINE_PATH).strip()
+        except Exception as err:
+            logger.debug(f"GetProperty optional {PROPERTY_TIMELINE_PATH} failed, err: {err}")
+        self.timelines = TimelineRecorder("polly_tts", timeline_path)
+
         self.polly = PollyWrapper(polly_config)
-        self.frame_size = int(
-            int(polly_config.sample_rate)
-            * self.number_of_channels
-            * self.bytes_per_sample
-            / 100
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.lookahead + 1, thread_name_prefix="polly"
+        )
+        self.framer = PcmFramer(
+            int(polly_config.sample_rate),
+            self.frame_ms,
+            self.bytes_per_sample,
+            self.number_of_channels,
+        )
+        self.frame_size = self.framer.frame_size
+        self.converter = PcmConverter(
+            int(polly_config.provider_sample_rate),
+            int(polly_config.sample_rate),
+            self.number_of_channels,
+            self.number_of_channels,
+            self.bytes_per_sample,
+            self.bytes_per_sample,
+        )
+        self.pacer = FramePacer(
+            lambda item: self.__send_paced(ten, item),
+            self.frame_ms,
+            self.pacing_lead_ms,
+            "polly_pacer",
         )
+        self.pacer.start()
+        self.coalescer = TextCoalescer(
+            self.__put_text,
+            self.coalesce_min_chars,
+            self.coalesce_max_delay_ms,
+            "polly_coalescer",
+        )
+        self.coalescer.start()
+
+        if polly_config.include_visemes:
+            # the cache holds audio only, a cached sentence would have no visemes
+            logger.info("audio cache disabled, visemes are included")
+        elif self.audio_cache_memory_mb > 0 or audio_cache_path:
+            self.audio_cache = AudioCache(
+                max(self.audio_cache_memory_mb, 0) * 1024 * 1024, audio_cache_path
+            )
+            try:
+                phrases = load_phrases(audio_cache_phrases)
+            except Exception as err:
+                logger.warning(f"invalid {PROPERTY_AUDIO_CACHE_PHRASES}, err: {err}")
+                phrases = []
+            if phrases:
+                threading.Thread(
+                    target=self.audio_cache.prerender,
+                    args=[phrases, self.__cache_key, self.__render],
+                    daemon=True,
+                ).start()
 
         self.thread = threading.Thread(target=self.async_polly_handler, args=[ten])
         self.thread.start()
@@ -79,75 +274,256 @@ class PollyTTSExtension(Extension):
         logger.info("PollyTTSExtension on_stop")
 
         self.stopped = True
+        logger.info(f"coalescer stats: {self.coalescer.stats()}")
+        self.coalescer.stop()
         self.queue.put(None)
         self.flush()
         self.thread.join()
+        self.pool.shutdown(wait=False)
+        logger.info(f"pacer stats: {self.pacer.stats()}")
+        self.pacer.stop()
+        if self.audio_cache is not None:
+            logger.info(f"audio cache stats: {self.audio_cache.stats()}")
+            self.audio_cache.close()
+        self.timelines.report()
         ten.on_stop_done()
 
     def need_interrupt(self, ts: datetime.time) -> bool:
         return (self.outdateTs - ts).total_seconds() > 1
 
-    def __get_frame(self, data: bytes) -> AudioFrame:
+    def __cache_key(self, text: str) -> str:
+        config = self.polly.config
+        return AudioCache.make_key(
+            "polly-" + config.engine,
+            config.voice,
+            config.lang_code or "",
+            int(config.provider_sample_rate),
+            text,
+        )
+
+    def __render(self, text: str) -> bytes:
+        audio_stream, _ = self.polly.synthesize(text)
+        with closing(audio_stream) as stream:
+            return stream.read()
+
+    def __get_frame(self, data: memoryview, timestamp: int) -> AudioFrame:
         sample_rate = int(self.polly.config.sample_rate)
 
         f = AudioFrame.create("pcm_frame")
         f.set_sample_rate(sample_rate)
         f.set_bytes_per_sample(2)
         f.set_number_of_channels(1)
+        f.set_timestamp(timestamp)
 
         f.set_data_fmt(AudioFrameDataFmt.INTERLEAVE)
-        f.set_samples_per_channel(sample_rate // 100)
-        f.alloc_buf(self.frame_size)
+        f.set_samples_per_channel(self.framer.samples_per_frame)
+        f.alloc_buf(len(data))
         buff = f.lock_buf()
-        if len(data) < self.frame_size:
-            buff[:] = bytes(self.frame_size)  # fill with 0
-        buff[: len(data)] = data
+        buff[:] = data
         f.unlock_buf(buff)
         return f
 
-    def async_polly_handler(self, ten: TenEnv):
-        while not self.stopped:
-            value = self.queue.get()
+    def __viseme_data(self, mark: dict, base_ms: int) -> Data:
+        d = Data.create(DATA_OUT_VISEME)
+        d.set_property_string(DATA_OUT_VISEME_PROPERTY_VALUE, mark.get("value", ""))
+        d.set_property_int(DATA_OUT_VISEME_PROPERTY_TIME_MS, mark.get("time", 0))
+        d.set_property_int(DATA_OUT_VISEME_PROPERTY_TIMESTAMP, base_ms + mark.get("time", 0))
+        return d
+
+    def __put_frame(self, job: SynthesisJob, frame: memoryview, timestamp: int, base_ms: int) -> None:
+        """
+        Queue a frame on the pacer together with the visemes that start
+        within it, so they are sent when the frame is. With visemes frames
+        are queued one behind, __put_held_frame queues the last frame of a
+        sentence with the visemes still left.
+        """
+        audio_frame = self.__get_frame(frame, timestamp)
+        self.last_frame_ms = timestamp
+        self.frames_end_ms = timestamp + self.frame_ms
+        if job.marks is None:
+            self.pacer.put(audio_frame)
+            return
+        marks = job.marks.until(timestamp - base_ms + self.frame_ms)
+        if self.held_frame is not None:
+            self.__put_paced(*self.held_frame)
+        self.held_frame = (audio_frame, [self.__viseme_data(mark, base_ms) for mark in marks])
+
+    def __put_held_frame(self, job: SynthesisJob, base_ms: int) -> None:
+        if self.held_frame is None:
+            return
+        audio_frame, visemes = self.held_frame
+        self.held_frame = None
+        visemes += [self.__viseme_data(mark, base_ms) for mark in job.marks.rest(1.0)]
+        self.__put_paced(audio_frame, visemes)
+
+    def __put_paced(self, audio_frame: AudioFrame, visemes: list) -> None:
+        self.pacer.put((audio_frame, visemes) if visemes else audio_frame)
+
+    def __send_paced(self, ten: TenEnv, item) -> None:
+        if isinstance(item, tuple):
+            audio_frame, visemes = item
+            ten.send_audio_frame(audio_frame)
+            for d in visemes:
+                ten.send_data(d)
+        else:
+            ten.send_audio_frame(item)
+
+    def __base_ms(self, job: SynthesisJob) -> int:
+        """
+        The timestamp of the first frame of a sentence. It follows the frames
+        of the previous sentence still queued on the pacer, so the frame and
+        viseme timelines of consecutive sentences don't overlap, and starts
+        at the wall clock after a flush or once the pacer has drained.
+        """
+        now = int(datetime.now().timestamp() * 1000)
+        if self.frames_end_ms is None or job.generation != self.frames_generation:
+            self.frames_generation = job.generation
+            return now
+        return max(now, self.frames_end_ms)
+
+    def __stale(self, job: SynthesisJob) -> bool:
+        return job.generation != self.generation or self.need_interrupt(job.ts)
+
+    def __fill(self, pending: deque, block: bool) -> bool:
+        """
+        Start jobs for queued sentences until the playing one has lookahead
+        jobs behind it. Only the first get blocks, and only if block is set.
+        Returns False once the queue is closed.
+        """
+        while len(pending) <= self.lookahead:
+            try:
+                value = self.queue.get(block=block and len(pending) == 0)
+            except queue.Empty:
+                return True
             if value is None:
                 logger.warning("async_polly_handler: exit due to None value got.")
-                break
-            inputText, ts = value
+                return False
+            inputText, ts, turn_id = value
             if len(inputText) == 0:
                 logger.warning("async_polly_handler: empty input detected.")
-                continue
-            try:
-                audio_stream, visemes = self.polly.synthesize(inputText)
-                with closing(audio_stream) as stream:
-                    for chunk in stream.iter_chunks(chunk_size=self.frame_size):
-                        if self.need_interrupt(ts):
+                # the flush marker, back to the loop to see if it stopped
+                return True
+
+            cache_key = None
+            if self.audio_cache is not None and self.audio_cache.cacheable(inputText):
+                cache_key = self.__cache_key(inputText)
+                cached = self.audio_cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"async_polly_handler: audio cache hit for [{inputText}]")
+                    job = SynthesisJob.cached(inputText, ts, self.generation, cached)
+                    job.timeline = self.timelines.begin(inputText, turn_id)
+                    job.timeline.stamp(STAGE_TTS_REQUEST)
+                    pending.append(job)
+                    continue
+
+            job = SynthesisJob(inputText, ts, self.generation, cache_key)
+            job.timeline = self.timelines.begin(inputText, turn_id)
+            job.timeline.stamp(STAGE_TTS_REQUEST)
+            job.future = self.pool.submit(job.run, self.polly.synthesize, self.frame_size)
+            pending.append(job)
+        return True
+
+    def __cancel(self, pending: deque) -> None:
+        if pending:
+            logger.debug(f"async_polly_handler: cancel {len(pending)} lookahead jobs.")
+        while pending:
+            pending.popleft().cancel()
+
+    def async_polly_handler(self, ten: TenEnv):
+        pending = deque()
+        try:
+            while not self.stopped:
+                if not self.__fill(pending, block=True):
+                    break
+                if not pending:
+                    continue
+
+                job = pending.popleft()
+                if self.__stale(job):
+                    job.cancel()
+                    self.__cancel(pending)
+                    continue
+
+                try:
+                    interrupted = False
+                    self.converter.reset()
+                    self.held_frame = None
+                    base_ms = self.__base_ms(job)
+                    self.framer.reset(base_ms)
+                    for chunk in job.iter_chunks():
+                        if self.__stale(job):
                             logger.debug(
                                 "async_polly_handler: got interrupt cmd, stop sending pcm frame."
                             )
+                            interrupted = True
                             break
 
-                        f = self.__get_frame(chunk)
-                        ten.send_audio_frame(f)
-            except Exception as e:
-                logger.exception(e)
-                logger.exception(traceback.format_exc())
+                        for frame, timestamp in self.framer.push(self.converter.push(chunk)):
+                            self.__put_frame(job, frame, timestamp, base_ms)
+
+                        # keep the lookahead full while this sentence plays
+                        if not self.__fill(pending, block=False):
+                            self.stopped = True
+
+                    if job.first_chunk_ms is not None:
+                        job.timeline.stamp(STAGE_FIRST_AUDIO, job.first_chunk_ms)
+
+                    if interrupted or job.cancelled:
+                        job.timeline.stamp(STAGE_FLUSH)
+                        # frames of this job pushed after the flush cleared the pacer
+                        self.pacer.clear()
+                        self.frames_end_ms = None
+                        job.cancel()
+                        self.__cancel(pending)
+                        continue
+
+                    # the tail is padded with silence to a full frame
+                    for frame, timestamp in self.framer.push(self.converter.flush()):
+                        self.__put_frame(job, frame, timestamp, base_ms)
+                    for frame, timestamp in self.framer.flush():
+                        self.__put_frame(job, frame, timestamp, base_ms)
+                    self.__put_held_frame(job, base_ms)
+                    self.pacer.end()
+                    if STAGE_FIRST_AUDIO in job.timeline.stamps:
+                        job.timeline.stamp(STAGE_LAST_FRAME, self.last_frame_ms)
+                    if job.cache_key is not None:
+                        self.audio_cache.put(job.cache_key, job.audio())
+                except Exception as e:
+                    logger.exception(e)
+                    logger.exception(traceback.format_exc())
+                finally:
+                    # the sentence played, was cut off or failed
+                    job.timeline.finish()
+        finally:
+            self.__cancel(pending)
 
     def flush(self):
         logger.info("PollyTTSExtension flush")
+        self.coalescer.clear()
         while not self.queue.empty():
             self.queue.get()
-        self.queue.put(("", datetime.now()))
+        self.queue.put(("", datetime.now(), None))
 
     def on_data(self, ten: TenEnv, data: Data) -> None:
         logger.info("PollyTTSExtension on_data")
         inputText = data.get_property_string("text")
-        if len(inputText) == 0:
+        is_end = data.get_property_bool("end_of_segment")
+        if len(inputText) == 0 and not is_end:
             logger.info("ignore empty text")
             return
 
-        is_end = data.get_property_bool("end_of_segment")
-
+        # an empty end of segment still goes to the coalescer, it starts the
+        # next turn there
         logger.info("on data %s %d", inputText, is_end)
-        self.queue.put((inputText, datetime.now()))
+        # texts the coalescer merges are of one turn
+        self.turn_id = get_turn_id(data)
+        self.coalescer.put(inputText, is_end)
+
+    def __put_text(self, text: str, end_of_segment: bool) -> None:
+        # an empty text is the flush marker of the queue, the end of a
+        # segment has no text of its own here
+        if len(text) > 0:
+            self.queue.put((text, datetime.now(), self.turn_id))
 
     def on_cmd(self, ten: TenEnv, cmd: Cmd) -> None:
         logger.info("PollyTTSExtension on_cmd")
@@ -157,6 +533,8 @@ class PollyTTSExtension(Extension):
         cmdName = cmd.get_name()
         if cmdName == "flush":
             self.outdateTs = datetime.now()
+            self.generation += 1
+            self.pacer.clear()
             self.flush()
             cmd_out = Cmd.create("flush")
             ten.send_cmd(
@@ -1,12 +1,19 @@
 import io
 import json
 import logging
+import threading
 import boto3
-from typing import Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import List, Union
 from botocore.exceptions import ClientError
 
 from .log import logger
 
+# sample rates Polly synthesizes pcm at
+PCM_SAMPLE_RATES = [8000, 16000]
+
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/polly/client/synthesize_speech.html
 class PollyConfig:
     def __init__(self, 
@@ -25,6 +32,9 @@ class PollyConfig:
         self.engine = engine
         self.lang_code = lang_code
         self.sample_rate = str(sample_rate)
+        # rate requested from Polly and converted to sample_rate, empty for
+        # the supported rate nearest to sample_rate
+        self.provider_sample_rate = ""
 
         self.speech_mark_type = 'sentence' # 'sentence'|'ssml'|'viseme'|'word'
         self.audio_format = 'pcm' # 'json'|'mp3'|'ogg_vorbis'|'pcm'
@@ -65,6 +75,10 @@ class PollyWrapper:
             self.client = boto3.client(service_name='polly', region_name=config.region)
 
         self.voice_metadata = None
+        # speech marks are requested next to the audio, in threads of their own
+        self.marks_pool = None
+        if config.include_visemes:
+            self.marks_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="polly_marks")
 
 
     def describe_voices(self):
@@ -88,39 +102,60 @@ class PollyWrapper:
         """
         Synthesizes speech or speech marks from text, using the specified voice.
 
+        The viseme marks are requested concurrently with the audio and read in
+        the background, the audio stream is returned as soon as it starts.
+
         :param text: The text to synthesize.
-        :return: The audio stream that contains the synthesized speech and a list
-                 of visemes that are associated with the speech audio.
+        :return: The audio stream that contains the synthesized speech and the
+                 SpeechMarks of the visemes that are associated with the speech
+                 audio, or None if visemes are not included.
         """
+        visemes = None
         try:
             kwargs = {
                 "Engine": self.config.engine,
                 "OutputFormat": self.config.audio_format,
                 "Text": text,
                 "VoiceId": self.config.voice,
+                "SampleRate": self.config.provider_sample_rate,
             }
             if self.config.lang_code is not None:
                 kwargs["LanguageCode"] = self.config.lang_code
+            if self.marks_pool is not None:
+                marks_kwargs = dict(kwargs, OutputFormat="json", SpeechMarkTypes=["viseme"])
+                # the sample rate only applies to audio output formats
+                marks_kwargs.pop("SampleRate")
+                visemes = SpeechMarks()
+                visemes.future = self.marks_pool.submit(self.read_speech_marks, visemes, marks_kwargs)
             response = self.client.synthesize_speech(**kwargs)
             audio_stream = response["AudioStream"]
             logger.info("Got audio stream spoken by %s.", self.config.voice)
-            visemes = None
-            if self.config.include_visemes:
-                kwargs["OutputFormat"] = "json"
-                kwargs["SpeechMarkTypes"] = ["viseme"]
-                response = self.client.synthesize_speech(**kwargs)
-                visemes = [
-                    json.loads(v)
-                    for v in response["AudioStream"].read().decode().split()
-                    if v
-                ]
-                logger.info("Got %s visemes.", len(visemes))
         except ClientError:
+            if visemes is not None:
+                visemes.cancel()
             logger.exception("Couldn't get audio stream.")
             raise
         else:
             return audio_stream, visemes
 
+    def read_speech_marks(self, marks: "SpeechMarks", kwargs: dict) -> None:
+        try:
+            if marks.cancelled:
+                return
+            response = self.client.synthesize_speech(**kwargs)
+            with closing(response["AudioStream"]) as stream:
+                # one JSON object per line, handed out as the lines arrive
+                for line in stream.iter_lines():
+                    if marks.cancelled:
+                        break
+                    if line.strip():
+                        marks.add(json.loads(line))
+            logger.info("Got %s visemes.", marks.count)
+        except Exception:
+            logger.exception("Couldn't get speech marks.")
+        finally:
+            marks.finish()
+
     def get_voice_engines(self):
         """
         Extracts the set of available voice engine types from the full list of
@@ -172,4 +207,59 @@ class PollyWrapper:
             vo["Name"]: vo["Id"]
             for vo in self.voice_metadata
             if engine in vo["SupportedEngines"] and language_code == vo["LanguageCode"]
-        }
\ No newline at end of file
+        }
+
+class SpeechMarks:
+    """
+    Speech marks of one synthesized text, read by PollyWrapper while its
+    audio streams. Every mark has the time in ms into the audio at which it
+    applies, until hands out the marks due before a point of the audio.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.marks = deque()
+        self.count = 0
+        self.done = False
+        self.cancelled = False
+        self.future = None
+
+    def add(self, mark: dict) -> None:
+        with self.cond:
+            self.marks.append(mark)
+            self.count += 1
+            self.cond.notify_all()
+
+    def finish(self) -> None:
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def cancel(self) -> None:
+        with self.cond:
+            self.cancelled = True
+            self.marks.clear()
+            self.cond.notify_all()
+        if self.future is not None:
+            self.future.cancel()
+
+    def until(self, time_ms: int) -> List[dict]:
+        """
+        The marks read so far with a time before time_ms, without waiting.
+        """
+        due = []
+        with self.cond:
+            while self.marks and self.marks[0].get("time", 0) < time_ms:
+                due.append(self.marks.popleft())
+        return due
+
+    def rest(self, timeout: float) -> List[dict]:
+        """
+        The remaining marks, waiting up to timeout seconds for the rest of the
+        stream.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or self.cancelled, timeout)
+            due = list(self.marks)
+            self.marks.clear()
+        return due
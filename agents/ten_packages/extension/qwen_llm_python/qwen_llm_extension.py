@@ -19,9 +19,21 @@ import queue
 import json
 from datetime import datetime
 import threading
-import re
 from http import HTTPStatus
 from .log import logger
+from .inflight_streams import InflightStreams
+from .sentence_segmenter import SentenceSegmenter, get_punctuations
+from .speculative import Speculator, TurnOutput
+from .turn_timeline import (
+    DATA_PROPERTY_TURN_ID,
+    STAGE_ASR_FINAL,
+    STAGE_FIRST_SENTENCE,
+    STAGE_FIRST_TOKEN,
+    STAGE_FLUSH,
+    STAGE_LLM_REQUEST,
+    TimelineRecorder,
+    get_asr_final_ms,
+)
 
 
 class QWenLLMExtension(Extension):
@@ -34,7 +46,11 @@ class QWenLLMExtension(Extension):
         self.max_history = 10
         self.stopped = False
         self.thread = None
-        self.sentence_expr = re.compile(r".+?[,，.。!！?？:：]", re.DOTALL)
+        self.sentence_punctuations = get_punctuations("default")
+        self.min_sentence_length = 0
+        self.inflight_streams = InflightStreams()
+        self.speculator = None
+        self.timelines = None
 
         self.outdate_ts = datetime.now()
         self.outdate_ts_lock = threading.Lock()
@@ -71,23 +87,48 @@ class QWenLLMExtension(Extension):
         with self.outdate_ts_lock:
             return self.outdate_ts
 
-    def complete_with_history(self, ten: TenEnv, ts: datetime.time, input_text: str):
+    def turn_outdated(self, ts: datetime.time, turn: TurnOutput) -> bool:
+        if turn is not None:
+            return turn.outdated(self.get_outdate_ts())
+        return self.need_interrupt(ts)
+
+    def complete_with_history(
+        self, ten: TenEnv, ts: datetime.time, input_text: str, turn: TurnOutput
+    ):
         """
         Complete input_text querying with built-in chat history.
+        Output and history are held back while turn is a pending speculation.
         """
 
-        def callback(text: str, end_of_segment: bool):
+        def send(text: str, end_of_segment: bool):
             d = Data.create("text_data")
             d.set_property_string("text", text)
             d.set_property_bool("end_of_segment", end_of_segment)
+            d.set_property_string(DATA_PROPERTY_TURN_ID, timeline.turn_id)
             ten.send_data(d)
 
-        messages = self.get_messages()
-        messages.append({"role": "user", "content": input_text})
-        total = self.stream_chat(ts, messages, callback)
-        self.on_msg("user", input_text)
-        if len(total) > 0:
-            self.on_msg("assistant", total)
+        def callback(text: str, end_of_segment: bool):
+            if text:
+                timeline.stamp(STAGE_FIRST_SENTENCE)
+            turn.emit(send, text, end_of_segment)
+
+        timeline = self.timelines.begin(input_text)
+        timeline.stamp(
+            STAGE_ASR_FINAL,
+            turn.final_ms if turn.final_ms is not None else ts.timestamp() * 1000,
+        )
+        try:
+            messages = self.get_messages()
+            messages.append({"role": "user", "content": input_text})
+            total = self.stream_chat(ts, messages, callback, turn, timeline)
+            turn.emit(self.on_msg, "user", input_text)
+            if len(total) > 0:
+                turn.emit(self.on_msg, "assistant", total)
+        finally:
+            # a speculative turn that was never committed is not a turn of the user
+            if turn.final_ms is not None:
+                timeline.stamps[STAGE_ASR_FINAL] = turn.final_ms
+                timeline.finish()
 
     def call_chat(self, ten: TenEnv, ts: datetime.time, cmd: Cmd):
         """
@@ -131,13 +172,24 @@ class QWenLLMExtension(Extension):
             total = self.stream_chat(ts, messages, None)
             callback(total, True)  # callback once until full answer returned
 
-    def stream_chat(self, ts: datetime.time, messages: List[Any], callback):
+    def stream_chat(
+        self,
+        ts: datetime.time,
+        messages: List[Any],
+        callback,
+        turn: TurnOutput = None,
+        timeline=None,
+    ):
         logger.info("before stream_chat call {} {}".format(messages, ts))
 
-        if self.need_interrupt(ts):
+        if self.turn_outdated(ts, turn):
             logger.warning("out of date, %s, %s", self.get_outdate_ts(), ts)
-            return
+            if timeline is not None:
+                timeline.stamp(STAGE_FLUSH)
+            return ""
 
+        if timeline is not None:
+            timeline.stamp(STAGE_LLM_REQUEST)
         responses = dashscope.Generation.call(
             self.model,
             messages=messages,
@@ -147,40 +199,63 @@ class QWenLLMExtension(Extension):
         )
 
         total = ""
-        partial = ""
-        for response in responses:
-            if self.need_interrupt(ts):
-                logger.warning("out of date, %s, %s", self.get_outdate_ts(), ts)
-                partial = ""  # discard not sent
-                break
-            if response.status_code == HTTPStatus.OK:
-                temp = response.output.choices[0]["message"]["content"]
-                if len(temp) == 0:
-                    continue
-                partial += temp
-                total += temp
-
-                m = self.sentence_expr.match(partial)
-                if m is not None:
-                    sentence = m.group(0)
-                    partial = partial[m.end(0) :]
-                    if callback is not None:
-                        callback(sentence, False)
+        segmenter = SentenceSegmenter(
+            self.sentence_punctuations, self.min_sentence_length
+        )
+        # dashscope keeps the http response inside the generator, which can't
+        # be closed from the flush thread while it is read here, so flush only
+        # marks the stream cancelled and it is closed at its next chunk
+        inflight = self.inflight_streams.register(
+            responses, closer=lambda: False, start_ts=ts, turn=turn
+        )
+        try:
+            for response in responses:
+                if self.turn_outdated(ts, turn):
+                    logger.warning("out of date, %s, %s", self.get_outdate_ts(), ts)
+                    if timeline is not None:
+                        timeline.stamp(STAGE_FLUSH)
+                    break
+                if response.status_code == HTTPStatus.OK:
+                    temp = response.output.choices[0]["message"]["content"]
+                    if len(temp) == 0:
+                        continue
+                    if timeline is not None:
+                        timeline.stamp(STAGE_FIRST_TOKEN)
+                    total += temp
+                    self.inflight_streams.on_chunk(inflight)
+                    if turn is not None:
+                        turn.on_chunk()
+
+                    for sentence in segmenter.feed(temp):
+                        if callback is not None:
+                            callback(sentence, False)
 
-            else:
-                logger.warning(
-                    "request_id: {}, status_code: {}, error code: {}, error message: {}".format(
-                        response.request_id,
-                        response.status_code,
-                        response.code,
-                        response.message,
+                else:
+                    logger.warning(
+                        "request_id: {}, status_code: {}, error code: {}, error message: {}".format(
+                            response.request_id,
+                            response.status_code,
+                            response.code,
+                            response.message,
+                        )
                     )
-                )
-                break
+                    break
+        except Exception as e:
+            if not inflight.cancelled:
+                raise
+            if timeline is not None:
+                timeline.stamp(STAGE_FLUSH)
+            logger.warning("stream closed by flush, %s", e)
+        finally:
+            self.inflight_streams.unregister(inflight)
+            responses.close()
+
+        if self.turn_outdated(ts, turn):
+            segmenter.reset()  # discard not sent
 
         # always send end_of_segment
         if callback is not None:
-            callback(partial, True)
+            callback(segmenter.flush(), True)
         logger.info("stream_chat full_answer {}".format(total))
         return total
 
@@ -191,6 +266,39 @@ class QWenLLMExtension(Extension):
         self.prompt = ten.get_property_string("prompt")
         self.max_history = ten.get_property_int("max_memory_length")
 
+        try:
+            self.sentence_punctuations = get_punctuations(
+                ten.get_property_string("sentence_language")
+            )
+        except Exception as e:
+            logger.warning("sentence_language property not found, use default")
+
+        try:
+            self.min_sentence_length = ten.get_property_int("min_sentence_length")
+        except Exception as e:
+            logger.warning("min_sentence_length property not found, default to 0")
+
+        try:
+            if ten.get_property_bool("speculative_completion"):
+                stable_ms = 400
+                try:
+                    stable_ms = ten.get_property_int("speculative_stable_ms")
+                except Exception as e:
+                    logger.warning("speculative_stable_ms property not found, default to 400")
+                self.speculator = Speculator(
+                    stable_ms,
+                    lambda turn: self.queue.put((turn.text, datetime.now(), turn)),
+                )
+        except Exception as e:
+            logger.warning("speculative_completion property not found, default to False")
+
+        timeline_path = ""
+        try:
+            timeline_path = ten.get_property_string("timeline_path")
+        except Exception as e:
+            logger.warning("timeline_path property not found, timelines are only logged")
+        self.timelines = TimelineRecorder("qwen_llm_python", timeline_path)
+
         dashscope.api_key = self.api_key
         self.thread = threading.Thread(target=self.async_handle, args=[ten])
         self.thread.start()
@@ -199,24 +307,38 @@ class QWenLLMExtension(Extension):
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("on_stop")
         self.stopped = True
+        if self.speculator is not None:
+            self.speculator.cancel()
         self.flush()
         self.queue.put(None)
         if self.thread is not None:
             self.thread.join()
             self.thread = None
+        if self.timelines is not None:
+            self.timelines.report()
         ten.on_stop_done()
 
     def flush(self):
         with self.outdate_ts_lock:
             self.outdate_ts = datetime.now()
+            outdate_ts = self.outdate_ts
 
+        self.inflight_streams.cancel_all(outdate_ts)
+        logger.info("in-flight streams stats {}".format(self.inflight_streams.stats()))
+
+        # pending speculative turns outlive flushes, see TurnOutput.outdated
+        kept = []
         while not self.queue.empty():
-            self.queue.get()
+            value = self.queue.get()
+            if value is not None and value[2] is not None and value[2].pending:
+                kept.append(value)
+        for value in kept:
+            self.queue.put(value)
 
     def on_data(self, ten: TenEnv, data: Data) -> None:
         logger.info("on_data")
         is_final = data.get_property_bool("is_final")
-        if not is_final:
+        if not is_final and self.speculator is None:
             logger.info("ignore non final")
             return
 
@@ -225,9 +347,20 @@ class QWenLLMExtension(Extension):
             logger.info("ignore empty text")
             return
 
+        if not is_final:
+            self.speculator.on_partial(input_text)
+            return
+
         ts = datetime.now()
+        final_ms = get_asr_final_ms(data)
         logger.info("on data %s, %s", input_text, ts)
-        self.queue.put((input_text, ts))
+        if self.speculator is not None:
+            turn = self.speculator.on_final(input_text)
+            if turn is not None:
+                # the speculative answer is already on its way, let it out
+                turn.commit(ts, final_ms)
+                return
+        self.queue.put((input_text, ts, TurnOutput(input_text, ts, final_ms=final_ms)))
 
     def async_handle(self, ten: TenEnv):
         while not self.stopped:
@@ -235,13 +368,13 @@ class QWenLLMExtension(Extension):
                 value = self.queue.get()
                 if value is None:
                     break
-                input, ts = value
-                if self.need_interrupt(ts):
+                input, ts, turn = value
+                if self.turn_outdated(ts, turn):
                     continue
 
                 if isinstance(input, str):
                     logger.info("fetched from queue {}".format(input))
-                    self.complete_with_history(ten, ts, input)
+                    self.complete_with_history(ten, ts, input, turn)
                 else:
                     logger.info("fetched from queue {}".format(input.get_name()))
                     self.call_chat(ten, ts, input)
@@ -261,7 +394,7 @@ class QWenLLMExtension(Extension):
                 lambda ten, result: logger.info("send_cmd flush done"),
             )
         elif cmd_name == "call_chat":
-            self.queue.put((cmd, ts))
+            self.queue.put((cmd, ts, None))
             return  # cmd_result will be returned once it's processed
         else:
             logger.info("unknown cmd {}".format(cmd_name))
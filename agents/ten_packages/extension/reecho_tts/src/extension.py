@@ -6,7 +6,7 @@
 #
 from ten import (
     AudioFrame,
-    VideoFrame,
+    AudioFrameDataFmt,
     Extension,
     TenEnv,
     Cmd,
@@ -16,40 +16,39 @@ from ten import (
 )
 # 导入追踪栈中函数调用的库
 import traceback
-# 导入python内置的typing模块中的List和Any，用于类型提示
-from typing import List, Any
 # 导入python内置的datetime模块，用于处理时间
 from datetime import datetime
 # 导入自定义的日志记录器模块log，用于记录日志信息
 from .log import logger
-# 导入 json 模块，用于处理 JSON 格式的数据
-import json
-# 导入 requests 模块，用于发送 HTTP 请求
-import requests
+# 导入睿声接口客户端和音频解码器
+from .reecho_client import PcmDecoder, ReechoClient
+# 导入把PCM数据切成固定时长音频帧的分帧器
+from .pcm_framer import PcmFramer
 # 导入queue和threading模块，用于创建队列和线程
 import queue
 import threading
+# 导入shutil模块，用于检查ffmpeg是否可用
+import shutil
 
 
 class Reecho_ttsExtension(Extension):
     def __init__(self, name):
         """
-        初始化CosyTTSExtension对象，设置属性的默认值。
+        初始化Reecho_ttsExtension对象，设置属性的默认值。
 
         参数：
         name (str)：扩展的名称。
 
-        设置api_key、voice、model和format属性为None。
-        设置sample_rate属性为16000。
+        设置接口地址、音色和合成参数的默认值。
+        设置sample_rate属性为16000，frame_ms属性为10。
         设置outdate_ts属性为当前时间。
         设置stopped标志为False。
         创建一个queue.Queue对象，并设置thread为None。
         """
         super().__init__(name)
         self.api_url = "https://v1.reecho.cn/api/tts/simple-generate"
+        self.api_key = ""
         self.voice_id = ""
-        self.default_text = ""
-        self.default_texts = [""]
         self.prompt_id = "default"
         self.model = "reecho-neural-voice-001"
         self.randomness = 97
@@ -58,9 +57,15 @@ class Reecho_ttsExtension(Extension):
         self.break_clone = False
         self.flash = False
         self.origin_audio = False
-        self.stream = False
+        self.stream = True
         self.seed = -1
-    
+        self.sample_rate = 16000
+        self.frame_ms = 10
+
+        self.client = None
+        self.framer = None
+        self.outdate_ts = datetime.now()
+
         # 初始化停止标志为False
         self.stopped = False
         # 初始化线程为None
@@ -81,26 +86,44 @@ class Reecho_ttsExtension(Extension):
         ten (TenEnv)：与扩展关联的TenEnv对象。
 
         记录一条日志信息。
-        从ten对象中获取api_key、voice、model和sample_rate属性，并打印日志。
-        根据sample_rate属性设置format格式。
+        从ten对象中读取接口地址、密钥、音色和合成参数，没有配置的属性使用默认值。
+        创建带连接池的接口客户端和分帧器。
         创建一个线程，启动异步处理任务。
         调用ten的on_start_done方法，表示启动完成。
         """
         logger.info("Reecho_ttsExtension on_start")
-        self.api_url = ten_env.get_property_string("api_url", self.api_url)
-        self.voice_id = ten_env.get_property_string("voice_id", self.voice_id)
-        self.default_text = ten_env.get_property_string("default_text", self.default_text)
-        self.default_texts = ten_env.get_property_list("default_texts", self.default_texts)
-        self.prompt_id = ten_env.get_property_string("prompt_id", self.prompt_id)
-        self.model = ten_env.get_property_string("model", self.model)
-        self.randomness = ten_env.get_property_int("randomness", self.randomness)
-        self.stability_boost = ten_env.get_property_int("stability_boost", self.stability_boost)
-        self.probability_optimization = ten_env.get_property_int("probability_optimization", self.probability_optimization)
-        self.break_clone = ten_env.get_property_bool("break_clone", self.break_clone)
-        self.flash = ten_env.get_property_bool("flash", self.flash)
-        self.origin_audio = ten_env.get_property_bool("origin_audio", self.origin_audio)
-        self.stream = ten_env.get_property_bool("stream", self.stream)
-        self.seed = ten_env.get_property_int("seed", self.seed)
+        for name in ["api_url", "api_key", "voice_id", "prompt_id", "model"]:
+            try:
+                value = ten_env.get_property_string(name)
+                if value:
+                    setattr(self, name, value)
+            except Exception as err:
+                logger.info(f"GetProperty optional {name} failed, err: {err}")
+
+        for name in [
+            "randomness",
+            "stability_boost",
+            "probability_optimization",
+            "seed",
+            "sample_rate",
+            "frame_ms",
+        ]:
+            try:
+                setattr(self, name, ten_env.get_property_int(name))
+            except Exception as err:
+                logger.info(f"GetProperty optional {name} failed, err: {err}")
+
+        for name in ["break_clone", "flash", "origin_audio", "stream"]:
+            try:
+                setattr(self, name, ten_env.get_property_bool(name))
+            except Exception as err:
+                logger.info(f"GetProperty optional {name} failed, err: {err}")
+
+        if shutil.which("ffmpeg") is None:
+            logger.error("ffmpeg not found, audio can not be decoded")
+
+        self.client = ReechoClient(self.api_url, self.api_key)
+        self.framer = PcmFramer(self.sample_rate, self.frame_ms)
 
         self.thread = threading.Thread(target=self.async_handle, args=[ten_env])
         self.thread.start()
@@ -127,6 +150,9 @@ class Reecho_ttsExtension(Extension):
         if self.thread is not None:
             self.thread.join()
             self.thread = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
         ten_env.on_stop_done()
 
     def flush(self):
@@ -171,10 +197,6 @@ class Reecho_ttsExtension(Extension):
             self.flush()
             cmd_out = Cmd.create("flush")
             ten_env.send_cmd(cmd_out, lambda ten, result: print("send_cmd flush done"))
-            # 在flush指令时同时执行generate_tts任务
-            payload = json.loads(cmd.get_payload())
-            result = self.generate_tts(payload)
-            logger.info("generated result: {}".format(result))
         else:
             logger.info("unknown cmd: {}".format(cmd_name))
 
@@ -182,35 +204,124 @@ class Reecho_ttsExtension(Extension):
         cmd_result.set_property_string("detail", "success")
         ten_env.return_result(cmd_result, cmd)
 
-    def generate_tts(self, payload):
-        headers = {
-            'User-Agent': 'Bearer sk-b71481e4d2b6cbc8e2a9d910207ab4e2',
-            'Content-Type': 'Authorization'
-        }
-        
-        default_payload = {
-            "voiceId": "bf2e0fe3-1988-42d6-95e7-2b8fd36f4d2f",
-            "text": "你好呀！你今天感觉怎么样？",
-            "texts": ["你好呀！你今天感觉怎么样？"],
-            "promptId": "default",
-            "model": "reecho-neural-voice-001",
-            "randomness": 97,
-            "stability_boost": 100,
-            "probability_optimization": 99,
-            "break_clone": False,
-            "flash": False,
-            "origin_audio": False,
-            "stream": False,
-            "seed": -1
+    def need_interrupt(self, ts: datetime) -> bool:
+        """
+        给定时间戳早于最近一次flush时，对应的文本已经过期，需要中断。
+        """
+        return self.outdate_ts > ts
+
+    def build_payload(self, text: str) -> dict:
+        """
+        生成接口的请求参数。
+        """
+        return {
+            "voiceId": self.voice_id,
+            "text": text,
+            "promptId": self.prompt_id,
+            "model": self.model,
+            "randomness": self.randomness,
+            "stability_boost": self.stability_boost,
+            "probability_optimization": self.probability_optimization,
+            "break_clone": self.break_clone,
+            "flash": self.flash,
+            "origin_audio": self.origin_audio,
+            "stream": self.stream,
+            "seed": self.seed,
         }
-        
-        # 更新默认payload与用户提供的payload
-        default_payload.update(payload)
-        
+
+    def get_frame(self, data: memoryview, timestamp: int) -> AudioFrame:
+        """
+        将一帧PCM数据转换为音频帧对象。
+        """
+        f = AudioFrame.create("pcm_frame")
+        f.set_sample_rate(self.sample_rate)
+        f.set_bytes_per_sample(2)
+        f.set_number_of_channels(1)
+        f.set_timestamp(timestamp)
+        f.set_data_fmt(AudioFrameDataFmt.INTERLEAVE)
+        f.set_samples_per_channel(len(data) // 2)
+        f.alloc_buf(len(data))
+        buff = f.lock_buf()
+        buff[:] = data
+        f.unlock_buf(buff)
+        return f
+
+    def send_pcm(self, ten_env: TenEnv, pcm: bytes):
+        for frame, timestamp in self.framer.push(pcm):
+            ten_env.send_audio_frame(self.get_frame(frame, timestamp))
+
+    def synthesize(self, ten_env: TenEnv, text: str, ts: datetime):
+        """
+        合成一句文本：取得音频地址后边下载边解码，解码出的PCM切成固定时长的音频帧发送。
+        每下载一块数据都检查一次是否被打断，打断后立即停止下载和解码。
+        """
+        start = datetime.now()
+        first_frame = True
+        interrupted = False
+        self.framer.reset(int(start.timestamp() * 1000))
+
+        url = self.client.audio_url(self.build_payload(text))
+        if self.need_interrupt(ts):
+            logger.info("drop interrupted text [{}]".format(text))
+            return
+
+        decoder = PcmDecoder(self.sample_rate)
         try:
-            response = requests.post(self.api_url, headers=headers, json=default_payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            logger.error(f"生成TTS时发生错误: {str(e)}")
-            return {"status": 500, "message": "服务器内部错误", "data": None}
\ No newline at end of file
+            for chunk in self.client.iter_audio(url):
+                if self.need_interrupt(ts):
+                    interrupted = True
+                    break
+                decoder.feed(chunk)
+                for pcm in decoder.available():
+                    if first_frame:
+                        first_frame = False
+                        logger.info(
+                            "TTS TTFB {}ms for text [{}]".format(
+                                int((datetime.now() - start).total_seconds() * 1000), text
+                            )
+                        )
+                    self.send_pcm(ten_env, pcm)
+
+            if not interrupted:
+                decoder.finish()
+                for pcm in decoder.remaining():
+                    if self.need_interrupt(ts):
+                        interrupted = True
+                        break
+                    self.send_pcm(ten_env, pcm)
+        finally:
+            decoder.kill()
+
+        if interrupted:
+            logger.info("interrupted text [{}]".format(text))
+            return
+
+        # 末尾不足一帧的数据补静音到整帧
+        for frame, timestamp in self.framer.flush():
+            ten_env.send_audio_frame(self.get_frame(frame, timestamp))
+        logger.info(
+            "TTS done in {}ms for text [{}]".format(
+                int((datetime.now() - start).total_seconds() * 1000), text
+            )
+        )
+
+    def async_handle(self, ten_env: TenEnv):
+        """
+        合成线程的入口：依次取出on_data放入队列的文本并合成，直到取到None。
+        网络请求都在这个线程里进行，flush只清空队列并更新outdate_ts，不会阻塞。
+        """
+        while not self.stopped:
+            value = self.queue.get()
+            if value is None:
+                break
+            input_text, ts, end_of_segment = value
+            if len(input_text) == 0:
+                continue
+            if self.need_interrupt(ts):
+                logger.info("drop outdated input [{}]".format(input_text))
+                continue
+            try:
+                self.synthesize(ten_env, input_text, ts)
+            except Exception as e:
+                logger.exception(e)
+                logger.exception(traceback.format_exc())
@@ -0,0 +1,151 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# 导入 json 模块，用于处理 JSON 格式的数据
+import json
+# 导入 os、queue、subprocess 和 threading 模块，用于读取解码进程的输出
+import os
+import queue
+import subprocess
+import threading
+# 导入python内置的typing模块中的Iterator，用于类型提示
+from typing import Iterator
+
+# 导入 requests 模块，用于发送 HTTP 请求
+import requests
+from requests.adapters import HTTPAdapter
+
+# 导入自定义的日志记录器模块log，用于记录日志信息
+from .log import logger
+
+
+class ReechoClient:
+    """
+    睿声语音合成接口的客户端。
+
+    所有请求共用一个带连接池的requests.Session，句子之间复用TCP和TLS连接。
+    合成分两步：先请求生成接口拿到音频地址（stream为True时是流式音频地址），
+    再以流的方式下载音频，边下载边交给解码器。
+    """
+
+    def __init__(self, api_url: str, api_key: str, pool_size: int = 4, timeout: int = 30):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if api_key:
+            self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+
+    def audio_url(self, payload: dict) -> str:
+        """
+        请求生成接口，返回音频地址。
+        """
+        response = self.session.post(
+            self.api_url, data=json.dumps(payload), timeout=self.timeout
+        )
+        response.raise_for_status()
+        data = response.json()["data"]
+        if payload.get("stream") and data.get("streamUrl"):
+            return data["streamUrl"]
+        return data["audio"]
+
+    def iter_audio(self, url: str, chunk_size: int = 4096) -> Iterator[bytes]:
+        """
+        流式下载音频，数据到达一块返回一块。
+        """
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+
+    def close(self):
+        self.session.close()
+
+
+class PcmDecoder:
+    """
+    用ffmpeg子进程把压缩音频增量解码成16位单声道PCM。
+
+    feed写入的数据随到随解，解码出的PCM由读取线程放进队列，
+    available取出已经解码好的部分，不会阻塞；finish结束输入后，
+    remaining返回剩下的全部PCM。需要PATH中有ffmpeg。
+    """
+
+    def __init__(self, sample_rate: int = 16000, read_size: int = 3200):
+        self.proc = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                "-f",
+                "s16le",
+                "-ac",
+                "1",
+                "-ar",
+                str(sample_rate),
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.read_size = read_size
+        self.output = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def feed(self, data: bytes):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def available(self) -> Iterator[bytes]:
+        while True:
+            try:
+                pcm = self.output.get_nowait()
+            except queue.Empty:
+                return
+            if pcm is None:
+                # 读到结尾的标记放回去，留给remaining
+                self.output.put(None)
+                return
+            yield pcm
+
+    def finish(self):
+        try:
+            self.proc.stdin.close()
+        except Exception as e:
+            logger.warning(f"close decoder input failed, err: {e}")
+
+    def remaining(self) -> Iterator[bytes]:
+        while True:
+            pcm = self.output.get()
+            if pcm is None:
+                return
+            yield pcm
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except Exception as e:
+            logger.warning(f"kill decoder failed, err: {e}")
+
+    def _read(self):
+        fd = self.proc.stdout.fileno()
+        try:
+            while True:
+                pcm = os.read(fd, self.read_size)
+                if not pcm:
+                    break
+                self.output.put(pcm)
+        finally:
+            self.output.put(None)
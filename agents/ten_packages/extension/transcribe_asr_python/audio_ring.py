@@ -0,0 +1,109 @@
+import threading
+from collections import deque
+from typing import Dict
+
+from .log import logger
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+
+class AudioRing:
+    """
+    Handoff of audio frames from the audio callback thread to the asyncio loop,
+    with one producer and one consumer.
+
+    put and read share a lock, held only while frames are moved, so the
+    consumer never sees a frame the producer drops meanwhile. Every counter
+    is written by one side only. The consumer drains the ring on its own
+    schedule with read, which joins the queued frames into chunks of at most
+    max_bytes.
+
+    The ring holds at most capacity_bytes. When a frame does not fit, the
+    overflow policy drops either the oldest queued frames (drop_oldest, the
+    ASR keeps up with the latest speech) or the incoming frame (drop_newest).
+    """
+
+    def __init__(self, capacity_bytes: int, overflow: str = OVERFLOW_DROP_OLDEST):
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            logger.warning(f"unknown overflow policy {overflow}, using {OVERFLOW_DROP_OLDEST}")
+            overflow = OVERFLOW_DROP_OLDEST
+        self.capacity_bytes = capacity_bytes
+        self.overflow = overflow
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # written by the producer
+        self.put_frames = 0
+        self.put_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+        # written by the consumer
+        self.read_bytes = 0
+        self.reads = 0
+        self.max_depth_bytes = 0
+
+    def depth_bytes(self) -> int:
+        return self.put_bytes - self.read_bytes - self.dropped_bytes
+
+    def put(self, frame: bytes) -> bool:
+        """
+        Queue a frame, returns False if it was dropped.
+        """
+        size = len(frame)
+        if size == 0:
+            return True
+        self.put_frames += 1
+        with self.lock:
+            if self.depth_bytes() + size > self.capacity_bytes:
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped_frames += 1
+                    self.dropped_bytes += size
+                    self.put_bytes += size
+                    return False
+                while self.frames and self.depth_bytes() + size > self.capacity_bytes:
+                    dropped = self.frames.popleft()
+                    self.dropped_frames += 1
+                    self.dropped_bytes += len(dropped)
+            self.frames.append(frame)
+            self.put_bytes += size
+        return True
+
+    def read(self, max_bytes: int) -> bytes:
+        """
+        Take queued frames, whole, up to max_bytes, at least one frame if any
+        is queued. Returns b"" if the ring is empty.
+        """
+        chunks = []
+        size = 0
+        with self.lock:
+            self.max_depth_bytes = max(self.max_depth_bytes, self.depth_bytes())
+            while self.frames:
+                if chunks and size + len(self.frames[0]) > max_bytes:
+                    break
+                frame = self.frames.popleft()
+                chunks.append(frame)
+                size += len(frame)
+            self.read_bytes += size
+        if not chunks:
+            return b""
+        self.reads += 1
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "put_frames": self.put_frames,
+            "put_bytes": self.put_bytes,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "read_bytes": self.read_bytes,
+            "reads": self.reads,
+            "depth_bytes": self.depth_bytes(),
+            "max_depth_bytes": self.max_depth_bytes,
+            "overflow": self.overflow,
+        }
@@ -10,6 +10,7 @@ from ten import (
 import asyncio
 import threading
 
+from .audio_ring import AudioRing
 from .log import logger
 from .transcribe_wrapper import AsyncTranscribeWrapper, TranscribeConfig
 
@@ -18,6 +19,15 @@ PROPERTY_ACCESS_KEY = "access_key"  # Optional
 PROPERTY_SECRET_KEY = "secret_key"  # Optional
 PROPERTY_SAMPLE_RATE = "sample_rate"  # Optional
 PROPERTY_LANG_CODE = "lang_code"  # Optional
+PROPERTY_BATCH_MS = "batch_ms"  # Optional
+PROPERTY_RING_BUFFER_MS = "ring_buffer_ms"  # Optional
+PROPERTY_OVERFLOW_POLICY = "overflow_policy"  # Optional
+PROPERTY_VAD_ENABLED = "vad_enabled"  # Optional
+PROPERTY_VAD_THRESHOLD_DB = "vad_threshold_db"  # Optional
+PROPERTY_VAD_HANGOVER_MS = "vad_hangover_ms"  # Optional
+PROPERTY_VAD_PREROLL_MS = "vad_preroll_ms"  # Optional
+PROPERTY_STANDBY_ENABLED = "standby_enabled"  # Optional
+PROPERTY_STANDBY_KEEP_S = "standby_keep_s"  # Optional
 
 
 class TranscribeAsrExtension(Extension):
@@ -25,7 +35,7 @@ class TranscribeAsrExtension(Extension):
         super().__init__(name)
 
         self.stopped = False
-        self.queue = asyncio.Queue(maxsize=3000)  # about 3000 * 10ms = 30s input
+        self.ring = None
         self.transcribe = None
         self.thread = None
 
@@ -43,6 +53,7 @@ class TranscribeAsrExtension(Extension):
             PROPERTY_LANG_CODE,
             PROPERTY_ACCESS_KEY,
             PROPERTY_SECRET_KEY,
+            PROPERTY_OVERFLOW_POLICY,
         ]:
             try:
                 value = ten.get_property_string(optional_param).strip()
@@ -53,8 +64,54 @@ class TranscribeAsrExtension(Extension):
                     f"GetProperty optional {optional_param} failed, err: {err}. Using default value: {transcribe_config.__getattribute__(optional_param)}"
                 )
 
+        # the property is a string, the VAD and the stream need a number
+        try:
+            transcribe_config.sample_rate = int(transcribe_config.sample_rate)
+        except ValueError as err:
+            logger.warning(f"invalid {PROPERTY_SAMPLE_RATE} {transcribe_config.sample_rate}, err: {err}. Using default value: 16000")
+            transcribe_config.sample_rate = 16000
+
+        for optional_param in [
+            PROPERTY_BATCH_MS,
+            PROPERTY_RING_BUFFER_MS,
+            PROPERTY_VAD_HANGOVER_MS,
+            PROPERTY_VAD_PREROLL_MS,
+            PROPERTY_STANDBY_KEEP_S,
+        ]:
+            try:
+                value = ten.get_property_int(optional_param)
+                if value > 0:
+                    transcribe_config.__setattr__(optional_param, value)
+            except Exception as err:
+                logger.debug(
+                    f"GetProperty optional {optional_param} failed, err: {err}. Using default value: {transcribe_config.__getattribute__(optional_param)}"
+                )
+
+        try:
+            # dBFS, so at most 0
+            value = ten.get_property_int(PROPERTY_VAD_THRESHOLD_DB)
+            if value < 0:
+                transcribe_config.vad_threshold_db = value
+        except Exception as err:
+            logger.debug(
+                f"GetProperty optional {PROPERTY_VAD_THRESHOLD_DB} failed, err: {err}. Using default value: {transcribe_config.vad_threshold_db}"
+            )
+
+        for optional_param in [PROPERTY_VAD_ENABLED, PROPERTY_STANDBY_ENABLED]:
+            try:
+                value = ten.get_property_bool(optional_param)
+                transcribe_config.__setattr__(optional_param, value)
+            except Exception as err:
+                logger.debug(
+                    f"GetProperty optional {optional_param} failed, err: {err}. Using default value: {transcribe_config.__getattribute__(optional_param)}"
+                )
+
+        self.ring = AudioRing(
+            transcribe_config.ring_buffer_ms * transcribe_config.bytes_per_ms(),
+            transcribe_config.overflow_policy,
+        )
         self.transcribe = AsyncTranscribeWrapper(
-            transcribe_config, self.queue, ten, self.loop
+            transcribe_config, self.ring, ten, self.loop
         )
 
         logger.info("Starting async_transcribe_wrapper thread")
@@ -64,14 +121,14 @@ class TranscribeAsrExtension(Extension):
         ten.on_start_done()
 
     def put_pcm_frame(self, pcm_frame: AudioFrame) -> None:
+        # waits at most for a read in progress, the transcribe loop drains the
+        # ring every batch_ms
         try:
-            asyncio.run_coroutine_threadsafe(
-                self.queue.put(pcm_frame), self.loop
-            ).result(timeout=0.1)
-        except asyncio.QueueFull:
-            logger.exception("Queue is full, dropping frame")
+            if not self.ring.put(bytes(pcm_frame.get_buf())):
+                if self.ring.dropped_frames % 100 == 1:
+                    logger.warning(f"ring is full, dropped {self.ring.dropped_frames} frames")
         except Exception as e:
-            logger.exception(f"Error putting frame in queue: {e}")
+            logger.exception(f"Error putting frame in ring: {e}")
 
     def on_audio_frame(self, ten: TenEnv, frame: AudioFrame) -> None:
         self.put_pcm_frame(pcm_frame=frame)
@@ -79,10 +136,15 @@ class TranscribeAsrExtension(Extension):
     def on_stop(self, ten: TenEnv) -> None:
         logger.info("TranscribeAsrExtension on_stop")
 
-        # put an empty frame to stop transcribe_wrapper
-        self.put_pcm_frame(None)
+        # transcribe_wrapper stops once the ring is closed and drained
+        self.ring.close()
         self.stopped = True
         self.thread.join()
+        logger.info(
+            f"ring stats: {self.ring.stats()}, stream stats: {self.transcribe.stats()}"
+        )
+        if self.transcribe.vad:
+            logger.info(f"vad stats: {self.transcribe.vad.stats()}")
         self.loop.stop()
         self.loop.close()
 
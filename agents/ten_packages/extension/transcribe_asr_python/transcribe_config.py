@@ -18,6 +18,32 @@ class TranscribeConfig:
         self.bytes_per_sample = 2,
         self.channel_nums = 1
 
+        # audio is sent in events of batch_ms, kept between 50 and 200 ms
+        self.batch_ms = 100
+        # audio waiting to be sent is capped at ring_buffer_ms, beyond it the
+        # overflow policy drops frames, 'drop_oldest'|'drop_newest'
+        self.ring_buffer_ms = 30000
+        self.overflow_policy = 'drop_oldest'
+
+        # silence is not sent, the gate opens at speech louder than
+        # vad_threshold_db dBFS and the noise floor, with vad_preroll_ms of
+        # the audio before it, and closes after vad_hangover_ms of silence.
+        # The stream is ended at every close to finalize the transcript, so
+        # each utterance opens a stream, billed for at least 15 s
+        self.vad_enabled = False
+        self.vad_threshold_db = -45
+        self.vad_hangover_ms = 400
+        self.vad_preroll_ms = 300
+
+        # a standby stream is kept open for standby_keep_s after the last
+        # audio, so the first words after a pause need no new stream. It is
+        # replaced every 10 s while unused, each one billed for at least 15 s
+        self.standby_enabled = False
+        self.standby_keep_s = 60
+
+    def bytes_per_ms(self) -> int:
+        return int(self.sample_rate) * 2 * self.channel_nums // 1000
+
     @classmethod
     def default_config(cls):
         return cls(
@@ -1,5 +1,7 @@
-from typing import Union
+from collections import deque
+from typing import Dict, Optional, Union
 import asyncio
+import time
 
 from ten import (
     TenEnv,
@@ -11,27 +13,115 @@ from amazon_transcribe.client import TranscribeStreamingClient
 from amazon_transcribe.handlers import TranscriptResultStreamHandler
 from amazon_transcribe.model import TranscriptEvent, TranscriptResultStream, StartStreamTranscriptionEventStream
 
+from .audio_ring import AudioRing
 from .log import logger
 from .transcribe_config import TranscribeConfig
+from .vad import VadGate
 
 DATA_OUT_TEXT_DATA_PROPERTY_TEXT = "text"
 DATA_OUT_TEXT_DATA_PROPERTY_IS_FINAL = "is_final"
+# unix epoch ms of a final, the start of the turn latency timeline downstream
+DATA_OUT_TEXT_DATA_PROPERTY_ASR_FINAL_TS = "asr_final_ts"
+DATA_OUT_VAD_DATA_PROPERTY_SPEAKING = "speaking"
+DATA_OUT_VAD_DATA_PROPERTY_TIME_MS = "time_ms"
 
 def create_and_send_data(ten: TenEnv, text_result: str, is_final: bool):
     stable_data = Data.create("text_data")
     stable_data.set_property_bool(DATA_OUT_TEXT_DATA_PROPERTY_IS_FINAL, is_final)
     stable_data.set_property_string(DATA_OUT_TEXT_DATA_PROPERTY_TEXT, text_result)
+    if is_final:
+        stable_data.set_property_int(
+            DATA_OUT_TEXT_DATA_PROPERTY_ASR_FINAL_TS, int(time.time() * 1000)
+        )
     ten.send_data(stable_data)
 
 
+def create_and_send_vad_data(ten: TenEnv, speaking: bool, time_ms: int):
+    vad_data = Data.create("vad_data")
+    vad_data.set_property_bool(DATA_OUT_VAD_DATA_PROPERTY_SPEAKING, speaking)
+    vad_data.set_property_int(DATA_OUT_VAD_DATA_PROPERTY_TIME_MS, time_ms)
+    ten.send_data(vad_data)
+
+
+# close the active stream after this long without audio
+IDLE_TIMEOUT_S = 10.0
+# Transcribe ends a stream that got no audio for 15 s, the standby stream is
+# replaced before that
+STANDBY_ROTATE_S = 10.0
+# wait before opening a standby stream again after opening one failed
+STANDBY_RETRY_S = 5.0
+# Transcribe ends a stream after 4 hours, the active stream is rotated at a
+# pause after SESSION_ROTATE_S, and at SESSION_MAX_S even mid speech
+SESSION_ROTATE_S = 3.5 * 3600
+SESSION_MAX_S = 4 * 3600 - 60
+# audio taken from the ring and not yet sent, the rest of a backlog waits in
+# the ring under its overflow policy
+MAX_PENDING_MS = 1000
+
+
+class TranscribeSession():
+    def __init__(self, stream: StartStreamTranscriptionEventStream, ten: TenEnv):
+        self.stream = stream
+        self.handler = TranscribeEventHandler(stream.output_stream, ten)
+        self.event_handler_task = asyncio.create_task(self.handler.handle_events())
+        self.opened_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.opened_at
+
+    def alive(self) -> bool:
+        # the handler ends with the stream, e.g. once the provider closed it
+        return not self.event_handler_task.done()
+
+    async def close(self) -> None:
+        try:
+            await self.stream.input_stream.end_stream()
+        except Exception as e:
+            logger.warning(f"end stream failed, err: {e}")
+        try:
+            # the final results of the audio sent are still delivered
+            await self.event_handler_task
+        except Exception as e:
+            logger.warning(f"event handler ended with err: {e}")
+
+
 class AsyncTranscribeWrapper():
-    def __init__(self, config: TranscribeConfig, queue: asyncio.Queue, ten:TenEnv, loop: asyncio.BaseEventLoop):
-        self.queue = queue
+    """
+    Streams the audio of the ring to Transcribe.
+
+    The active stream is closed after IDLE_TIMEOUT_S without audio. Next to
+    it a standby stream is kept open, so the first words after a pause, or
+    after the active stream broke or was rotated at the session limit, go to
+    a stream that is already set up. The standby is kept for standby_keep_s
+    after the last audio, and replaced every STANDBY_ROTATE_S while unused.
+
+    Audio taken from the ring stays pending until a stream has accepted it.
+    While no stream is ready it is buffered, in the ring, and replayed into
+    the next stream.
+    """
+
+    def __init__(self, config: TranscribeConfig, ring: AudioRing, ten:TenEnv, loop: asyncio.BaseEventLoop):
+        self.ring = ring
         self.ten = ten
         self.stopped = False
         self.config = config
         self.loop = loop
 
+        self.batch_ms = min(max(config.batch_ms, 50), 200)
+        self.batch_bytes = self.batch_ms * config.bytes_per_ms()
+        self.audio_events = 0
+        self.audio_bytes = 0
+
+        self.vad = None
+        if config.vad_enabled:
+            self.vad = VadGate(
+                sample_rate=config.sample_rate,
+                threshold_db=config.vad_threshold_db,
+                hangover_ms=config.vad_hangover_ms,
+                preroll_ms=config.vad_preroll_ms,
+                on_change=self.on_vad_change,
+            )
+
         if config.access_key and config.secret_key:
             logger.info(f"init trascribe client with access key: {config.access_key}")
             self.transcribe_client = TranscribeStreamingClient(
@@ -48,71 +138,250 @@ class AsyncTranscribeWrapper():
                 region=config.region
             )
 
+        self.active = None
+        self.standby = None
+        self.standby_task = None
+        self.standby_retry_at = 0.0
+        self.closing = set()
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.max_pending_bytes = MAX_PENDING_MS * config.bytes_per_ms()
+        self.last_audio = 0.0
+        # the gate closed, the stream is ended once the audio up to it is sent
+        self.speech_ended = False
+
+        self.streams_opened = 0
+        self.standby_hits = 0
+        self.reconnects = 0
+        self.rotations = 0
+        self.replayed_bytes = 0
+
         asyncio.set_event_loop(self.loop)
-        self.reset_stream()
 
-    def reset_stream(self):
-        self.stream = None
-        self.handler = None
-        self.event_handler_task = None
+    async def open_session(self) -> Optional[TranscribeSession]:
+        try:
+            stream = await self.get_transcribe_stream()
+        except Exception as e:
+            logger.exception(e)
+            return None
+        self.streams_opened += 1
+        return TranscribeSession(stream, self.ten)
+
+    def retire(self, session: Optional[TranscribeSession]) -> None:
+        """
+        Close a session in the background.
+        """
+        if session is None:
+            return
+        task = asyncio.create_task(session.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
 
     async def cleanup(self):
-        if self.stream:
-            await self.stream.input_stream.end_stream()
-            logger.info("cleanup: stream ended.")
+        if self.standby_task:
+            self.standby_task.cancel()
+            try:
+                await self.standby_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.standby_task = None
+
+        self.retire(self.active)
+        self.retire(self.standby)
+        self.active = None
+        self.standby = None
+        if self.closing:
+            await asyncio.gather(*self.closing, return_exceptions=True)
+            logger.info("cleanup: streams ended.")
+
+        if self.pending_bytes:
+            logger.warning(f"cleanup: {self.pending_bytes} bytes of audio were not sent.")
+        self.pending.clear()
+        self.pending_bytes = 0
+
+    async def replace_standby(self) -> None:
+        session = await self.open_session()
+        if session is None:
+            self.standby_retry_at = time.monotonic() + STANDBY_RETRY_S
+            return
+        old, self.standby = self.standby, session
+        self.retire(old)
 
-        if self.event_handler_task:
-            await self.event_handler_task
-            logger.info("cleanup: event handler ended.")
+    def maintain_standby(self, now: float) -> None:
+        if self.standby_task and not self.standby_task.done():
+            return
+        self.standby_task = None
 
-        self.reset_stream()
+        wanted = self.config.standby_enabled and (
+            self.active is not None or now - self.last_audio < self.config.standby_keep_s
+        )
+        if not wanted:
+            if self.standby:
+                logger.debug("standby stream closed, no audio for a while.")
+                self.retire(self.standby)
+                self.standby = None
+            return
 
-    async def create_stream(self) -> bool:
+        if now < self.standby_retry_at:
+            return
+        if self.standby is None or not self.standby.alive() or self.standby.age() >= STANDBY_ROTATE_S:
+            self.standby_task = asyncio.create_task(self.replace_standby())
+
+    async def activate(self) -> bool:
+        """
+        Make a stream active, the standby if there is one, else a new one.
+        """
+        start = time.monotonic()
+        ready = self.standby is not None and self.standby.alive()
+        if not ready and self.standby_task and not self.standby_task.done():
+            # already being opened, sooner ready than a new one
+            try:
+                await self.standby_task
+            except Exception:
+                pass
+        if self.standby and self.standby.alive():
+            self.active, self.standby = self.standby, None
+            self.standby_hits += 1
+        else:
+            self.retire(self.standby)
+            self.standby = None
+            logger.info("lazy init stream.")
+            self.active = await self.open_session()
+            if self.active is None:
+                return False
+
+        backlog = self.pending_bytes + self.ring.depth_bytes()
+        if time.monotonic() - start > self.batch_ms / 1000:
+            self.replayed_bytes += backlog
+            logger.info(f"replaying {backlog} bytes buffered while no stream was ready.")
+        return True
+
+    def rotate(self, now: float) -> None:
+        if self.active is None:
+            return
+        if not self.active.alive():
+            logger.warning("active stream ended, switching streams.")
+            self.reconnects += 1
+        elif now - self.last_audio > IDLE_TIMEOUT_S:
+            logger.debug(f"send_frame: no data for {IDLE_TIMEOUT_S}s, will close current stream.")
+        elif self.active.age() >= SESSION_MAX_S or (
+            self.active.age() >= SESSION_ROTATE_S and not (self.vad and self.vad.speaking)
+        ):
+            logger.info(f"rotating stream after {int(self.active.age())}s.")
+            self.rotations += 1
+        else:
+            return
+        self.retire(self.active)
+        self.active = None
+
+    def fill_pending(self) -> None:
+        while self.pending_bytes < self.max_pending_bytes:
+            chunk = self.ring.read(self.batch_bytes)
+            if not chunk:
+                return
+            chunk = self.gate(chunk)
+            if chunk:
+                self.pending.append(chunk)
+                self.pending_bytes += len(chunk)
+                self.last_audio = time.monotonic()
+
+    async def send_pending(self) -> bool:
+        """
+        Send the pending audio, in order. If the stream fails, it is closed and
+        the chunk stays pending for the next one.
+        """
+        while self.pending:
+            chunk = self.pending[0]
+            try:
+                await self.active.stream.input_stream.send_audio_event(audio_chunk=chunk)
+            except Exception as e:
+                logger.exception(f"Error in send_frame: {e}")
+                self.reconnects += 1
+                self.retire(self.active)
+                self.active = None
+                return False
+            self.pending.popleft()
+            self.pending_bytes -= len(chunk)
+            self.audio_events += 1
+            self.audio_bytes += len(chunk)
+        return True
+
+    def on_vad_change(self, speaking: bool) -> None:
+        time_ms = self.vad.frames * self.vad.frame_ms
+        logger.info(f"vad: speaking {speaking} at {time_ms}ms")
+        self.speech_ended = not speaking
         try:
-            self.stream = await self.get_transcribe_stream()
-            self.handler = TranscribeEventHandler(self.stream.output_stream, self.ten)
-            self.event_handler_task = asyncio.create_task(self.handler.handle_events())
+            create_and_send_vad_data(ten=self.ten, speaking=speaking, time_ms=time_ms)
         except Exception as e:
-            logger.exception(e)
-            return False
+            logger.warning(f"send vad_data failed, err: {e}")
 
-        return True
+    def gate(self, chunk: bytes) -> bytes:
+        if self.vad is None or not chunk:
+            return chunk
+        return self.vad.process(chunk)
 
     async def send_frame(self) -> None:
+        """
+        Every batch_ms, send the audio queued in the ring since, in audio
+        events of at most batch_ms each. Silence is held back by the VAD gate,
+        the stream is ended once the gate closed, to finalize the transcript.
+        """
+        # a participant that just joined likely speaks soon
+        self.last_audio = time.monotonic()
         while not self.stopped:
             try:
-                pcm_frame = await asyncio.wait_for(self.queue.get(), timeout=10.0)
+                await asyncio.sleep(self.batch_ms / 1000)
 
-                if pcm_frame is None:
-                    logger.warning("send_frame: exit due to None value got.")
-                    return
+                self.fill_pending()
+                now = time.monotonic()
+                self.rotate(now)
+                self.maintain_standby(now)
 
-                frame_buf = pcm_frame.get_buf()
-                if not frame_buf:
-                    logger.warning("send_frame: empty pcm_frame detected.")
+                if not self.pending:
+                    if self.ring.closed:
+                        logger.warning("send_frame: exit due to ring closed.")
+                        return
                     continue
 
-                if not self.stream:
-                    logger.info("lazy init stream.")
-                    if not await self.create_stream():
-                        continue
-
-                await self.stream.input_stream.send_audio_event(audio_chunk=frame_buf)
-                self.queue.task_done()
-            except asyncio.TimeoutError:
-                if self.stream:
-                    await self.cleanup()
-                    logger.debug("send_frame: no data for 10s, will close current stream and create a new one when receving new frame.")
-                else:
-                    logger.debug("send_frame: waiting for pcm frame.")
-            except IOError as e:
-                logger.exception(f"Error in send_frame: {e}")
+                # a backlog, e.g. while the stream was set up, goes out at once,
+                # a failed stream is replaced right away
+                failures = 0
+                while self.pending and failures < 2:
+                    if self.active is None and not await self.activate():
+                        break
+                    if not await self.send_pending():
+                        failures += 1
+                    self.fill_pending()
+
+                if self.speech_ended and not self.pending and self.active is not None:
+                    # Transcribe gets no audio until the next onset, ending the
+                    # stream makes it finalize the last words now, the next
+                    # onset goes to the standby
+                    logger.debug("speech ended, ending stream to finalize the transcript.")
+                    self.speech_ended = False
+                    self.retire(self.active)
+                    self.active = None
+
+                if self.pending and self.active is None and self.ring.closed:
+                    logger.warning("send_frame: exit due to ring closed, no stream for the rest of the audio.")
+                    return
             except Exception as e:
                 logger.exception(f"Error in send_frame: {e}")
                 raise e
 
         logger.info("send_frame: exit due to self.stopped == True")
 
+    def stats(self) -> Dict[str, int]:
+        return {
+            "audio_events": self.audio_events,
+            "audio_bytes": self.audio_bytes,
+            "streams_opened": self.streams_opened,
+            "standby_hits": self.standby_hits,
+            "reconnects": self.reconnects,
+            "rotations": self.rotations,
+            "replayed_bytes": self.replayed_bytes,
+        }
+
     async def transcribe_loop(self) -> None:
         try:
             await self.send_frame()
@@ -0,0 +1,153 @@
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from .log import logger
+
+# the noise floor is the lowest frame energy of the last NOISE_WINDOW_BLOCKS
+# blocks of NOISE_BLOCK_FRAMES frames, over speech too, so a steady noise
+# louder than threshold_db is learned
+NOISE_BLOCK_FRAMES = 10
+NOISE_WINDOW_BLOCKS = 20
+
+
+class VadGate:
+    """
+    Energy and zero-crossing voice activity gate for 16 bit mono PCM.
+
+    Audio is judged in frames of frame_ms. A frame is speech if its energy is
+    above the threshold, or a little below it with the high zero-crossing
+    rate of unvoiced sounds such as "s" and "f". The threshold is the higher
+    of threshold_db and the noise floor plus margin_db. The floor falls at
+    once with a quieter frame and rises slowly towards the lowest energy of
+    the last seconds, speech included, as speech has gaps between words and
+    a steady noise has none.
+
+    The gate opens after onset_ms of speech and passes the preroll_ms of
+    audio before the onset along, so the first syllable is not clipped. It
+    stays open until hangover_ms without speech. Audio while it is closed is
+    dropped. on_change(speaking) is called whenever the gate opens or closes.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        threshold_db: float = -45.0,
+        margin_db: float = 10.0,
+        hangover_ms: int = 400,
+        preroll_ms: int = 300,
+        onset_ms: int = 20,
+        frame_ms: int = 10,
+        on_change: Optional[Callable[[bool], None]] = None,
+    ):
+        self.frame_ms = frame_ms
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.hangover_frames = max(hangover_ms // frame_ms, 1)
+        self.onset_frames = max(onset_ms // frame_ms, 1)
+        self.preroll = deque(maxlen=max(preroll_ms // frame_ms, 0) + self.onset_frames)
+        self.on_change = on_change
+
+        self.carry = b""
+        self.speaking = False
+        self.onset = 0
+        self.hangover = 0
+        self.noise_db = threshold_db - margin_db
+        self.block_min = None
+        self.block_frames = 0
+        self.window = deque(maxlen=NOISE_WINDOW_BLOCKS)
+
+        self.frames = 0
+        self.speech_frames = 0
+        self.passed_frames = 0
+        self.onsets = 0
+
+    def process(self, chunk: bytes) -> bytes:
+        """
+        Judge a chunk of audio, returns the part of it to send, which is empty
+        while the gate is closed. Audio is returned in whole frames, a partial
+        frame is kept for the next chunk.
+        """
+        if self.carry:
+            chunk = self.carry + chunk
+        whole = len(chunk) - len(chunk) % self.frame_bytes
+        self.carry = chunk[whole:]
+        if whole == 0:
+            return b""
+
+        samples = np.frombuffer(chunk, dtype="<i2", count=whole // 2)
+        frames = samples.reshape(-1, self.frame_bytes // 2).astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) / (32768.0 * 32768.0) + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+        out = []
+        for i in range(len(frames)):
+            frame = chunk[i * self.frame_bytes : (i + 1) * self.frame_bytes]
+            threshold = max(self.threshold_db, self.noise_db + self.margin_db)
+            speech = energy_db[i] > threshold or (energy_db[i] > threshold - 4 and zcr[i] > 0.3)
+            self._track_noise(float(energy_db[i]))
+            self.frames += 1
+            if speech:
+                self.speech_frames += 1
+
+            if self.speaking:
+                out.append(frame)
+                if speech:
+                    self.hangover = self.hangover_frames
+                else:
+                    self.hangover -= 1
+                    if self.hangover <= 0:
+                        self._change(False)
+                continue
+
+            self.preroll.append(frame)
+            if not speech:
+                self.onset = 0
+                continue
+            self.onset += 1
+            if self.onset >= self.onset_frames:
+                out.extend(self.preroll)
+                self.preroll.clear()
+                self.onset = 0
+                self.hangover = self.hangover_frames
+                self.onsets += 1
+                self._change(True)
+
+        self.passed_frames += len(out)
+        return b"".join(out)
+
+    def _track_noise(self, energy_db: float) -> None:
+        if energy_db < self.noise_db:
+            self.noise_db = energy_db
+        self.block_min = energy_db if self.block_min is None else min(self.block_min, energy_db)
+        self.block_frames += 1
+        if self.block_frames < NOISE_BLOCK_FRAMES:
+            return
+        self.window.append(self.block_min)
+        self.block_min = None
+        self.block_frames = 0
+        floor = min(self.window)
+        if floor > self.noise_db:
+            # a fifth of the way per block, about half a second to settle
+            self.noise_db += 0.2 * (floor - self.noise_db)
+
+    def _change(self, speaking: bool) -> None:
+        self.speaking = speaking
+        if self.on_change is not None:
+            try:
+                self.on_change(speaking)
+            except Exception as e:
+                logger.warning(f"vad on_change failed, err: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "audio_ms": self.frames * self.frame_ms,
+            "speech_ms": self.speech_frames * self.frame_ms,
+            "sent_ms": self.passed_frames * self.frame_ms,
+            "suppressed_ms": (self.frames - self.passed_frames) * self.frame_ms,
+            "onsets": self.onsets,
+            "noise_db": round(float(self.noise_db), 1),
+        }
@@ -0,0 +1,20 @@
+#
+#
+# Agora Real Time Engagement
+# Copyright (c) 2024 Agora IO. All rights reserved.
+#
+#
+# Loading of the modules the extensions ship identical copies of. They are
+# loaded by path, the extension packages import the ten runtime.
+import importlib.util
+import os
+
+EXTENSION_DIR = os.path.join(os.path.dirname(__file__), "..", "ten_packages", "extension")
+
+
+def load(extension: str, module: str):
+    path = os.path.join(EXTENSION_DIR, extension, module + ".py")
+    spec = importlib.util.spec_from_file_location(f"{extension}_{module}", path)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    return m
@@ -0,0 +1,43 @@
+import numpy as np
+
+from shared_modules import load
+
+pcm_converter = load("polly_tts", "pcm_converter")
+
+
+def sine(rate: int, seconds: float = 1.0, hz: float = 440.0) -> np.ndarray:
+    return np.sin(np.arange(int(rate * seconds)) * 2 * np.pi * hz / rate) * 10000
+
+
+def test_resample_keeps_length_and_signal():
+    data = sine(24000).astype("<i2").tobytes()
+    converter = pcm_converter.PcmConverter(24000, 16000)
+    out = converter.push(data) + converter.flush()
+
+    y = np.frombuffer(out, dtype="<i2")
+    assert len(y) == 16000
+    # away from the edges the output is the same tone sampled at 16 kHz
+    assert np.abs(y[1000:15000] - sine(16000)[1000:15000]).max() < 20
+
+
+def test_chunking_does_not_change_output():
+    data = sine(22050).astype("<i2").tobytes()
+    converter = pcm_converter.PcmConverter(22050, 16000)
+    whole = converter.push(data) + converter.flush()
+    # odd chunk sizes split samples
+    chunked = b"".join(converter.push(data[i : i + 777]) for i in range(0, len(data), 777))
+    chunked += converter.flush()
+    assert chunked == whole
+
+
+def test_passthrough_and_channels():
+    converter = pcm_converter.PcmConverter(16000, 16000)
+    assert converter.push(b"\x01\x00\x02\x00") == b"\x01\x00\x02\x00"
+    converter = pcm_converter.PcmConverter(16000, 16000, 1, 2)
+    assert converter.push(b"\x01\x00\x02\x00") == b"\x01\x00\x01\x00\x02\x00\x02\x00"
+
+
+def test_native_rate():
+    assert pcm_converter.native_rate([8000, 16000, 24000], 16000) == 16000
+    assert pcm_converter.native_rate([8000, 22050, 24000], 16000) == 22050
+    assert pcm_converter.native_rate([8000, 11025], 16000) == 11025
@@ -0,0 +1,42 @@
+from shared_modules import load
+
+pcm_framer = load("polly_tts", "pcm_framer")
+
+
+def frames(framer, chunks):
+    out = []
+    for chunk in chunks:
+        out += [(bytes(frame), ts) for frame, ts in framer.push(chunk)]
+    out += [(bytes(frame), ts) for frame, ts in framer.flush()]
+    return out
+
+
+def test_chunking_does_not_change_frames():
+    # 10 ms at 16 kHz mono is 320 bytes
+    data = bytes(i % 251 for i in range(320 * 7 + 100))
+    framer = pcm_framer.PcmFramer(16000, 10)
+    framer.reset(1000)
+    whole = frames(framer, [data])
+
+    framer.reset(1000)
+    chunked = frames(framer, [data[i : i + 97] for i in range(0, len(data), 97)])
+
+    assert chunked == whole
+    assert [ts for _, ts in whole] == [1000 + 10 * i for i in range(8)]
+    assert all(len(frame) == 320 for frame, _ in whole)
+    assert b"".join(frame for frame, _ in whole) == data + bytes(220)
+
+
+def test_flush_without_padding():
+    framer = pcm_framer.PcmFramer(16000, 10)
+    assert list(framer.push(bytes(100))) == []
+    tail = [(bytes(frame), ts) for frame, ts in framer.flush(pad=False)]
+    assert tail == [(bytes(100), 0)]
+    assert list(framer.flush()) == []
+
+
+def test_reset_drops_partial_frame():
+    framer = pcm_framer.PcmFramer(16000, 10)
+    list(framer.push(bytes(100)))
+    framer.reset(500)
+    assert frames(framer, [b"\x01" * 320]) == [(b"\x01" * 320, 500)]
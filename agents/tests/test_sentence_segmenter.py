@@ -0,0 +1,63 @@
+from shared_modules import load
+
+segmenter = load("openai_chatgpt_python", "sentence_segmenter")
+
+
+def segment(deltas, punctuations=segmenter.PUNCTUATIONS["default"], min_length=0):
+    s = segmenter.SentenceSegmenter(punctuations, min_length)
+    sentences = []
+    for delta in deltas:
+        sentences += s.feed(delta)
+    return sentences, s.flush()
+
+
+def test_mixed_punctuation():
+    assert segment(["Hi, there! How are you? Fine: thanks; bye"]) == (
+        ["Hi,", " there!", " How are you?", " Fine:", " thanks;"],
+        " bye",
+    )
+
+
+def test_run_of_delimiters_stays_together():
+    assert segment(["Really?! Yes... ok"]) == (["Really?!", " Yes..."], " ok")
+
+
+def test_ellipsis_split_across_deltas_gives_no_empty_sentence():
+    sentences, remain = segment(["Wait", "..", ". what", "?!"])
+    assert sentences == ["Wait..", ". what?!"]
+    assert remain == ""
+
+
+def test_punctuation_only_piece_merges_forward():
+    assert segment(["... , Hello.", " Bye"]) == (["... , Hello."], " Bye")
+
+
+def test_cjk():
+    assert segment(["好的，我来看", "一下。今天……", "适合出门！你呢"]) == (
+        ["好的，", "我来看一下。", "今天……", "适合出门！"],
+        "你呢",
+    )
+
+
+def test_language_punctuations():
+    # the english set has no fullwidth delimiters
+    assert segment(["好的，我来看一下。ok. Next"], segmenter.get_punctuations("en")) == (
+        ["好的，我来看一下。ok."],
+        " Next",
+    )
+    assert segmenter.get_punctuations("xx") == segmenter.PUNCTUATIONS["default"]
+
+
+def test_min_length_merges_short_sentences():
+    assert segment(["Hi, there! How are you doing? Ok."], min_length=10) == (
+        ["Hi, there!", " How are you doing?"],
+        " Ok.",
+    )
+
+
+def test_chunking_does_not_change_sentences():
+    for stream in segmenter.RECORDED_TOKEN_STREAMS:
+        text = "".join(stream)
+        chunked = segment(stream)
+        assert "".join(chunked[0]) + chunked[1] == text
+        assert chunked == segment([text])
@@ -0,0 +1,29 @@
+import glob
+import os
+
+import pytest
+
+from shared_modules import EXTENSION_DIR
+
+# modules every extension using them ships an identical copy of
+SHARED_MODULES = [
+    "sentence_segmenter.py",
+    "pcm_framer.py",
+    "pcm_converter.py",
+    "text_coalescer.py",
+    "turn_timeline.py",
+    "speculative.py",
+    "inflight_streams.py",
+]
+
+
+@pytest.mark.parametrize("module", SHARED_MODULES)
+def test_copies_are_identical(module):
+    paths = glob.glob(os.path.join(EXTENSION_DIR, "**", module), recursive=True)
+    assert len(paths) > 1
+
+    contents = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            contents.setdefault(f.read(), []).append(os.path.relpath(path, EXTENSION_DIR))
+    assert len(contents) == 1, f"{module} copies differ: {list(contents.values())}"